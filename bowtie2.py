@@ -8,7 +8,7 @@ import os
 import logging
 import sys
 from operator import itemgetter
-from subprocess import Popen
+from subprocess import Popen, PIPE
 from aligner import Aligner
 
 try:
@@ -51,8 +51,8 @@ class Bowtie2(Aligner):
             Outputs:
             
             'sam' is a filename where output SAM records will be
-            stored.  If 'sam' is none, SAM records will be added to
-            the outQ.
+            stored.  If 'sam' is None, SAM records are written to
+            the standard output of self.pipe.
         """
         if index is None:
             raise RuntimeError('Must specify --index when aligner is Bowtie 2')
@@ -98,7 +98,7 @@ class Bowtie2(Aligner):
         if sam is not None:
             output_args.extend(['-S', sam])
         else:
-            raise RuntimeError("Must specify SAM output")
+            popen_stdout = PIPE
         index_args = ['-x', index]
         # Put all the arguments together
         input_args.extend(aligner_args)
@@ -7,7 +7,7 @@ Concrete subclass for BWA-MEM aligner.
 import os
 import logging
 import sys
-from subprocess import Popen
+from subprocess import Popen, PIPE
 from aligner import Aligner
 
 try:
@@ -50,8 +50,8 @@ class BwaMem(Aligner):
             Outputs:
             
             'sam' is a filename where output SAM records will be
-            stored.  If 'sam' is none, SAM records will be added to
-            the outQ.
+            stored.  If 'sam' is None, SAM records are written to
+            the standard output of self.pipe.
         """
         if index is None:
             raise RuntimeError('Must specify --index when aligner is bwa mem')
@@ -86,7 +86,7 @@ class BwaMem(Aligner):
         if sam is not None:
             output_args.extend(['>', sam])
         else:
-            raise RuntimeError("Must specify SAM output")
+            popen_stdout = PIPE
         # Tell bwa mem whether to expected paired-end interleaved input
         if pairs_only:
             options.append('-p')
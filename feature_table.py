@@ -22,7 +22,15 @@ __author__ = 'langmead'
 
 class FeatureTableReader(object):
     """ Reads a table of information describing alignments.  These are tables
-        output by qtip.  Tables might describe training or test alignments. """
+        output by qtip.  Tables might describe training or test alignments.
+
+        A table written by qtip-parse with dedup-features has one row per
+        distinct feature record, a "weight" column giving how many
+        alignments the row stands for, and an accompanying id map giving
+        the row for each alignment, in alignment order. """
+
+    # id map records: alignment id, row of the table
+    idmap_dtype = np.dtype([('id', '<u8'), ('row', '<u4')])
 
     #            short
     #            name   suffix
@@ -35,6 +43,8 @@ class FeatureTableReader(object):
         self.prefix = prefix
         self.dfs = {}
         self.readers = {}
+        self.fills = {}
+        self.idmaps = {}
         nonempty = False
         fns = []
         for sn, suf in self.datasets:
@@ -42,15 +52,44 @@ class FeatureTableReader(object):
             fns.append(fn)
             if os.path.exists(fn + '.npy') and os.stat(fn + '.npy').st_size > 0:
                 nonempty = True
-                self.readers[sn] = MetaMat(fn, chunksize)
+                self.readers[sn] = MetaMat(fn, chunksize, mmap=True)
+                self.fills[sn] = self._table_fills(self.readers[sn])
+                if 'weight' in self.readers[sn].cols:
+                    if not os.path.exists(fn + '.idmap'):
+                        raise RuntimeError('Weighted feature table "%s" has no id map' % fn)
+                    nrec = os.stat(fn + '.idmap').st_size // self.idmap_dtype.itemsize
+                    self.idmaps[sn] = np.memmap(fn + '.idmap', dtype=self.idmap_dtype, mode='r', shape=(nrec,)) \
+                        if nrec > 0 else np.empty(0, dtype=self.idmap_dtype)
 
         if not nonempty:
             raise RuntimeError('No non-empty input files with names like: ' + str(fns))
 
     @staticmethod
-    def _postprocess_data_frame(df):
+    def _table_fills(reader):
+        """ Return dict mapping each column of the table that has NAs to the
+            value to replace them with: 1 more than the column's maximum, or
+            0 if the column is all NAs.  Returns None if the table has no
+            column statistics, in which case fill values have to be worked
+            out one chunk at a time. """
+        if reader.col_nans is None or reader.col_max is None:
+            return None
+        fills = {}
+        for j, col in enumerate(reader.cols):
+            if reader.col_nans[j] > 0:
+                fills[col] = 0.0 if reader.col_nans[j] == reader.nrow else reader.col_max[j] + 1
+        return fills
+
+    @staticmethod
+    def _postprocess_data_frame(df, fills=None):
         """ Changes 'correct' column to use 0/1 and replaces NAs in the score
-            difference columns with small values. """
+            difference columns with small values.  If fills is given, it
+            maps columns to the values to replace their NAs with, and other
+            columns are left alone. """
+
+        if fills is not None:
+            if len(fills) > 0 and df.shape[0] > 0:
+                df.fillna(fills, inplace=True)
+            return df
 
         def _fill_nas(_df, nm):
             with warnings.catch_warnings(record=True) as w:
@@ -70,11 +109,114 @@ class FeatureTableReader(object):
 
         return df
 
+    @staticmethod
+    def _fill_nas_array(m, cols, fills=None):
+        """ Like _postprocess_data_frame, but fills NAs in the columns of a
+            numpy array, in place.  cols names the columns of m. """
+        if fills is not None:
+            for j, col in enumerate(cols):
+                if col in fills:
+                    arr = m[:, j]
+                    arr[np.isnan(arr)] = fills[col]
+            return m
+        for j in range(m.shape[1]):
+            col = m[:, j]
+            nas = np.isnan(col)
+            if nas.any():
+                col[nas] = 0 if nas.all() else np.nanmax(col) + 1
+        return m
+
+    def dataset_chunk_bounds(self, sn):
+        """ Return list of (first row, last row + 1) for each chunk that
+            dataset_iter would return. """
+        assert sn in self.readers
+        return self.readers[sn].chunk_bounds()
+
+    def dataset_rows(self, sn, row_i, row_f, cols):
+        """ Return array with the named columns for rows [row_i, row_f),
+            with NAs filled in the same way as by dataset_iter.  Columns
+            are copied straight from the memory-mapped table; in a columnar
+            table, other columns are never touched. """
+        assert sn in self.readers
+        cols = self.readers[sn].cols if cols is None else cols
+        return self._fill_nas_array(self.readers[sn].rows(row_i, row_f, cols),
+                                    cols, self.fills[sn])
+
+    def dataset_rows_at(self, sn, rows, cols):
+        """ Like dataset_rows, but for the rows with the given indexes, in
+            the given order. """
+        assert sn in self.readers
+        cols = self.readers[sn].cols if cols is None else cols
+        return self._fill_nas_array(self.readers[sn].take(rows, cols),
+                                    cols, self.fills[sn])
+
+    def dataset_ids(self, sn, row_i, row_f):
+        """ Return uint64 array with the alignment ids of rows [row_i,
+            row_f).  In a columnar table, ids are read with their own type,
+            so ids too big for a double are exact. """
+        assert sn in self.readers
+        reader = self.readers[sn]
+        if reader.columnar:
+            return reader.column('id', row_i, row_f).astype(np.uint64)
+        return reader.rows(row_i, row_f, ['id'])[:, 0].astype(np.uint64)
+
     def dataset_iter(self, sn):
         """ Return an iterator over chunks of rows from the data frame. """
         assert sn in self.readers
         self.readers[sn].reset()
-        return imap(lambda x: self._postprocess_data_frame(x), self.readers[sn])
+        fills = self.fills[sn]
+        return imap(lambda x: self._postprocess_data_frame(x, fills), self.readers[sn])
+
+    def weighted(self, sn):
+        """ Return true iff the table for sn has one row per distinct
+            record, with weights and an id map """
+        return sn in self.idmaps
+
+    def idmap(self, sn):
+        """ Return the id map for sn as a structured array with fields id
+            and row """
+        assert sn in self.idmaps
+        return self.idmaps[sn]
+
+    def idmap_chunk_bounds(self, sn):
+        """ Return list of (first, last + 1) for chunks of the id map of the
+            same size as the chunks of the table """
+        n = len(self.idmap(sn))
+        chunk_size = self.readers[sn].chunk_size
+        if chunk_size <= 0:
+            return [(0, n)]
+        return [(i, min(i + chunk_size, n)) for i in range(0, n, chunk_size)]
+
+    def shape(self, sn):
+        """ Return (rows, columns) of the table for sn """
+        assert sn in self.readers
+        return self.readers[sn].nrow, len(self.readers[sn].cols)
+
+    def max_id(self):
+        """ Return greatest alignment id in any table, or -1 if all are
+            empty.  Ids ascend within a table and its id map. """
+        mx = -1
+        for sn, reader in self.readers.items():
+            if sn in self.idmaps:
+                if len(self.idmaps[sn]) > 0:
+                    mx = max(mx, int(self.idmaps[sn]['id'][-1]))
+            elif reader.nrow > 0:
+                mx = max(mx, int(self.dataset_ids(sn, reader.nrow - 1, reader.nrow)[0]))
+        return mx
+
+    def chunk_rows(self, sn):
+        """ Return maximum number of rows in a chunk from dataset_iter """
+        assert sn in self.readers
+        nrow = self.readers[sn].nrow
+        chunk_size = self.readers[sn].chunk_size
+        return nrow if chunk_size <= 0 else min(nrow, chunk_size)
+
+    def estimated_bytes(self, sn):
+        """ Return rough estimate of peak memory needed to load the whole
+            table for sn and convert it to a matrix for fitting.  The table
+            is held in chunks, concatenated, then copied to a matrix. """
+        nrow, ncol = self.shape(sn)
+        return 3 * 8 * nrow * ncol
 
     def __contains__(self, o):
         return o in self.readers
@@ -15,6 +15,10 @@ import gc
 import os
 import sys
 import multiprocessing
+import collections
+import pickle
+import struct
+import traceback
 from sklearn import cross_validation
 try:
     import itertools.izip as zip
@@ -35,26 +39,94 @@ def _np_deduping_indexes(m):
     return idx, inv
 
 
+def _physical_memory_bytes():
+    """ Return total physical memory in bytes """
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
 def _get_peak_gb():
     """ Return peak RSS in GB.  Seems spuriously high on the Mac. """
     return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024.0 * 1024.0)
 
 
-def _clamp_predictions(pcor, min_pcor=0.0, max_pcor=0.999999):
-    """ Clamp numpy array of pcor predictions between 0 and 1 - 1e-6 """
-    return np.maximum(np.minimum(pcor, max_pcor), min_pcor)
+def _clamp_predictions(pcor, min_pcor=0.0, max_pcor=0.999999, out=None):
+    """ Clamp numpy array of pcor predictions between 0 and 1 - 1e-6,
+        writing them to out if given """
+    return np.maximum(np.minimum(pcor, max_pcor, out=out), min_pcor, out=out)
 
 
-def postprocess_predictions(pcor_test, dataset_name, max_pcor=0.999999, log=logging):
-    """ Deal with pcors equal to 1.0, which cause infinite MAPQs """
-    mn, mx = min(pcor_test), max(pcor_test)
-    if mx >= 1.0:
-        if mn == mx:
+def postprocess_predictions(pcor_test, dataset_name, max_pcor=0.999999, log=logging, inplace=False):
+    """ Deal with pcors equal to 1.0, which cause infinite MAPQs: they're
+        replaced with a hair more than the greatest pcor less than 1.0,
+        then all are clamped.  If inplace is set, pcor_test must be a
+        float64 array and is overwritten with the result. """
+    pcor = pcor_test if inplace else np.array(pcor_test, dtype=np.float64)
+    assert pcor.dtype == np.float64
+    if pcor.shape[0] > 0 and pcor.max() >= 1.0:
+        ones = pcor >= 1.0
+        if ones.all():
             log.warning('All data points for %s are predicted correct; results unreliable' % dataset_name)
-            pcor_test = [max_pcor] * len(pcor_test)
-        max_noninf_pcor_test = max(filter(lambda x: x < 1.0, pcor_test))
-        pcor_test = [max_noninf_pcor_test + 1e-6 if p >= 1.0 else p for p in pcor_test]
-    return _clamp_predictions(pcor_test, 0.0, max_pcor)
+            pcor.fill(max_pcor)
+        else:
+            pcor[ones] = pcor[~ones].max() + 1e-6
+    return _clamp_predictions(pcor, 0.0, max_pcor, out=pcor)
+
+
+def _pcor_to_mapq_f4(pcor):
+    """ Return float32 MAPQs for post-processed pcors, as pcor_to_mapq_np
+        would compute them, using pcor (a float64 array) as scratch space
+        so no temporary arrays are needed. """
+    mapq = np.empty(pcor.shape[0], dtype=np.float32)
+    with np.errstate(divide='ignore'):
+        np.subtract(1.0, pcor, out=pcor)
+        np.log10(pcor, out=pcor)
+    np.multiply(pcor, -10.0, out=pcor)
+    return np.abs(pcor, out=mapq)
+
+
+def _stratum_ids(df):
+    """ Return array giving each row's stratum for stratified sampling: a
+        combination of whether the alignment is correct and its original
+        MAPQ. """
+    correct = df['correct'].values.astype(np.int64) + 1
+    mapq = np.clip(df['mapq'].values, 0, 1023).astype(np.int64)
+    return correct * 1024 + mapq
+
+
+def _stratified_sample(chunk_iter, nrows, log=logging, seed=0):
+    """ Return a data frame with a stratified sample of about nrows rows
+        from a table too big to hold in memory.  chunk_iter is a function
+        returning a new iterator over the table's chunks, since the table
+        is read twice.  The first pass counts
+        rows per stratum (see _stratum_ids) and allots each stratum a share
+        of nrows in proportion to its size, at least 1 row.  The second
+        pass keeps, for each stratum, the rows with the smallest random
+        keys seen so far, so at most one chunk plus the sample is in memory
+        at a time.  Rows are kept in their original order. """
+    counts = {}
+    for chunk in chunk_iter():
+        for st, cnt in zip(*np.unique(_stratum_ids(chunk), return_counts=True)):
+            counts[st] = counts.get(st, 0) + cnt
+    ntot = sum(counts.values())
+    strata = np.array(sorted(counts.keys()), dtype=np.int64)
+    quota = np.array([min(counts[st], max(1, (nrows * counts[st]) // ntot)) for st in strata], dtype=np.int64)
+    log.info('  Sampling %d of %d rows from %d strata' % (quota.sum(), ntot, len(strata)))
+    rng = np.random.RandomState(seed)
+    vals, keys, sts, cols = None, None, None, None
+    for chunk in chunk_iter():
+        if vals is None:
+            vals, keys, sts, cols = chunk.values, rng.random_sample(chunk.shape[0]), _stratum_ids(chunk), chunk.columns
+        else:
+            vals = np.concatenate((vals, chunk.values))
+            keys = np.concatenate((keys, rng.random_sample(chunk.shape[0])))
+            sts = np.concatenate((sts, _stratum_ids(chunk)))
+        # rank rows by key within stratum; keep those within the quota
+        order = np.lexsort((keys, sts))
+        sorted_sts = sts[order]
+        rank = np.arange(len(order)) - np.searchsorted(sorted_sts, sorted_sts, side='left')
+        keep = np.sort(order[rank < quota[np.searchsorted(strata, sorted_sts)]])
+        vals, keys, sts = vals[keep], keys[keep], sts[keep]
+    return pandas.DataFrame(data=vals, columns=cols)
 
 
 def _df_to_mat(data, shortname, training, training_labs, log=logging, include_mapq=False):
@@ -63,7 +135,7 @@ def _df_to_mat(data, shortname, training, training_labs, log=logging, include_ma
         original MAPQ predictions, the ids for the alignments (i.e. their
         line of origin) and whether or not the alignments are correct. """
     labs = []
-    exclude_cols = ['id', 'correct', 'rname']
+    exclude_cols = ['id', 'correct', 'rname', 'weight']
     if not include_mapq:
         exclude_cols.append('mapq')
     if training:
@@ -94,25 +166,42 @@ def _df_to_mat(data, shortname, training, training_labs, log=logging, include_ma
     return data_mat, data['id'], np.array(data['mapq'], dtype=int), correct, labs
 
 
-_prediction_worker_queue = multiprocessing.Queue()
-_prediction_worker_trained_models = None
-_prediction_worker_pred_overall = None
-_prediction_worker_log = None
+def _rows_to_mat(dfs, shortname, row_i, row_f, training_labs):
+    """ Like _df_to_mat for test data, but takes the feature columns for
+        rows [row_i, row_f) straight from the feature table, so only the
+        columns needed are copied, once. """
+    assert shortname in training_labs, (shortname, str(training_labs.keys()))
+    labs = training_labs[shortname]
+    data_mat = dfs.dataset_rows(shortname, row_i, row_f, labs)
+    assert not np.isinf(data_mat).any() and not np.isnan(data_mat).any()
+    other = dfs.dataset_rows(shortname, row_i, row_f, ['mapq', 'correct'])
+    ids = dfs.dataset_ids(shortname, row_i, row_f)
+    return data_mat, ids, other[:, 0].astype(int), other[:, 1].astype(int), labs
 
 
-def _prediction_worker(my_test_chunk_tup, training, training_labs, ds,
-                       ds_long, dedup, multiprocess=True, include_mapq=False):
-    i, my_test_chunk = my_test_chunk_tup
+# Set in the parent before worker processes are forked, so that workers share
+# the trained models and the memory-mapped feature tables copy-on-write
+# instead of receiving a pickled copy
+_prediction_worker_trained_models = None
+_prediction_worker_dfs = None
+_prediction_worker_log = logging
+# MAPQ store shared with worker processes, which fill in their own chunks
+_prediction_worker_store = None
+
+
+def _predict_chunk(my_test_chunk_tup, training, training_labs, ds, ds_long, dedup):
+    """ Make predictions for one chunk of a dataset, given as its index and
+        its range of rows.  Returns the predicted probabilities, not yet
+        post-processed, along with the rows' ids, original MAPQs and
+        correctness. """
+    _, (row_i, row_f) = my_test_chunk_tup
     gc.collect()
     log = _prediction_worker_log
     trained_model = _prediction_worker_trained_models[ds]
-    pred_overall = _prediction_worker_pred_overall
     log.info('  PID %d predicting for %s %s chunk, %d rows (peak mem=%0.2fGB)' %
-             (os.getpid(), 'training' if training else 'test', ds_long, my_test_chunk.shape[0], _get_peak_gb()))
+             (os.getpid(), 'training' if training else 'test', ds_long, row_f - row_i, _get_peak_gb()))
     x_test, ids, mapq_orig_test, y_test, col_names = \
-        _df_to_mat(my_test_chunk, ds, False, training_labs, log=log, include_mapq=include_mapq)
-    del my_test_chunk
-    gc.collect()
+        _rows_to_mat(_prediction_worker_dfs, ds, row_i, row_f, training_labs)
     if dedup:
         log.info('    Done loading data; collapsing and making predictions')
         idxs, invs = _np_deduping_indexes(x_test)
@@ -124,53 +213,94 @@ def _prediction_worker(my_test_chunk_tup, training, training_labs, ds,
         pcor = trained_model.predict(x_test)  # make predictions
     del x_test
     gc.collect()
-    pcor = np.array(postprocess_predictions(pcor, ds_long))
+    return pcor, ids, mapq_orig_test, y_test
+
+
+def _pred_df(pcor, ids, mapq_orig, correct, ds):
+    """ Return data frame of predictions for alignments of category ds,
+        given post-processed predicted probabilities, which are
+        overwritten. """
     # convert category data to doubles
     ds = {'u': 1.0, 'b': 2.0, 'c': 3.0, 'd': 4.0}.get(ds)
-    pred_df = pandas.DataFrame({'mapq': pandas.Series(pcor_to_mapq_np(pcor), dtype=np.float32),
-                                'ids': pandas.Series(ids, dtype=np.float64),
-                                'category': ds,
-                                'mapq_orig': pandas.Series(mapq_orig_test, dtype=np.int16),
-                                'correct': pandas.Series(y_test, dtype=np.int8)})
+    return pandas.DataFrame({'mapq': pandas.Series(_pcor_to_mapq_f4(pcor), copy=False),
+                             'ids': pandas.Series(ids, dtype=np.uint64),
+                             'category': ds,
+                             'mapq_orig': pandas.Series(mapq_orig, dtype=np.int16),
+                             'correct': pandas.Series(correct, dtype=np.int8)})
+
+
+def _prediction_worker(my_test_chunk_tup, training, training_labs, ds,
+                       ds_long, dedup, include_mapq=False):
+    """ Make predictions for one chunk of a dataset, given as its index and
+        its range of rows, and store its MAPQs in the shared store.  Returns
+        the chunk's index along with a data frame of its predictions. """
+    pcor, ids, mapq_orig_test, y_test = \
+        _predict_chunk(my_test_chunk_tup, training, training_labs, ds, ds_long, dedup)
+    pcor = postprocess_predictions(np.asarray(pcor, dtype=np.float64), ds_long, inplace=True)
+    pred_df = _pred_df(pcor, ids, mapq_orig_test, y_test, ds)
+    if _prediction_worker_store is not None:
+        MapqPredictions.store(_prediction_worker_store, ids, pred_df.mapq.values)
+    _prediction_worker_log.info('    Done; peak mem usage so far = %0.2fGB' % _get_peak_gb())
+    return my_test_chunk_tup[0], pred_df
+
+
+def _pcor_worker(my_test_chunk_tup, training, training_labs, ds,
+                 ds_long, dedup, include_mapq=False):
+    """ Like _prediction_worker, but for a chunk of a de-duplicated table,
+        whose rows stand for alignments all over the input.  Returns the
+        chunk's index along with its predicted probabilities, not yet
+        post-processed. """
+    return my_test_chunk_tup[0], \
+        _predict_chunk(my_test_chunk_tup, training, training_labs, ds, ds_long, dedup)[0]
+
+
+def _prediction_worker_init():
+    _prediction_worker_log.info('  Initializing worker process with PID %d' % (os.getpid()))
+    # cores are divided among worker processes, so each predicts serially
+    for model in _prediction_worker_trained_models.values():
+        if hasattr(model, 'n_jobs'):
+            model.n_jobs = 1
+
+
+def _add_predictions(pred_overall, pred_df, stored=False):
+    """ Add a chunk's predictions to pred_overall, along with the columns
+        needed for tallying if correctness is known.  If stored is set, the
+        chunk's MAPQs are already in pred_overall's store. """
+    if pred_df.shape[0] == 0:
+        return
     cor_mn, cor_mx = pred_df.correct.min(), pred_df.correct.max()
-    has_correct = cor_mx >= 0
-    if multiprocess:
-        if has_correct:
-            assert cor_mn in [0, 1], (cor_mn, cor_mx)
-            assert cor_mx in [0, 1], (cor_mn, cor_mx)
-            assert cor_mx >= cor_mn, (cor_mn, cor_mx)
-            return (i, pred_df, pred_df.ids[0], pred_df.ids.iloc[-1],
-                    pred_df.mapq, pred_df.mapq_orig, pred_df.correct)
-        else:
-            return i, pred_df, pred_df.ids[0], pred_df.ids.iloc[-1]
+    if cor_mx >= 0:
+        assert cor_mn in [0, 1], (cor_mn, cor_mx)
+        assert cor_mx in [0, 1], (cor_mn, cor_mx)
+        pred_overall.add(pred_df, pred_df.mapq, pred_df.mapq_orig, pred_df.correct, stored=stored)
     else:
-        if has_correct:
-            assert cor_mn in [0, 1], (cor_mn, cor_mx)
-            assert cor_mx in [0, 1], (cor_mn, cor_mx)
-            assert cor_mx >= cor_mn, (cor_mn, cor_mx)
-            pred_overall.add(pred_df, pred_df.ids[0], pred_df.ids.iloc[-1],
-                             pred_df.mapq, pred_df.mapq_orig, pred_df.correct)
-        else:
-            pred_overall.add(pred_df, pred_df.ids[0], pred_df.ids.iloc[-1])
-    log.info('    Done; peak mem usage so far = %0.2fGB' %
-             (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024.0 * 1024.0)))
+        pred_overall.add(pred_df, stored=stored)
+
+
+def _fork_pool(n, initializer=None):
+    """ Return a pool of n worker processes created by forking this one, so
+        module globals set beforehand are shared copy-on-write. """
+    ctx = multiprocessing.get_context('fork') if hasattr(multiprocessing, 'get_context') else multiprocessing
+    return ctx.Pool(n, initializer)
 
 
-def _prediction_worker_star(a_b):
-    return _prediction_worker(*a_b)
+# Scoring function and candidate predictors being scored in the
+# hyperparameter search; set before forking the pool that scores them
+_crossval_worker_score = None
+_crossval_worker_preds = None
 
 
-def _prediction_worker_init(log):
-    log.info('  Initializing worker process with PID %d' % (os.getpid()))
+def _crossval_worker(i):
+    return _crossval_worker_score(_crossval_worker_preds[i])
 
 
 class MapqFit:
     """ Encapsulates an object that fits models and makes predictions """
 
     @staticmethod
-    def _subsample(x_train, mapq_orig_train, y_train, sample_fraction):
-        """ Return a random subset of the data, MAPQs and labels.  Size of
-            subset given by sample_fraction. """
+    def _subsample(x_train, mapq_orig_train, y_train, sample_fraction, w_train=None):
+        """ Return a random subset of the data, MAPQs, labels and weights (if
+            any).  Size of subset given by sample_fraction. """
         n_training_samples = x_train.shape[0]
         assert x_train.shape[0] == y_train.shape[0]
         if sample_fraction < 1.0:
@@ -178,31 +308,44 @@ class MapqFit:
             x_train = x_train[sample_indexes, ]
             y_train = y_train[sample_indexes, ]
             mapq_orig_train = mapq_orig_train[sample_indexes, ]
-        return x_train, mapq_orig_train, y_train
+            if w_train is not None:
+                w_train = w_train[sample_indexes, ]
+        return x_train, mapq_orig_train, y_train, w_train
 
     @staticmethod
     def _fit_and_possibly_reweight_and_refit(predictor, x_train, y_train,
                                              reweight_ratio=1.0,
                                              reweight_mapq=False,
-                                             reweight_mapq_offset=10.0):
+                                             reweight_mapq_offset=10.0,
+                                             w_train=None):
         """ Fit, then, if request, use predictions to weigh samples and re-fit.
             Tends to force the model to fit the high-MAPQ points better so we have fewer
-            incorrect alignments with high MAPQ. """
-        predictor.fit(x_train, y_train)
+            incorrect alignments with high MAPQ.  w_train, if given, gives
+            the number of alignments each row stands for, and multiplies
+            any reweighting. """
+        predictor.fit(x_train, y_train, w_train)
+        w = 1.0 if w_train is None else w_train
         if reweight_ratio > 1.0:
             y_pred = predictor.predict(x_train)
             lower = 1.0 / reweight_ratio
             y_pred = lower + y_pred * (1.0 - lower)
-            predictor.fit(x_train, y_train, y_pred)
+            predictor.fit(x_train, y_train, y_pred * w)
         elif reweight_mapq:
             assert reweight_mapq_offset >= 0
             y_pred = pcor_to_mapq_np(_clamp_predictions(predictor.predict(x_train)))
-            predictor.fit(x_train, y_train, y_pred + reweight_mapq_offset)
+            predictor.fit(x_train, y_train, (y_pred + reweight_mapq_offset) * w)
 
     def _crossval_fit(self, mf_gen, x_train, y_train, dataset_shortname, use_oob=True, log=logging,
-                      reweight_ratio=1.0, reweight_mapq=False, reweight_mapq_offset=10.0):
+                      reweight_ratio=1.0, reweight_mapq=False, reweight_mapq_offset=10.0, n_jobs=1,
+                      w_train=None):
         """ Use cross validation to pick the best model from a
-            collection of possible models (model_family) """
+            collection of possible models (model_family).  All candidates
+            in the family's workset are scored at once, concurrently on
+            forked processes if n_jobs > 1, then consumed in the order a
+            one-at-a-time search would, so the result is the same. """
+        global _crossval_worker_score
+        global _crossval_worker_preds
+
         mf = mf_gen()
         self.model_fam_name = mf.name
         scores = []
@@ -212,18 +355,46 @@ class MapqFit:
             self._fit_and_possibly_reweight_and_refit(pred_, x_train, y_train,
                                                       reweight_ratio=reweight_ratio,
                                                       reweight_mapq=reweight_mapq,
-                                                      reweight_mapq_offset=reweight_mapq_offset)
+                                                      reweight_mapq_offset=reweight_mapq_offset,
+                                                      w_train=w_train)
             return pred_.oob_score_
 
         def _crossval_score(pred_):
-            scores_cv = cross_validation.cross_val_score(pred_, x_train, y_train)
+            if w_train is None:
+                scores_cv = cross_validation.cross_val_score(pred_, x_train, y_train)
+            else:
+                scores_cv = cross_validation.cross_val_score(pred_, x_train, y_train,
+                                                             fit_params={'sample_weight': w_train})
             return float(np.mean(scores_cv))
 
+        score_fn = _oob_score if use_oob else _crossval_score
+        ready = {}  # scores for workset candidates, by idxs
         while True:
-            params, pred = mf.next_predictor()
-            if pred is None:
+            # score everything in the workset not yet scored, then consume
+            # candidates in the same order as a one-at-a-time search would
+            pending = mf.pending_predictors(exclude=ready)
+            preds = [pred for _, _, pred in pending]
+            if n_jobs > 1 and len(pending) > 1:
+                # one process per candidate, each fitting on a single core
+                for pred in preds:
+                    if hasattr(pred, 'n_jobs'):
+                        pred.n_jobs = 1
+                _crossval_worker_score, _crossval_worker_preds = score_fn, preds
+                p = _fork_pool(min(n_jobs, len(pending)))
+                try:
+                    pending_scores = p.map(_crossval_worker, range(len(pending)))
+                finally:
+                    p.terminate()
+                    p.join()
+                    _crossval_worker_score, _crossval_worker_preds = None, None
+            else:
+                pending_scores = list(map(score_fn, preds))
+            for (idxs, _, _), score in zip(pending, pending_scores):
+                ready[idxs] = score
+            idxs, params = mf.next_params()
+            if idxs is None:
                 break
-            score = _oob_score(pred) if use_oob else _crossval_score(pred)
+            score = ready.pop(idxs)
             scores.append(score)
             better, much_better = mf.set_score(score)
             symbol = ''
@@ -240,125 +411,256 @@ class MapqFit:
 
     datasets = list(zip('dbcu', ['Discordant', 'Bad-end', 'Concordant', 'Unpaired'], [True, False, True, False]))
 
+    # Per-category results of fitting, keyed by category
+    _fit_result_attrs = ['trained_models', 'trained_params', 'model_score',
+                         'trained_shape', 'col_names', 'training_labs']
+
     def _fit(self, dfs, log=logging, frac=1.0, heap_profiler=None, include_mapq=False,
-             reweight_ratio=1.0, reweight_mapq=False, reweight_mapq_offset=10.0, no_oob=False):
+             reweight_ratio=1.0, reweight_mapq=False, reweight_mapq_offset=10.0, no_oob=False, n_jobs=1,
+             fit_processes=1, fit_memory_limit=None, train_memory_limit=None):
         """ Train one model per training table. Optionally subsample training
-            data first. """
-        for ds, ds_long, paired in self.datasets:
-            if ds not in dfs:
-                continue  # empty
+            data first.  If fit_processes > 1, categories are trained
+            concurrently in that many forked processes, subject to
+            fit_memory_limit.  If train_memory_limit is set, each category
+            is fit to a stratified sample of its table small enough to fit
+            in that many bytes. """
+        kwargs = {'log': log, 'frac': frac, 'heap_profiler': heap_profiler,
+                  'train_memory_limit': train_memory_limit,
+                  'reweight_ratio': reweight_ratio, 'reweight_mapq': reweight_mapq,
+                  'reweight_mapq_offset': reweight_mapq_offset, 'no_oob': no_oob, 'n_jobs': n_jobs}
+        todo = [(ds, ds_long) for ds, ds_long, paired in self.datasets if ds in dfs]
+        # sampling draws from the global RNG; give each category its own
+        # seed so results don't depend on whether categories are fit
+        # concurrently
+        seeds = dict((ds, random.randint(0, 2 ** 31 - 1)) for ds, _ in todo)
+        if fit_processes <= 1 or len(todo) <= 1:
+            for ds, ds_long in todo:
+                random.seed(seeds[ds])
+                self._fit_one(dfs, ds, ds_long, **kwargs)
+        else:
+            self._fit_concurrently(dfs, todo, seeds, fit_processes, fit_memory_limit, kwargs)
+
+    @staticmethod
+    def _bounded_training_table(dfs, ds, ds_long, mem_limit, log=logging):
+        """ Return the training table for ds, or a stratified sample of it
+            if the whole table won't fit in mem_limit bytes.  Besides the
+            sample, memory holds one chunk being merged into it plus a few
+            copies of the sample made while merging and converting it to a
+            matrix. """
+        nrow, ncol = dfs.shape(ds)
+        nrows_limit = mem_limit // (4 * 8 * ncol) - dfs.chunk_rows(ds)
+        if nrows_limit < 1:
+            raise RuntimeError('--train-memory-limit too small to hold a chunk of %s training '
+                               'records; lower --max-rows or raise the limit' % ds_long)
+        if nrow <= nrows_limit:
+            return pandas.concat([x for x in dfs.dataset_iter(ds)])
+        log.info('  %s training table has %d rows; sampling about %d to stay within %0.2fGB' %
+                 (ds_long, nrow, nrows_limit, mem_limit / (1024.0 * 1024.0 * 1024.0)))
+        return _stratified_sample(lambda: dfs.dataset_iter(ds), nrows_limit,
+                                  log=log, seed=random.randint(0, 2 ** 31 - 1))
+
+    def _fit_one(self, dfs, ds, ds_long, log=logging, frac=1.0, heap_profiler=None, train_memory_limit=None,
+                 reweight_ratio=1.0, reweight_mapq=False, reweight_mapq_offset=10.0, no_oob=False, n_jobs=1):
+        """ Train the model for one category """
+        if train_memory_limit is not None:
+            train = self._bounded_training_table(dfs, ds, ds_long, train_memory_limit, log=log)
+        else:
             train = pandas.concat([x for x in dfs.dataset_iter(ds)])
-            if train.shape[0] == 0:
-                continue  # empty
-            train.correct = train.correct.astype(int)
-            train.mapq = train.mapq.astype(int)
-            if train['correct'].nunique() == 1:
-                logging.warning('Warning: All training data has correct=%d.  This might mean '
-                                'the qtip software is making a mistake.  It could also '
-                                'mean that, because of your data and reference genome, the aligner '
-                                'can correctly resolve point of origin for all reads.  Treat '
-                                'results circumspectly.' % train['correct'][0])
-            # extract features, convert to matrix
-            x_train, _, mapq_orig_train, y_train, self.col_names[ds] = \
-                _df_to_mat(train, ds, True, self.training_labs, log=logging, include_mapq=False)
-            assert x_train.shape[0] == y_train.shape[0]
-            assert x_train.shape[1] > 0
-            # optionally subsample
-            if frac < 1.0:
-                log.info('  Sampling %0.2f%% of %d rows of %s records' % (100.0 * frac, train.shape[0], ds_long))
-                x_train, mapq_orig_train, y_train = \
-                    self._subsample(x_train, mapq_orig_train, y_train, frac)
-                log.info('  Now has %d rows' % x_train.shape[0])
-            # use cross-validation to pick a model
-            log.info('Fitting %d %s training records; %d features each' % (x_train.shape[0], ds_long, x_train.shape[1]))
-            assert x_train.shape[0] == y_train.shape[0]
-            self.trained_shape[ds] = x_train.shape
-            self.trained_models[ds], self.trained_params[ds], self.model_score[ds] = \
-                self._crossval_fit(self.model_gen, x_train, y_train, ds,
-                                   use_oob=self.model_gen().calculates_oob() and not no_oob)
-            log.info('    Chose parameters: %s' % str(self.trained_params[ds]))
-            self._fit_and_possibly_reweight_and_refit(self.trained_models[ds], x_train, y_train,
-                                                      reweight_ratio=reweight_ratio,
-                                                      reweight_mapq=reweight_mapq,
-                                                      reweight_mapq_offset=reweight_mapq_offset)
-            del x_train
-            del y_train
-            gc.collect()
-            log.info('    Done; peak mem usage so far = %0.2fGB' % _get_peak_gb())
-            if heap_profiler is not None:
-                print(heap_profiler.heap(), file=sys.stderr)
-
-    def predict(self, dfs, pred_prefix, assess_prefix,
+        if train.shape[0] == 0:
+            return  # empty
+        train.correct = train.correct.astype(int)
+        train.mapq = train.mapq.astype(int)
+        if train['correct'].nunique() == 1:
+            logging.warning('Warning: All training data has correct=%d.  This might mean '
+                            'the qtip software is making a mistake.  It could also '
+                            'mean that, because of your data and reference genome, the aligner '
+                            'can correctly resolve point of origin for all reads.  Treat '
+                            'results circumspectly.' % train['correct'][0])
+        # extract features, convert to matrix
+        x_train, _, mapq_orig_train, y_train, self.col_names[ds] = \
+            _df_to_mat(train, ds, True, self.training_labs, log=logging, include_mapq=False)
+        # rows of a de-duplicated table are weighted by # alignments
+        w_train = train['weight'].values.astype(np.float64) if 'weight' in train else None
+        if w_train is not None and (w_train == 1).all():
+            w_train = None  # nothing collapsed; fit as usual
+        assert x_train.shape[0] == y_train.shape[0]
+        assert x_train.shape[1] > 0
+        # optionally subsample
+        if frac < 1.0:
+            log.info('  Sampling %0.2f%% of %d rows of %s records' % (100.0 * frac, train.shape[0], ds_long))
+            x_train, mapq_orig_train, y_train, w_train = \
+                self._subsample(x_train, mapq_orig_train, y_train, frac, w_train)
+            log.info('  Now has %d rows' % x_train.shape[0])
+        # use cross-validation to pick a model
+        log.info('Fitting %d %s training records; %d features each' % (x_train.shape[0], ds_long, x_train.shape[1]))
+        if w_train is not None:
+            log.info('  Rows are distinct records standing for %d alignments' % int(w_train.sum()))
+        assert x_train.shape[0] == y_train.shape[0]
+        self.trained_shape[ds] = x_train.shape
+        self.trained_models[ds], self.trained_params[ds], self.model_score[ds] = \
+            self._crossval_fit(self.model_gen, x_train, y_train, ds,
+                               use_oob=self.model_gen().calculates_oob() and not no_oob,
+                               n_jobs=n_jobs, w_train=w_train)
+        log.info('    Chose parameters: %s' % str(self.trained_params[ds]))
+        self._fit_and_possibly_reweight_and_refit(self.trained_models[ds], x_train, y_train,
+                                                  reweight_ratio=reweight_ratio,
+                                                  reweight_mapq=reweight_mapq,
+                                                  reweight_mapq_offset=reweight_mapq_offset,
+                                                  w_train=w_train)
+        del x_train
+        del y_train
+        gc.collect()
+        log.info('    Done; peak mem usage so far = %0.2fGB' % _get_peak_gb())
+        if heap_profiler is not None:
+            print(heap_profiler.heap(), file=sys.stderr)
+
+    def _fit_one_in_child(self, conn, seed, dfs, ds, ds_long, kwargs):
+        """ Body of a forked fitting process; sends the results for category
+            ds, or a traceback, back through conn. """
+        try:
+            random.seed(seed)
+            self._fit_one(dfs, ds, ds_long, **kwargs)
+            res = dict((attr, getattr(self, attr).get(ds)) for attr in self._fit_result_attrs)
+            res['model_fam_name'] = self.model_fam_name
+            conn.send((True, res))
+        except BaseException:
+            conn.send((False, traceback.format_exc()))
+        finally:
+            conn.close()
+
+    def _fit_concurrently(self, dfs, todo, seeds, nprocs, mem_limit, kwargs):
+        """ Fit categories in forked processes, at most nprocs at a time.
+            Biggest categories are started first, and a category isn't
+            started while others are running if its estimated memory
+            footprint would push the total over mem_limit bytes. """
+        log = kwargs['log']
+        if mem_limit is None:
+            mem_limit = _physical_memory_bytes() // 2
+        kwargs = dict(kwargs, n_jobs=max(1, kwargs['n_jobs'] // min(nprocs, len(todo))))
+        ctx = multiprocessing.get_context('fork') if hasattr(multiprocessing, 'get_context') else multiprocessing
+
+        def _estimated_bytes(ds_):
+            est = dfs.estimated_bytes(ds_)
+            if kwargs['train_memory_limit'] is not None:
+                est = min(est, kwargs['train_memory_limit'])
+            return est
+
+        pending = sorted(todo, key=lambda x: -_estimated_bytes(x[0]))
+        running = []  # (ds, process, connection, estimated bytes)
+        results = {}
+        try:
+            while len(pending) > 0 or len(running) > 0:
+                mem_used = sum(r[3] for r in running)
+                for ds, ds_long in list(pending):
+                    est = _estimated_bytes(ds)
+                    if len(running) >= nprocs:
+                        break
+                    if len(running) > 0 and mem_used + est > mem_limit:
+                        continue
+                    log.info('  Fitting %s model in a separate process (est. %0.2fGB)' %
+                             (ds_long, est / (1024.0 * 1024.0 * 1024.0)))
+                    parent_conn, child_conn = ctx.Pipe(duplex=False)
+                    proc = ctx.Process(target=self._fit_one_in_child,
+                                       args=(child_conn, seeds[ds], dfs, ds, ds_long, kwargs))
+                    proc.start()
+                    child_conn.close()
+                    running.append((ds, proc, parent_conn, est))
+                    pending.remove((ds, ds_long))
+                    mem_used += est
+                # wait for a fit to finish
+                finished = None
+                while finished is None:
+                    for r in running:
+                        if r[2].poll(0.1):
+                            finished = r
+                            break
+                ds, proc, conn, _ = finished
+                try:
+                    ok, res = conn.recv()
+                except EOFError:
+                    ok, res = False, 'process exited with code %s' % str(proc.exitcode)
+                proc.join()
+                running.remove(finished)
+                if not ok:
+                    raise RuntimeError('Fitting %s model failed: %s' % (ds, res))
+                results[ds] = res
+        finally:
+            for _, proc, _, _ in running:
+                proc.terminate()
+                proc.join()
+        # collect results in the usual category order
+        for ds, _ in todo:
+            res = results[ds]
+            for attr in self._fit_result_attrs:
+                if res[attr] is not None:
+                    getattr(self, attr)[ds] = res[attr]
+            if res['model_fam_name'] is not None:
+                self.model_fam_name = res['model_fam_name']
+
+    def predict(self, dfs, pred_prefix,
                 log=logging, dedup=False, training=False, calc_summaries=False,
-                prediction_mem_limit=10000000, heap_profiler=None, include_mapq=False,
-                multiprocess=False, n_multi=8):
+                heap_profiler=None, include_mapq=False,
+                multiprocess=False, n_multi=8, quantize=False):
+        """ Make predictions for every alignment in dfs and write them to
+            files with the given prefix.  MAPQs go in a store indexed by
+            alignment id, so chunks can be stored in any order.  If
+            multiprocess is set, chunks are predicted on n_multi forked
+            worker processes, which store MAPQs themselves, with at most
+            2 * n_multi chunks in flight at once.  If quantize is set, MAPQs
+            are stored to the nearest 0.001 in 2 bytes each. """
 
         global _prediction_worker_trained_models
-        global _prediction_worker_pred_overall
+        global _prediction_worker_dfs
         global _prediction_worker_log
+        global _prediction_worker_store
 
         name = '_'.join(['overall', 'training' if training else 'test'])
-        pred_overall = MapqPredictions(name, pred_prefix, assess_prefix,
+        pred_overall = MapqPredictions(name, pred_prefix,
                                        calc_summaries=calc_summaries,
-                                       prediction_mem_limit=prediction_mem_limit)
+                                       nlines=dfs.max_id() + 1, quantize=quantize)
         log.info('  Created overall MapqPredictions (peak mem=%0.2fGB)' % _get_peak_gb())
 
         _prediction_worker_trained_models = self.trained_models
-        _prediction_worker_pred_overall = pred_overall
+        _prediction_worker_dfs = dfs
         _prediction_worker_log = log
+        _prediction_worker_store = pred_overall.mapq_store
 
         p = None
         if multiprocess:
-            assert n_multi is None or n_multi > 0
-            p = multiprocessing.Pool(n_multi, _prediction_worker_init, (log,))
-
-        for ds, ds_long, paired in self.datasets:  # outer loop over alignment types
-            if ds not in dfs:
-                continue
-
-            if multiprocess:
-                try:
-                    nexti = 0
-                    jobs = {}
-                    r = itertools.repeat
-
-                    def _handle(recs, first_id, last_id, mapq, mapq_orig, correct):
-                        # first_id, last_id, mapq=None, mapq_orig=None, correct=None
-                        pred_overall.add(recs, first_id, last_id, mapq, mapq_orig, correct)
-
-                    for tup in p.imap_unordered(_prediction_worker_star,
-                                       zip(enumerate(dfs.dataset_iter(ds)),
-                                           r(training),
-                                           r(self.training_labs),
-                                           r(ds),
-                                           r(ds_long),
-                                           r(dedup),
-                                           r(True),
-                                           r(include_mapq))):
-                        i, recs, first_id, last_id, mapq, mapq_orig, correct = tup
-                        if i == nexti:
-                            _handle(recs, first_id, last_id, mapq, mapq_orig, correct)
-                            nexti += 1
-                            while nexti in jobs:
-                                i, recs, first_id, last_id, mapq, mapq_orig, correct = jobs[nexti]
-                                _handle(recs, first_id, last_id, mapq, mapq_orig, correct)
-                                del jobs[nexti]
-                                nexti += 1
-                                gc.collect()
-                        else:
-                            jobs[i] = tup
-
-                    assert len(jobs) == 0
-
-                except KeyboardInterrupt:
-                    p.terminate()
-                    p.join()
-                    raise
-            else:
-                for test_chunk in enumerate(dfs.dataset_iter(ds)):
-                    _prediction_worker(test_chunk, training, self.training_labs,
-                                       ds, ds_long, dedup,
-                                       multiprocess=False, include_mapq=include_mapq)
+            assert n_multi > 0
+            p = _fork_pool(n_multi, _prediction_worker_init)
+
+        try:
+            for ds, ds_long, paired in self.datasets:  # outer loop over alignment types
+                if ds not in dfs:
+                    continue
+
+                args = (training, self.training_labs, ds, ds_long, dedup, include_mapq)
+                if dfs.weighted(ds):
+                    self._predict_weighted(dfs, ds, ds_long, args, p, pred_overall, log=log)
+                elif multiprocess:
+                    # results are retrieved in submission order, and no more
+                    # chunks are submitted while the window is full
+                    window = collections.deque()
+                    for test_chunk in enumerate(dfs.dataset_chunk_bounds(ds)):
+                        if len(window) >= 2 * n_multi:
+                            _add_predictions(pred_overall, window.popleft().get()[1], stored=True)
+                        window.append(p.apply_async(_prediction_worker, (test_chunk,) + args))
+                    while len(window) > 0:
+                        _add_predictions(pred_overall, window.popleft().get()[1], stored=True)
+                else:
+                    for test_chunk in enumerate(dfs.dataset_chunk_bounds(ds)):
+                        _add_predictions(pred_overall, _prediction_worker(test_chunk, *args)[1], stored=True)
+        except BaseException:
+            if p is not None:
+                p.terminate()
+                p.join()
+            raise
+
+        if p is not None:
+            p.close()
+            p.join()
+        _prediction_worker_store = None
 
         log.info('Finalizing results for overall %s data (%d alignments)' %
                  ('training' if training else 'test', pred_overall.npredictions))
@@ -367,6 +669,31 @@ class MapqFit:
 
         return pred_overall
 
+    @staticmethod
+    def _predict_weighted(dfs, ds, ds_long, args, p, pred_overall, log=logging):
+        """ Make predictions for a de-duplicated table: predict once per
+            distinct row, on pool p if given, then add predictions for every
+            alignment by looking up its row in the id map.  Alignments are
+            post-processed in chunks the size of the table's chunks, in
+            alignment order, as they would be by _prediction_worker for a
+            table that isn't de-duplicated. """
+        nrow, _ = dfs.shape(ds)
+        idmap = dfs.idmap(ds)
+        log.info('  Predicting for %d distinct %s rows standing for %d alignments' % (nrow, ds_long, len(idmap)))
+        chunks = list(enumerate(dfs.dataset_chunk_bounds(ds)))
+        if p is not None:
+            results = [p.apply_async(_pcor_worker, (chunk,) + args) for chunk in chunks]
+            pcors = [r.get()[1] for r in results]
+        else:
+            pcors = [_pcor_worker(chunk, *args)[1] for chunk in chunks]
+        pcor = np.concatenate(pcors).astype(np.float64, copy=False)
+        for row_i, row_f in dfs.idmap_chunk_bounds(ds):
+            rows = np.asarray(idmap['row'][row_i:row_f])
+            chunk_pcor = postprocess_predictions(pcor[rows], ds_long, inplace=True)
+            other = dfs.dataset_rows_at(ds, rows, ['mapq', 'correct']).astype(int)
+            _add_predictions(pred_overall, _pred_df(chunk_pcor, np.asarray(idmap['id'][row_i:row_f]),
+                                                    other[:, 0], other[:, 1], ds))
+
     def write_feature_importances(self, prefix):
         """
         Write feature importances for each model to an appropriately-named
@@ -413,8 +740,88 @@ class MapqFit:
                     data.extend(['NA', '0', '0', '0'])
             fh.write(','.join(data) + '\n')
 
+    _forest_magic = b'QTIPFOR1'
+
+    def export_forests(self, fn):
+        """
+        Write the trained models to file fn in the flat-array format that
+        qtip-rewrite evaluates directly (see src/forest.h).  Only tree
+        ensembles can be exported: random forests and extra trees, whose
+        trees are averaged, and gradient boosting, whose trees are scaled by
+        the learning rate and added to the initial estimate.
+        """
+        from sklearn.ensemble import RandomForestRegressor, ExtraTreesRegressor, GradientBoostingRegressor
+        with open(fn, 'wb') as fh:
+            fh.write(self._forest_magic)
+            fh.write(struct.pack('<I', len(self.trained_models)))
+            for ds, model in sorted(self.trained_models.items()):
+                labs = self.training_labs[ds]
+                if isinstance(model, (RandomForestRegressor, ExtraTreesRegressor)):
+                    kind, base, scale, trees = 0, 0.0, 1.0, model.estimators_
+                elif isinstance(model, GradientBoostingRegressor):
+                    kind, scale, trees = 1, model.learning_rate, model.estimators_[:, 0]
+                    base = 0.0 if model.init_ == 'zero' else \
+                        float(np.ravel(model.init_.predict(np.zeros((1, len(labs)))))[0])
+                else:
+                    raise RuntimeError('Cannot export model of type %s' % type(model).__name__)
+                fh.write(struct.pack('<III', ord(ds), kind, len(labs)))
+                for lab in labs:
+                    lab = lab.encode()
+                    fh.write(struct.pack('<I', len(lab)) + lab)
+                fh.write(struct.pack('<ddI', base, scale, len(trees)))
+                for tree in trees:
+                    t = tree.tree_
+                    fh.write(struct.pack('<I', t.node_count))
+                    for arr, dtype in [(t.feature, '<i4'), (t.threshold, '<f8'),
+                                       (t.children_left, '<i4'), (t.children_right, '<i4'),
+                                       (t.value[:, 0, 0], '<f8')]:
+                        fh.write(np.ascontiguousarray(arr, dtype=dtype).tobytes())
+
+    _model_version = 1
+    _model_fn = 'model.pkl'
+
+    def save(self, dr):
+        """
+        Serialize the trained models, along with the feature columns and
+        hyperparameters chosen for each alignment category, to directory dr.
+        """
+        if not os.path.exists(dr):
+            os.makedirs(dr)
+        state = {'version': self._model_version,
+                 'trained_models': self.trained_models,
+                 'col_names': self.col_names,
+                 'trained_params': self.trained_params,
+                 'model_score': self.model_score,
+                 'trained_shape': self.trained_shape,
+                 'training_labs': self.training_labs,
+                 'model_fam_name': self.model_fam_name,
+                 'sample_fraction': self.sample_fraction}
+        with open(os.path.join(dr, self._model_fn), 'wb') as fh:
+            pickle.dump(state, fh, pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, dr, log=logging):
+        """
+        Return a MapqFit with models previously written to directory dr by
+        save().  No fitting is done.
+        """
+        fn = os.path.join(dr, cls._model_fn)
+        if not os.path.exists(fn):
+            raise RuntimeError('No saved model at "%s"' % fn)
+        with open(fn, 'rb') as fh:
+            state = pickle.load(fh)
+        if state.get('version') != cls._model_version:
+            raise RuntimeError('Saved model at "%s" has version %s; expected %d' %
+                               (fn, str(state.get('version')), cls._model_version))
+        fit = cls(None, None, log=log, sample_fraction=state['sample_fraction'])
+        for k in ['trained_models', 'col_names', 'trained_params', 'model_score',
+                  'trained_shape', 'training_labs', 'model_fam_name']:
+            setattr(fit, k, state[k])
+        log.info('Loaded models for categories %s from "%s"' % (','.join(sorted(fit.trained_models.keys())), fn))
+        return fit
+
     def __init__(self,
-                 dfs,  # dictionary of data frames, one per alignment type
+                 dfs,  # dictionary of data frames, one per alignment type; None -> don't fit
                  model_gen,  # function that takes vector of hyperparameters, returns new model object
                  log=logging,
                  sample_fraction=1.0,  # fraction of training data to actually use
@@ -423,7 +830,11 @@ class MapqFit:
                  reweight_ratio=1.0,
                  reweight_mapq=False,
                  reweight_mapq_offset=10.0,
-                 no_oob=False):
+                 no_oob=False,
+                 n_jobs=1,  # number of processes for hyperparameter search
+                 fit_processes=1,  # number of categories to fit at once
+                 fit_memory_limit=None,  # bytes; limits concurrent fits
+                 train_memory_limit=None):  # bytes; fit to sample if exceeded
         self.model_gen = model_gen
         self.trained_models = {}
         self.crossval_std = {}
@@ -435,6 +846,10 @@ class MapqFit:
         self.model_fam_name = None
         self.sample_fraction = sample_fraction
         self.q = None
+        if dfs is None:
+            return  # caller fills in trained models, e.g. load()
         self._fit(dfs, log=log, frac=sample_fraction, heap_profiler=heap_profiler, include_mapq=include_mapq,
                   reweight_ratio=reweight_ratio, reweight_mapq=reweight_mapq,
-                  reweight_mapq_offset=reweight_mapq_offset, no_oob=no_oob)
+                  reweight_mapq_offset=reweight_mapq_offset, no_oob=no_oob, n_jobs=n_jobs,
+                  fit_processes=fit_processes, fit_memory_limit=fit_memory_limit,
+                  train_memory_limit=train_memory_limit)
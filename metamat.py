@@ -9,14 +9,31 @@ class MetaMat(object):
     """
     Iterator that returns a large matrix of floats in chunks of rows, where the
     number of rows in a chunk is a parameter passed to the constructor.
-    Assumes all elements are double-precision 8-byte floating-point numbers.
+
+    The matrix is stored in one of two layouts, as given by the .meta file.
+    In the legacy layout, all elements are double-precision 8-byte
+    floating-point numbers in row-major order.  If mmap is true, the matrix
+    is mapped into memory (copy-on-write) and chunks are views of the
+    mapping rather than copies.  In the columnar layout, as written by
+    qtip-parse, rows are stored in groups of a fixed number of rows, and
+    within a group each column is stored contiguously with its own type.
+    Columnar files are always mapped, and individual columns can be read
+    without touching the others.  Either way, chunks are returned as
+    doubles.
+
+    The .meta file of a columnar matrix may also give the minimum, maximum
+    and number of NaNs in each column, in which case they are available as
+    col_min, col_max and col_nans.  Otherwise these are None.
     """
 
-    def __init__(self, prefix, chunk_size=1000000):
+    def __init__(self, prefix, chunk_size=1000000, mmap=False):
         """ Parse metadata, check that files exist and initialize members """
         self.prefix = prefix
         self.chunk_size = chunk_size
         self.fh = None
+        self.mat = None
+        self.columnar = False
+        self.col_min, self.col_max, self.col_nans = None, None, None
         self.cur = 0
         self.done = False
 
@@ -32,9 +49,47 @@ class MetaMat(object):
             fields = fh.readline().rstrip().split(',')
             self.nrow = int(fields[-1])
             self.cols = fields[:-1]
+            for ln in fh:
+                fields = ln.rstrip().split(',')
+                if fields[0] == 'format' and fields[1] == 'columnar':
+                    self.columnar = True
+                    self.group_rows = int(fields[2])
+                elif fields[0] == 'types':
+                    self.dtypes = [numpy.dtype(x) for x in fields[1:]]
+                elif fields[0] == 'min':
+                    self.col_min = numpy.array(fields[1:], dtype=numpy.float64)
+                elif fields[0] == 'max':
+                    self.col_max = numpy.array(fields[1:], dtype=numpy.float64)
+                elif fields[0] == 'nans':
+                    self.col_nans = numpy.array(fields[1:], dtype=numpy.int64)
 
-        # Start at first chunk
-        self.fh = open(self.data_fn, 'rb')
+        if self.columnar:
+            if len(self.dtypes) != len(self.cols):
+                raise RuntimeError('Metadata file "%s" has %d types for %d columns' %
+                                   (meta_fn, len(self.dtypes), len(self.cols)))
+            for stat in [self.col_min, self.col_max, self.col_nans]:
+                if stat is not None and len(stat) != len(self.cols):
+                    raise RuntimeError('Metadata file "%s" has %d statistics for %d columns' %
+                                       (meta_fn, len(stat), len(self.cols)))
+            # offset of each column within a row group, in units of rows
+            self.col_offsets = numpy.cumsum([0] + [dt.itemsize for dt in self.dtypes])
+            expected_size = self.nrow * self.col_offsets[-1]
+        else:
+            expected_size = self.nrow * 8 * len(self.cols)
+        if self.columnar or mmap:
+            if os.stat(self.data_fn).st_size < expected_size:
+                raise RuntimeError('Data file "%s" is smaller than its metadata says' % self.data_fn)
+            if self.columnar:
+                self.mat = numpy.memmap(self.data_fn, dtype=numpy.uint8, mode='r', shape=(expected_size,)) \
+                    if expected_size > 0 else numpy.empty(0, dtype=numpy.uint8)
+            elif expected_size == 0:
+                self.mat = numpy.empty((self.nrow, len(self.cols)), dtype=numpy.float64)
+            else:
+                self.mat = numpy.memmap(self.data_fn, dtype=numpy.float64, mode='c',
+                                        shape=(self.nrow, len(self.cols)))
+        else:
+            # Start at first chunk
+            self.fh = open(self.data_fn, 'rb')
         self.cur = 0
         self.done = False
 
@@ -45,9 +100,19 @@ class MetaMat(object):
         return self.__next__()
 
     def __next__(self):
-        """ Return next chunk """
+        """ Return next chunk as a data frame """
+        return pandas.DataFrame(data=self.next_array(), columns=self.cols, copy=False)
+
+    def col_index(self, col):
+        """ Return index of the column with the given name """
+        return self.cols.index(col)
+
+    def next_array(self):
+        """ Return next chunk as a numpy array with one column per column
+            of the matrix """
         if self.done:
-            self.fh.close()
+            if self.fh is not None:
+                self.fh.close()
             raise StopIteration
         if self.chunk_size > 0:
             row_i, row_f = self.cur, min(self.cur + self.chunk_size, self.nrow)
@@ -56,19 +121,93 @@ class MetaMat(object):
             row_i, row_f = 0, self.nrow
         self.done = row_f == self.nrow
         self.cur = row_f
-        nelt = (row_f - row_i) * len(self.cols)
-        assert self.fh.tell() == row_i * 8 * len(self.cols)
-        m = numpy.fromfile(self.fh, dtype=numpy.float64, count=nelt, sep='')
-        expected_pos = row_f * 8 * len(self.cols)
-        assert self.fh.tell() == expected_pos
-        assert m.size == nelt, (row_i, row_f, len(self.cols), m.size, nelt)
-        m = m.reshape((row_f - row_i, len(self.cols)))
-        return pandas.DataFrame(data=m, columns=self.cols)
+        return self.rows(row_i, row_f)
+
+    def column(self, col, row_i, row_f):
+        """ Return rows [row_i, row_f) of the named column of a columnar
+            matrix, with the column's own type.  This is a view of the
+            mapping if the rows are all in one row group. """
+        assert self.columnar
+        j = self.col_index(col)
+        dt, grp = self.dtypes[j], self.group_rows
+        pieces = []
+        row = row_i
+        while row < row_f:
+            g = row // grp
+            g_nrow = min(grp, self.nrow - g * grp)
+            start = g * grp * self.col_offsets[-1] + g_nrow * self.col_offsets[j]
+            lo, hi = row - g * grp, min(row_f - g * grp, g_nrow)
+            pieces.append(self.mat[start + lo * dt.itemsize:start + hi * dt.itemsize].view(dt))
+            row = g * grp + hi
+        if len(pieces) == 1:
+            return pieces[0]
+        return numpy.concatenate(pieces) if len(pieces) > 0 else numpy.empty(0, dtype=dt)
+
+    def rows(self, row_i, row_f, cols=None):
+        """ Return rows [row_i, row_f) as a numpy array of doubles, either
+            with all columns or just the named ones.  When the legacy layout
+            is mapped and all columns are requested, this is a view, and
+            rows can be requested in any order. """
+        if self.columnar:
+            cols = self.cols if cols is None else cols
+            m = numpy.empty((row_f - row_i, len(cols)), dtype=numpy.float64)
+            for j, col in enumerate(cols):
+                m[:, j] = self.column(col, row_i, row_f)
+            return m
+        if self.mat is not None:
+            m = self.mat[row_i:row_f]
+        else:
+            nelt = (row_f - row_i) * len(self.cols)
+            assert self.fh.tell() == row_i * 8 * len(self.cols)
+            m = numpy.fromfile(self.fh, dtype=numpy.float64, count=nelt, sep='')
+            expected_pos = row_f * 8 * len(self.cols)
+            assert self.fh.tell() == expected_pos
+            assert m.size == nelt, (row_i, row_f, len(self.cols), m.size, nelt)
+            m = m.reshape((row_f - row_i, len(self.cols)))
+        if cols is not None:
+            m = m[:, [self.col_index(col) for col in cols]]
+        return m
+
+    def take(self, rows, cols=None):
+        """ Return the rows with the given indexes, in the given order, as a
+            numpy array of doubles, either with all columns or just the
+            named ones.  Only those rows are read from the mapping. """
+        rows = numpy.asarray(rows, dtype=numpy.int64)
+        cols = self.cols if cols is None else cols
+        if not self.columnar:
+            assert self.mat is not None
+            return self.mat[rows][:, [self.col_index(col) for col in cols]]
+        grp = self.group_rows
+        g = rows // grp
+        g_nrow = numpy.minimum(grp, self.nrow - g * grp)
+        m = numpy.empty((len(rows), len(cols)), dtype=numpy.float64)
+        for j, col in enumerate(cols):
+            k = self.col_index(col)
+            dt = self.dtypes[k]
+            start = g * grp * self.col_offsets[-1] + g_nrow * self.col_offsets[k] + (rows - g * grp) * dt.itemsize
+            m[:, j] = self.mat[start[:, None] + numpy.arange(dt.itemsize)].view(dt).ravel()
+        return m
+
+    def arrays(self):
+        """ Return iterator over chunks as numpy arrays, from the start """
+        self.reset()
+        while True:
+            try:
+                yield self.next_array()
+            except StopIteration:
+                return
+
+    def chunk_bounds(self):
+        """ Return list of (first row, last row + 1) for each chunk """
+        if self.chunk_size <= 0:
+            return [(0, self.nrow)]
+        return [(i, min(i + self.chunk_size, self.nrow)) for i in range(0, self.nrow, self.chunk_size)]
 
     def reset(self):
-        if self.fh is not None:
-            self.fh.close()
-        self.fh = open(self.data_fn, 'rb')
+        if self.mat is None:
+            if self.fh is not None:
+                self.fh.close()
+            self.fh = open(self.data_fn, 'rb')
         self.cur = 0
         self.done = False
 
@@ -96,6 +235,28 @@ if __name__ == "__main__":
     import struct
 
 
+    def write_columnar(prefix, col_names, dtypes, m, group_rows=65536, stats=True):
+        """ Write numpy matrix m in the columnar layout, with the given
+            column names and numpy type names, and optionally with column
+            statistics, the way qtip-parse writes feature tables. """
+        with open(prefix + '.meta', 'w') as ofh:
+            ofh.write(','.join(col_names + [str(m.shape[0])]) + '\n')
+            ofh.write('format,columnar,%d\n' % group_rows)
+            ofh.write(','.join(['types'] + list(dtypes)) + '\n')
+            if stats:
+                typed = [m[:, j].astype(dt).astype(numpy.float64) for j, dt in enumerate(dtypes)]
+                nans = [int(numpy.isnan(col).sum()) for col in typed]
+                for nm, fn in [('min', numpy.min), ('max', numpy.max)]:
+                    vals = [repr(float(fn(col[~numpy.isnan(col)]))) if nnan < len(col) else 'nan'
+                            for col, nnan in zip(typed, nans)]
+                    ofh.write(','.join([nm] + vals) + '\n')
+                ofh.write(','.join(['nans'] + list(map(str, nans))) + '\n')
+        with open(prefix + '.npy', 'wb') as ofh:
+            for i in range(0, m.shape[0], group_rows):
+                for j, dt in enumerate(dtypes):
+                    m[i:i+group_rows, j].astype(dt).tofile(ofh)
+
+
     class TestCases(unittest.TestCase):
 
         def setUp(self):
@@ -172,6 +333,62 @@ if __name__ == "__main__":
             except StopIteration:
                 pass
 
+        def test_mmap(self):
+            for prefix in self.prefixes:
+                for chunk_size in [1, 7, 13, 1000, -1]:
+                    m1 = MetaMat(prefix, chunk_size)
+                    m2 = MetaMat(prefix, chunk_size, mmap=True)
+                    n = 0
+                    for df1, df2 in zip(m1, m2):
+                        self.assertTrue(df1.equals(df2))
+                        n += df2.shape[0]
+                    self.assertEqual(m2.nrow, n)
+                    arrs = list(m2.arrays())
+                    self.assertEqual(len(m2.chunk_bounds()), len(arrs))
+                    for (row_i, row_f), arr in zip(m2.chunk_bounds(), arrs):
+                        self.assertEqual(row_f - row_i, arr.shape[0])
+                        self.assertTrue((m2.rows(row_i, row_f) == arr).all())
+                    if m2.nrow > 3:
+                        rows = [3, 0, m2.nrow - 1]
+                        self.assertTrue((m2.rows(0, m2.nrow)[rows] == m2.take(rows)).all())
+            m = MetaMat(self.prefixes[1], 10, mmap=True)
+            self.assertEqual(2, m.col_index('charlie'))
+            self.assertAlmostEqual(self.float_list[7 * 5 + 2], m.rows(5, 6)[0, 2], places=3)
+
+        def test_columnar(self):
+            prefix = '.testmat_c'
+            self.prefixes.append(prefix)
+            n_row = 1000
+            m = numpy.zeros((n_row, 4))
+            m[:, 0] = numpy.arange(n_row) + 10 ** 12
+            m[:, 1] = numpy.arange(n_row) % 300
+            m[:, 2] = numpy.arange(n_row) / 8.0
+            m[::7, 2] = numpy.nan
+            m[:, 3] = numpy.arange(n_row) % 3 - 1
+            write_columnar(prefix, ['id', 'len', 'ztz0', 'correct'],
+                           ['<u8', '<i4', '<f4', '<i1'], m, group_rows=64)
+            self.assertEqual(n_row * 17, os.stat(prefix + '.npy').st_size)
+            for chunk_size in [1, 13, 64, 100, -1]:
+                mm = MetaMat(prefix, chunk_size)
+                df = pandas.concat(list(mm))
+                self.assertEqual(n_row, df.shape[0])
+                self.assertTrue(numpy.array_equal(m, df.values, equal_nan=True))
+            mm = MetaMat(prefix, 100)
+            self.assertEqual(numpy.dtype('<i1'), mm.column('correct', 0, 10).dtype)
+            self.assertTrue((m[60:70, 1] == mm.column('len', 60, 70)).all())
+            self.assertTrue((m[5:200, [3, 0]] == mm.rows(5, 200, ['correct', 'id'])).all())
+            rows = [999, 0, 64, 63, 500, 64]
+            self.assertTrue(numpy.array_equal(m[rows], mm.take(rows), equal_nan=True))
+            self.assertTrue((m[rows][:, [1, 3]] == mm.take(rows, ['len', 'correct'])).all())
+            self.assertEqual((0, 4), mm.take([]).shape)
+            self.assertEqual([0, 0, (n_row + 6) // 7, 0], list(mm.col_nans))
+            self.assertEqual(10 ** 12 + n_row - 1, mm.col_max[0])
+            self.assertEqual(-1, mm.col_min[3])
+            self.assertEqual(299, mm.col_max[1])
+            write_columnar(prefix, ['id', 'len', 'ztz0', 'correct'],
+                           ['<u8', '<i4', '<f4', '<i1'], m, stats=False)
+            self.assertIsNone(MetaMat(prefix).col_nans)
+
         def tearDown(self):
             for prefix in self.prefixes:
                 os.remove(prefix + '.meta')
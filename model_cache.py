@@ -0,0 +1,298 @@
+"""
+Copyright 2016, Ben Langmead <langmea@cs.jhu.edu>
+
+ModelCache class for storing trained MAPQ models in a size-bounded directory
+and looking them up by reference, aligner and input-model fingerprint.
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+from os.path import join, getsize, exists
+
+
+def read_fingerprint(fn):
+    """
+    Parse a fingerprint file written by qtip-parse (mode i) into a dict
+    mapping category (u, b, c, d) to a dict of its statistics.
+    """
+    fp = {}
+    with open(fn) as fh:
+        cols = fh.readline().rstrip().split(',')
+        for ln in fh:
+            toks = ln.rstrip().split(',')
+            if len(toks) != len(cols):
+                continue
+            fp[toks[0]] = dict((k, float(v)) for k, v in zip(cols[1:], toks[1:]))
+    return fp
+
+
+_fingerprint_stats = ['len_mean', 'len_sd', 'score_mean', 'score_sd', 'fraglen_mean', 'fraglen_sd']
+
+
+def fingerprint_distance(fp1, fp2):
+    """
+    Return the largest relative difference between corresponding statistics
+    of two fingerprints, or None if they don't cover the same categories.
+    Standard deviations are compared relative to the corresponding mean so
+    that near-zero spreads don't dominate.
+    """
+    cats1 = set(c for c, st in fp1.items() if st['ntemplates'] > 0)
+    cats2 = set(c for c, st in fp2.items() if st['ntemplates'] > 0)
+    if cats1 != cats2:
+        return None
+    dist = 0.0
+    for cat in cats1:
+        for stat in _fingerprint_stats:
+            a, b = fp1[cat][stat], fp2[cat][stat]
+            scale_stat = stat.replace('_sd', '_mean')
+            scale = max(abs(fp1[cat][scale_stat]), abs(fp2[cat][scale_stat]), 1.0)
+            dist = max(dist, abs(a - b) / scale)
+    return dist
+
+
+def _recursive_size(dr):
+    tot = 0
+    for root, dirs, files in os.walk(dr):
+        tot += sum(getsize(join(root, name)) for name in files)
+    return tot
+
+
+class ModelCache(object):
+    """
+    Directory of saved MapqFit models.  Models are grouped under a key that
+    hashes the reference FASTA contents together with the aligner name and
+    arguments.  Within a key, a model applies to a new input if the input's
+    fingerprint is within a tolerance of the fingerprint it was trained on.
+    When the cache grows beyond its size limit, least-recently-used entries
+    are removed.
+    """
+
+    _ref_memo_fn = 'references.json'
+    _entry_fn = 'entry.json'
+
+    # Aligner thread-count options, which take a value and don't affect the
+    # alignments.  As in the driver, -t is the thread option only for
+    # bwa-mem and snap; for Bowtie 2 and HISAT2 it's the value-less --time
+    _thread_opts = {'bwa-mem': {'-t'}, 'snap': {'-t'}}
+    _default_thread_opts = {'-p', '--threads'}
+
+    def __init__(self, dr, max_bytes, tolerance=0.05, log=logging):
+        self.dir = dr
+        self.max_bytes = max_bytes
+        self.tolerance = tolerance
+        self.log = log
+        if not exists(dr):
+            os.makedirs(dr)
+
+    def _reference_digest(self, fn):
+        """
+        Return SHA-1 of the contents of FASTA file fn.  Digests are memoized
+        by absolute path, size and modification time, since hashing a large
+        genome takes a while.
+        """
+        memo_fn = join(self.dir, self._ref_memo_fn)
+        memo = {}
+        if exists(memo_fn):
+            with open(memo_fn) as fh:
+                memo = json.load(fh)
+        path = os.path.abspath(fn)
+        st = os.stat(path)
+        ent = memo.get(path)
+        if ent is not None and ent['size'] == st.st_size and ent['mtime'] == st.st_mtime:
+            return ent['sha1']
+        h = hashlib.sha1()
+        with open(path, 'rb') as fh:
+            while True:
+                buf = fh.read(1024 * 1024)
+                if len(buf) == 0:
+                    break
+                h.update(buf)
+        memo[path] = {'size': st.st_size, 'mtime': st.st_mtime, 'sha1': h.hexdigest()}
+        tmp_fn = memo_fn + '.%d' % os.getpid()
+        with open(tmp_fn, 'w') as fh:
+            json.dump(memo, fh)
+        os.rename(tmp_fn, memo_fn)
+        return memo[path]['sha1']
+
+    def key(self, ref_fns, aligner, aligner_args):
+        """
+        Return cache key for the given reference FASTA files, aligner name and
+        list of aligner arguments.
+        """
+        h = hashlib.sha1()
+        for fn in ref_fns:
+            h.update(self._reference_digest(fn).encode())
+        h.update(aligner.encode())
+        ignored = self._thread_opts.get(aligner, self._default_thread_opts)
+        skip = False
+        for arg in aligner_args:
+            if skip:
+                skip = False
+            elif arg in ignored:
+                skip = True
+            else:
+                h.update(b'\0' + arg.encode())
+        return h.hexdigest()
+
+    def _entries(self, key=None):
+        """ Yield (entry directory, entry info) for each cached model """
+        keys = [key] if key is not None else os.listdir(self.dir)
+        for k in keys:
+            kdir = join(self.dir, k)
+            if not os.path.isdir(kdir):
+                continue
+            for ent in os.listdir(kdir):
+                if ent.startswith('.'):
+                    continue  # being inserted
+                edir = join(kdir, ent)
+                info_fn = join(edir, self._entry_fn)
+                if not exists(info_fn):
+                    continue  # partially written or removed
+                try:
+                    with open(info_fn) as fh:
+                        yield edir, json.load(fh)
+                except (IOError, OSError, ValueError):
+                    continue
+
+    def _touch(self, edir, info):
+        info['last_used'] = time.time()
+        tmp_fn = join(edir, self._entry_fn + '.%d' % os.getpid())
+        with open(tmp_fn, 'w') as fh:
+            json.dump(info, fh)
+        os.rename(tmp_fn, join(edir, self._entry_fn))
+
+    def lookup(self, key, fingerprint):
+        """
+        Return directory of the saved model under key whose fingerprint is
+        closest to the given one, provided it is within tolerance; otherwise
+        None.
+        """
+        best, best_dist = None, None
+        for edir, info in self._entries(key):
+            dist = fingerprint_distance(fingerprint, info['fingerprint'])
+            if dist is not None and dist <= self.tolerance and (best_dist is None or dist < best_dist):
+                best, best_dist = (edir, info), dist
+        if best is None:
+            self.log.info('No cached model applies (key %s)' % key)
+            return None
+        edir, info = best
+        self._touch(edir, info)
+        self.log.info('Using cached model "%s" (fingerprint distance %0.4f)' % (edir, best_dist))
+        return edir
+
+    def insert(self, key, fingerprint, fit):
+        """
+        Save fit under key along with the fingerprint it was trained on, then
+        evict least-recently-used entries if over the size limit.  Returns
+        the entry directory.
+        """
+        kdir = join(self.dir, key)
+        if not exists(kdir):
+            os.makedirs(kdir)
+        # write to a temporary directory then rename, so concurrent runs
+        # never see a half-written entry
+        tmp_dir = tempfile.mkdtemp(dir=kdir, prefix='.tmp')
+        fit.save(tmp_dir)
+        info = {'fingerprint': fingerprint, 'created': time.time()}
+        self._touch(tmp_dir, info)
+        edir = join(kdir, os.path.basename(tmp_dir)[len('.tmp'):])
+        os.rename(tmp_dir, edir)
+        self.log.info('Inserted model into cache at "%s"' % edir)
+        self.evict()
+        return edir
+
+    def evict(self):
+        """ Remove least-recently-used entries until under the size limit """
+        entries = []
+        for edir, info in self._entries():
+            entries.append((info['last_used'], edir, _recursive_size(edir)))
+        tot = sum(e[2] for e in entries)
+        for _, edir, sz in sorted(entries):
+            if tot <= self.max_bytes:
+                break
+            self.log.info('Evicting cached model "%s" (%0.2fMB)' % (edir, sz / (1024.0 * 1024)))
+            shutil.rmtree(edir, ignore_errors=True)
+            tot -= sz
+
+
+if __name__ == "__main__":
+
+    import sys
+    import unittest
+
+    class FakeFit(object):
+        def __init__(self, nbytes):
+            self.nbytes = nbytes
+
+        def save(self, dr):
+            with open(join(dr, 'model.pkl'), 'wb') as fh:
+                fh.write(b'\0' * self.nbytes)
+
+    def _fingerprint(len_mean):
+        return {'u': {'count': 100, 'ntemplates': 100, 'len_mean': len_mean, 'len_sd': 1.0,
+                      'score_mean': -10.0, 'score_sd': 2.0, 'fraglen_mean': 0.0, 'fraglen_sd': 0.0}}
+
+    class TestModelCache(unittest.TestCase):
+
+        def setUp(self):
+            self.dir = tempfile.mkdtemp()
+
+        def tearDown(self):
+            shutil.rmtree(self.dir)
+
+        def test_fingerprint_distance(self):
+            self.assertEqual(0.0, fingerprint_distance(_fingerprint(100.0), _fingerprint(100.0)))
+            self.assertAlmostEqual(0.1, fingerprint_distance(_fingerprint(100.0), _fingerprint(90.0)))
+            fp = _fingerprint(100.0)
+            fp['c'] = dict(fp['u'])
+            self.assertIsNone(fingerprint_distance(fp, _fingerprint(100.0)))
+
+        def test_read_fingerprint(self):
+            fn = join(self.dir, 'fp.csv')
+            with open(fn, 'w') as fh:
+                fh.write('category,count,ntemplates,len_mean,len_sd,score_mean,score_sd,fraglen_mean,fraglen_sd\n')
+                fh.write('u,10,10,100.0,0.0,-5.0,1.0,0.0,0.0\n')
+                fh.write('c,0,0,0.0,0.0,0.0,0.0,0.0,0.0\n')
+            fp = read_fingerprint(fn)
+            self.assertEqual(['c', 'u'], sorted(fp.keys()))
+            self.assertEqual(100.0, fp['u']['len_mean'])
+            self.assertEqual(0.0, fingerprint_distance(fp, fp))
+
+        def test_lookup_tolerance(self):
+            cache = ModelCache(self.dir, 1 << 20, tolerance=0.05)
+            edir = cache.insert('k', _fingerprint(100.0), FakeFit(10))
+            self.assertEqual(edir, cache.lookup('k', _fingerprint(102.0)))
+            self.assertIsNone(cache.lookup('k', _fingerprint(150.0)))
+            self.assertIsNone(cache.lookup('other', _fingerprint(100.0)))
+
+        def test_key(self):
+            ref = join(self.dir, 'ref.fa')
+            with open(ref, 'w') as fh:
+                fh.write('>r\nACGT\n')
+            cache = ModelCache(join(self.dir, 'cache'), 1 << 20)
+            k1 = cache.key([ref], 'bowtie2', ['--local', '-p', '4'])
+            self.assertEqual(k1, cache.key([ref], 'bowtie2', ['--local', '-p', '16']))
+            self.assertNotEqual(k1, cache.key([ref], 'bowtie2', ['--end-to-end']))
+            self.assertNotEqual(k1, cache.key([ref], 'bwa-mem', ['--local']))
+            # -t is Bowtie 2's --time flag, which takes no value
+            self.assertNotEqual(cache.key([ref], 'bowtie2', ['-t', '--local']),
+                                cache.key([ref], 'bowtie2', ['--local']))
+            self.assertEqual(cache.key([ref], 'bwa-mem', ['-t', '4', '-M']),
+                             cache.key([ref], 'bwa-mem', ['-t', '8', '-M']))
+
+        def test_lru_eviction(self):
+            cache = ModelCache(self.dir, 2500, tolerance=0.0)
+            e1 = cache.insert('k', _fingerprint(100.0), FakeFit(1000))
+            e2 = cache.insert('k', _fingerprint(200.0), FakeFit(1000))
+            time.sleep(0.01)
+            self.assertEqual(e1, cache.lookup('k', _fingerprint(100.0)))  # e1 now more recent
+            cache.insert('k', _fingerprint(300.0), FakeFit(1000))
+            self.assertTrue(exists(e1))
+            self.assertFalse(exists(e2))
+
+    unittest.main(argv=[sys.argv[0]])
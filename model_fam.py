@@ -69,6 +69,31 @@ class ModelFamily(object):
         self.last_params = None
         return None, None
 
+    def pending_predictors(self, exclude=()):
+        """
+        Return (idxs, translated params, new predictor) for each candidate in
+        the workset whose idxs aren't in exclude, sorted by idxs.  Workset
+        candidates are independent of each other, so they can be scored
+        concurrently before next_params() pops them.
+        """
+        pending = []
+        for idxs in sorted(self.workset):
+            if idxs not in exclude:
+                translated_params = self._idxs_to_params(idxs)
+                pending.append((idxs, translated_params, self.new_predictor(translated_params)))
+        return pending
+
+    def next_params(self):
+        """
+        Like next_predictor, but returns (idxs, translated params) without
+        making a predictor, for candidates already scored.
+        """
+        if len(self.workset) > 0:
+            self.last_params = self.workset.pop()
+            return self.last_params, self._idxs_to_params(self.last_params)
+        self.last_params = None
+        return None, None
+
     def set_score(self, score):
         assert self.last_params is not None
         assert self.last_params in self.added_to_workset
@@ -187,17 +212,17 @@ def add_args(parser):
 def model_family(args, random_seed):
     """ Given command-line arguments, return appropriate model family """
     if args['model_family'] == 'RandomForest':
-        return random_forest_models(random_seed, 1,  # args['threads'],
+        return random_forest_models(random_seed, args['threads'],
                                     args['optimization_tolerance'],
                                     args['num_trees'], args['max_features'],
                                     args['max_leaf_nodes'])
     elif args['model_family'] == 'ExtraTrees':
-        return extra_trees_models(random_seed, 1,  # args['threads'],
+        return extra_trees_models(random_seed, args['threads'],
                                   args['optimization_tolerance'],
                                   args['num_trees'], args['max_features'],
                                   args['max_leaf_nodes'])
     elif args['model_family'] == 'GradientBoosting':
-        return gradient_boosting_models(random_seed, 1,  # args['threads'],
+        return gradient_boosting_models(random_seed, args['threads'],
                                         args['optimization_tolerance'],
                                         args['num_trees'], args['max_features'],
                                         args['max_leaf_nodes'], args['learning_rate'])
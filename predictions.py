@@ -4,16 +4,16 @@ Copyright 2016, Ben Langmead <langmea@cs.jhu.edu>
 MapqPredictions class for storing and analyzing predictions.
 """
 
+import struct
 import pandas
 import logging
-from collections import Counter
+import numpy as np
 try:
     from itertools import izip
 except ImportError:
     izip = zip
 
-from roc import Roc
-from metamat import MetaMat
+from roc import RocTally
 
 # qtip imports
 __author__ = 'langmead'
@@ -22,133 +22,141 @@ __author__ = 'langmead'
 class MapqPredictions:
     """ Encapsulates mapq predictions for a dataset.  Sometimes the data has
         associated correctness information, in which case this class also
-        encapsulates performance results. """
+        encapsulates performance results.
 
-    def __init__(self, name, pred_prefix, assess_prefix, calc_summaries=True, prediction_mem_limit=10000000):
+        Predicted MAPQs are stored in <pred_prefix>.mapq, an array indexed
+        by alignment id (i.e. SAM line number) with a sentinel for lines
+        without a prediction, so that qtip-rewrite can look up each line's
+        MAPQ as it goes.  The array is preallocated, so predictions can be
+        stored in any order, and by any process sharing the mapping.
+
+        The file starts with a header: STORE_MAGIC, then little-endian
+        uint32 version and encoding and uint64 number of lines.  MAPQs are
+        encoded as float32, with NO_PREDICTION as the sentinel, or if
+        quantized as uint16 thousandths of a MAPQ (the precision of
+        --write-precise-mapq), with NO_PREDICTION_U2 as the sentinel.
+
+        Assessment is done as predictions are added: correct/incorrect
+        counts per MAPQ are tallied for the ROC tables, AUC and MSE, and
+        the top_incorrect incorrect alignments with the highest predicted
+        MAPQs are kept, so memory doesn't grow with the number of
+        predictions. """
+
+    NO_PREDICTION = -1.0
+    NO_PREDICTION_U2 = 0xffff
+
+    STORE_MAGIC = b'QTIPMAPQ'
+    STORE_VERSION = 1
+    STORE_F4, STORE_U2 = 0, 1
+    store_header = struct.Struct('<8sIIQ')
+
+    incorrect_columns = ['ids', 'category', 'mapq', 'mapq_orig', 'correct']
+
+    def __init__(self, name, pred_prefix, calc_summaries=True, nlines=0, quantize=False, top_incorrect=100):
         self.name = name
         self.calc_summaries = calc_summaries
         self.has_correct = False
 
-        def _get_fns(i):
-            return pred_prefix + '.%d.npy' % i, pred_prefix + '.%d.meta' % i
-
-        def _get_assessment_fns(i):
-            return assess_prefix + '.%d.npy' % i, assess_prefix + '.%d.meta' % i
-
-        self.get_fns = _get_fns
-        self.get_assessments_fns = _get_assessment_fns
-        npy_fn, meta_fn = _get_fns(0)
-        self.pred_fns = [npy_fn]
-        self.pred_fhs = [open(self.pred_fns[-1], 'wb')]
-        self.pred_meta_fns = [meta_fn]
-        self.pred_nrow = [0]
-        self.assess_fns = []
-        self.assess_fhs = []
-        self.assess_meta_fns = []
-        self.assess_nrow = []
-        self.assess_columns = None
-        self.last_id = None
-        if self.calc_summaries:
-            npy_assess_fn, meta_assess_fn = _get_assessment_fns(0)
-            self.assess_fns.append(npy_assess_fn)
-            self.assess_fhs.append(open(self.assess_fns[-1], 'wb'))
-            self.assess_meta_fns.append(meta_assess_fn)
-            self.assess_nrow.append(0)
+        self.pred_fn = pred_prefix + '.mapq'
+        self.mapq_store = self.open_store(self.pred_fn, nlines, quantize=quantize)
 
         self.mapq_precision = 3
-        self.tally = Counter()
-        self.tally_orig = Counter()
-        self.tally_rounded = Counter()
+        self.tally = RocTally()
+        self.tally_orig = RocTally()
+        self.tally_rounded = RocTally()
         self.roc = None
         self.roc_orig = None
         self.roc_rounded = None
-        self.df = None
+        self.top_incorrect = top_incorrect
+        self.incorrect = None  # highest-MAPQ incorrect alignments so far
 
-        self.prediction_mem_limit = prediction_mem_limit
         self.npredictions = 0
         self.auc_diff_pct = None
         self.auc_diff_round_pct = None
         self.mse_diff_pct = None
         self.mse_diff_round_pct = None
 
-    def add(self, recs, first_id, last_id, mapq=None, mapq_orig=None, correct=None):
-        """ Add a new batch of predictions. """
+    @classmethod
+    def open_store(cls, fn, nlines, quantize=False):
+        """ Create the MAPQ array for lines 0 through nlines-1 in file fn,
+            with every line lacking a prediction, and return it
+            memory-mapped, or None if nlines is 0. """
+        encoding = cls.STORE_U2 if quantize else cls.STORE_F4
+        with open(fn, 'wb') as fh:
+            fh.write(cls.store_header.pack(cls.STORE_MAGIC, cls.STORE_VERSION, encoding, nlines))
+        if nlines == 0:
+            return None
+        if quantize:
+            store = np.memmap(fn, dtype='<u2', mode='r+', offset=cls.store_header.size, shape=(nlines,))
+            store[:] = cls.NO_PREDICTION_U2
+        else:
+            store = np.memmap(fn, dtype='<f4', mode='r+', offset=cls.store_header.size, shape=(nlines,))
+            store[:] = cls.NO_PREDICTION
+        return store
+
+    @classmethod
+    def store(cls, mapq_store, ids, mapq):
+        """ Store predicted MAPQs for the alignments with the given ids.
+            Quantized MAPQs are kept on the same side of k + 0.5 as the
+            originals, so they round to the same integer MAPQ in
+            qtip-rewrite. """
+        if mapq_store.dtype == np.uint16:
+            mapq = np.asarray(mapq, dtype=np.float64)
+            rounded = np.floor(mapq + 0.5) * 1000.0
+            mapq = np.clip(np.rint(mapq * 1000.0), rounded - 500.0, rounded + 499.0)
+            mapq = np.minimum(mapq, cls.NO_PREDICTION_U2 - 1)
+        mapq_store[np.asarray(ids, dtype=np.uint64)] = mapq
+
+    def add(self, recs, mapq=None, mapq_orig=None, correct=None, stored=False):
+        """ Add a new batch of predictions, in any order.  If stored is
+            set, the caller has already stored the MAPQs with store(). """
         if recs.shape[0] == 0:
             return
 
-        # Open new csv if we got a discontiguous chunk. Requires merging later.
-        if self.last_id is not None and first_id < self.last_id:
-            i = len(self.pred_fns)
-            npy_fn, meta_fn = self.get_fns(i)
-            self.pred_fns.append(npy_fn)
-            self.pred_meta_fns.append(meta_fn)
-            self.pred_fhs.append(open(self.pred_fns[-1], 'wb'))
-            self.pred_nrow.append(0)
-            if self.calc_summaries:
-                assert mapq is not None
-                npy_assess_fn, meta_assess_fn = self.get_assessments_fns(i)
-                self.assess_fns.append(npy_assess_fn)
-                self.assess_fhs.append(open(self.assess_fns[-1], 'wb'))
-                self.assess_meta_fns.append(meta_assess_fn)
-                self.assess_nrow.append(0)
-
-        # This is performance-critical
-        recs[['ids', 'mapq']].values.tofile(self.pred_fhs[-1], sep='')
+        if not stored:
+            self.store(self.mapq_store, recs.ids.values, recs.mapq.values)
         self.npredictions += recs.shape[0]
-        self.pred_nrow[-1] += recs.shape[0]
-        if self.calc_summaries:
-            assert mapq is not None
-            if self.assess_columns is None:
-                self.assess_columns = list(recs.columns)
-            else:
-                assert self.assess_columns == list(recs.columns)
-            recs.values.tofile(self.assess_fhs[-1], sep='')
-            self.assess_nrow[-1] += recs.shape[0]
-
-        self.last_id = last_id
 
         # Update tallies if possible
         self.has_correct = mapq is not None
         if self.has_correct:
             assert mapq_orig is not None
             assert correct is not None
-            self.tally.update(zip(mapq.round(decimals=self.mapq_precision), correct))
-            self.tally_orig.update(zip(mapq_orig, correct))
-            self.tally_rounded.update(zip(mapq.round(decimals=0), correct))
-
-    def _load_predictions(self):
-        """ Load all the predictions added with the 'add' member function into
-            the appropriate fields of this object.  This should be called only
-            with a reasonable number of predictions. """
-        assert self.can_assess()
-        if self.npredictions > self.prediction_mem_limit:
-            raise RuntimeError('Request to load %d predictions into memory exceeds limit (%d)' %
-                               (self.npredictions, self.prediction_mem_limit))
-        dfs = []
-        for fn in self.assess_fns:
-            assert fn.endswith('.npy')
-            dfs.append(MetaMat(fn[:-4], chunk_size=-1).next())  # read the whole thing
-        self.df = pandas.concat(dfs)
-        assert self.df.shape[0] > 0
+            correct = np.asarray(correct)
+            self.tally.add(np.asarray(mapq.round(decimals=self.mapq_precision)), correct)
+            self.tally_orig.add(np.asarray(mapq_orig), correct)
+            self.tally_rounded.add(np.asarray(mapq.round(decimals=0)), correct)
+            if self.calc_summaries and self.top_incorrect > 0:
+                self._add_incorrect(recs.loc[correct == 0, self.incorrect_columns])
+
+    def _add_incorrect(self, recs):
+        """ Merge incorrect alignments into those kept so far, keeping the
+            top_incorrect with the highest MAPQs, ties broken by id. """
+        if recs.shape[0] == 0:
+            return
+        if self.incorrect is not None:
+            recs = pandas.concat([self.incorrect, recs], ignore_index=True)
+        if recs.shape[0] > self.top_incorrect:
+            mapq = recs.mapq.values
+            # partition on MAPQ first, keeping everything tied at the cutoff
+            cutoff = np.partition(mapq, mapq.shape[0] - self.top_incorrect)[mapq.shape[0] - self.top_incorrect]
+            recs = recs[mapq >= cutoff]
+        order = np.lexsort((recs.ids.values, -recs.mapq.values))[:self.top_incorrect]
+        self.incorrect = recs.iloc[order].reset_index(drop=True)
 
     def can_assess(self):
         """ Return true iff we have the data and the flags needed to do an
             accuracy assessment. """
         return self.calc_summaries and self.has_correct
 
-    def incorrect_indexes(self):
-        """ Return indexes of in correct alignments in order
-            from highest to lowest predicted pcor """
-        assert self.df.correct.max() > -1
-        #assert pandas.algos.is_monotonic_float64(self.df.mapq.values, True)
-        return self.df.correct[self.df.correct == 0].index[::-1].tolist()
-
     def summarize_incorrect(self, n=50):
-        """ Return a DataFrame summarizing information about """
-        assert self.df.correct.max() > -1
-        #assert pandas.algos.is_monotonic_float64(self.df.mapq.values, True)
-        cols = ['category', 'mapq', 'mapq_orig', 'data', 'correct']
-        return self.df.loc[self.incorrect_indexes()[:n], cols]
+        """ Return a DataFrame describing the n incorrect alignments with the
+            highest predicted MAPQs, from highest to lowest.  At most
+            top_incorrect are available. """
+        assert self.has_correct
+        if self.incorrect is None:
+            return pandas.DataFrame(columns=self.incorrect_columns)
+        return self.incorrect.iloc[:n]
 
     def write_rocs(self, roc_prefix):
         """ Write a ROC table with # correct/# incorrect stratified by
@@ -171,54 +179,27 @@ class MapqPredictions:
             fh.write((','.join(map(str, auc_stats + mse_stats)) + '\n').encode('utf-8'))
 
     def write_top_incorrect(self, fn, n=100):
-        """ Write a ROC table with # correct/# incorrect stratified by
-            predicted MAPQ. """
+        """ Write the n incorrect alignments with the highest predicted
+            MAPQs. """
         self.summarize_incorrect(n=n).to_csv(fn, sep=',', index=False, encoding='utf-8')
 
     def finalize(self, log=logging):
         """ Close prediction file handle.  If we have the information and flags
             needed for accuracy assessment, then do that too. """
 
-        # Finish writing numpy files
-        for fh in self.pred_fhs + self.assess_fhs:
-            fh.close()
-
-        # Write metadata for the prediction files
-        columns = ['ids', 'mapq']
-        for fn, n_row in zip(self.pred_meta_fns, self.pred_nrow):
-            with open(fn, 'wb') as fh:
-                fh.write(b','.join(map(lambda x: x.encode(), columns)))
-                fh.write(b',')
-                fh.write(str(n_row).encode())
-        if self.calc_summaries:
-            # Write metadata for the assessment files
-            for fn, n_row in zip(self.assess_meta_fns, self.assess_nrow):
-                with open(fn, 'wb') as fh:
-                    fh.write(b','.join(map(lambda x: x.encode(), self.assess_columns)))
-                    fh.write(b',')
-                    fh.write(str(n_row).encode())
-
-        log.info('  %d records written to %d files' % (self.npredictions, len(self.pred_fns)))
+        # Finish writing files
+        if self.mapq_store is not None:
+            self.mapq_store.flush()
+            self.mapq_store = None
+
+        log.info('  %d predictions stored in "%s"' % (self.npredictions, self.pred_fn))
 
         # calculate error measures and other measures
         if self.can_assess():
 
-            self.roc = Roc(self.tally)
-            self.roc_orig = Roc(self.tally_orig)
-            self.roc_rounded = Roc(self.tally_rounded)
-
-            log.info('  Correctness information is present; loading predictions into memory')
-            self._load_predictions()
-            assert self.df is not None
-            assert isinstance(self.df, pandas.DataFrame)
-            assert 'mapq' in self.df
-            assert 'mapq_orig' in self.df
-            assert 'correct' in self.df
-            self.df.mapq_orig = self.df.mapq_orig.astype(int)
-            self.df.correct = self.df.correct.astype(int)
-
-            log.info('  Reordering')
-            self.df.sort_values('mapq', ascending=False, inplace=True)
+            self.roc = self.tally.roc()
+            self.roc_orig = self.tally_orig.roc()
+            self.roc_rounded = self.tally_rounded.roc()
 
             log.info('  Calculating AUC')
             auc_orig = self.roc_orig.area_under_cumulative_incorrect()
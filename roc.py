@@ -26,13 +26,29 @@ class Roc(object):
                 dct[k[0]][1 - k[1]] = v
             tally = dct
         mapqs, tups = zip(*sorted(tally.items(), reverse=True))
-        mapqs = numpy.array(mapqs)
+        cors, incors = zip(*tups)
+        self._init_tab(numpy.array(mapqs), numpy.array(cors), numpy.array(incors), mapq_strata)
+
+    @classmethod
+    def from_counts(cls, mapqs, cors, incors, mapq_strata=True):
+        """
+        Make a Roc from parallel arrays giving each distinct MAPQ (or
+        probability, if not mapq_strata) and its numbers of correct and
+        incorrect alignments, in any order.
+        """
+        order = numpy.argsort(mapqs, kind='mergesort')[::-1]
+        roc = cls.__new__(cls)
+        roc._init_tab(numpy.asarray(mapqs)[order], numpy.asarray(cors)[order],
+                      numpy.asarray(incors)[order], mapq_strata)
+        return roc
+
+    def _init_tab(self, mapqs, cors, incors, mapq_strata):
+        """ Build table from arrays sorted by descending MAPQ """
         if mapq_strata:
             pcor = mapq_to_pcor_np(mapqs)
         else:
             pcor = mapqs
             mapqs = pcor_to_mapq_np(mapqs)
-        cors, incors = zip(*tups)
         self.tab = pandas.DataFrame.from_dict({'mapq': mapqs,
                                                'pcor': pcor,
                                                'cor': cors,
@@ -46,49 +62,95 @@ class Roc(object):
         self.tab['cum_se'] = self.tab['se'].cumsum()
         self.tot = self.tab['n'].sum()
 
-    def cum_incorrect_and_error(self):
+    def _increments(self):
+        """
+        Return # alignments per stratum, along with the share of the
+        stratum's incorrect count and squared error due to each alignment.
+        """
+        n = self.tab['n'].values.astype(numpy.int64)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            return n, self.tab['incor'].values / n, self.tab['se'].values / n
+
+    def cum_incorrect_and_error_arrays(self):
+        """
+        Return arrays with the CID and CSED curves: cumulative incorrect and
+        cumulative squared error after each alignment, from high to low
+        MAPQ, starting with 0 before the first.
+        """
+        n, incor_incr, se_incr = self._increments()
+        ci = numpy.concatenate(([0.0], numpy.cumsum(numpy.repeat(incor_incr, n))))
+        ce = numpy.concatenate(([0.0], numpy.cumsum(numpy.repeat(se_incr, n))))
+        return ci, ce
+
+    def cum_incorrect_and_error_at(self, pos):
         """
-        Take two ROC tables.  Return vectors corresponding to the CID and CSED
-        curves.
+        Return CID and CSED curves evaluated only after the given numbers of
+        alignments, without expanding strata into one point per alignment.
         """
-        ci, ce = [0], [0]
-        for idx, row in self.tab.iterrows():
-            incor_incr = row['incor'] / float(row['n'])
-            se_incr = row['se'] / float(row['n'])
-            for i in range(int(row['n'])):
-                ci.append(ci[-1] + incor_incr)
-                ce.append(ce[-1] + se_incr)
+        n, incor_incr, se_incr = self._increments()
+        ends = numpy.cumsum(n)
+        pos = numpy.asarray(pos, dtype=numpy.int64)
+        assert len(pos) == 0 or (pos.min() >= 0 and pos.max() <= ends[-1])
+        strat = numpy.minimum(numpy.searchsorted(ends, pos, side='left'), len(n) - 1)
+        within = pos - (ends - n)[strat]
+        ci_before = numpy.cumsum(self.tab['incor'].values) - self.tab['incor'].values
+        ce_before = self.tab['cum_se'].values - self.tab['se'].values
+        ci = ci_before[strat] + within * incor_incr[strat]
+        ce = ce_before[strat] + within * se_incr[strat]
         return ci, ce
 
+    def cum_incorrect_and_error(self):
+        """
+        Return lists corresponding to the CID and CSED curves.
+        """
+        ci, ce = self.cum_incorrect_and_error_arrays()
+        return ci.tolist(), ce.tolist()
+
+    @staticmethod
+    def _curve_diffs(roc1, roc2, which, max_points=None, chunk=1000000):
+        """
+        Yield differences between the CID (which=0) or CSED (which=1)
+        curves of two ROC tables, as far as the shorter goes, a chunk of
+        points at a time, so that neither curve is ever held in memory
+        whole.  If there are more than max_points points, the curves are
+        sampled at max_points evenly spaced points instead.
+        """
+        tot = min(int(roc1.tot), int(roc2.tot))
+        pos = None
+        if max_points is not None and tot + 1 > max_points:
+            pos = numpy.unique(numpy.linspace(0, tot, max_points).round().astype(numpy.int64))
+        npos = tot + 1 if pos is None else len(pos)
+        for i in range(0, npos, chunk):
+            p = numpy.arange(i, min(i + chunk, npos)) if pos is None else pos[i:i+chunk]
+            yield roc1.cum_incorrect_and_error_at(p)[which] - roc2.cum_incorrect_and_error_at(p)[which]
+
+    @staticmethod
+    def _write_values(chunks, fn):
+        """
+        Write values one per line, a chunk at a time.
+        """
+        with open(fn, 'w') as fh:
+            for vals in chunks:
+                fh.write(''.join(map(lambda x: str(x) + '\n', vals.tolist())))
+
     @staticmethod
-    def write_cum_incorrect_diff(roc1, roc2, fn):
-        with open(fn, 'wb') as fh:
-            ci1l, _ = roc1.cum_incorrect_and_error()
-            ci2l, _ = roc2.cum_incorrect_and_error()
-            for ci1, ci2 in zip(ci1l, ci2l):
-                fh.write(str(ci1 - ci2) + '\n')
+    def write_cum_incorrect_diff(roc1, roc2, fn, max_points=None):
+        Roc._write_values(Roc._curve_diffs(roc1, roc2, 0, max_points), fn)
 
     @staticmethod
-    def write_cum_squared_error(roc1, roc2, fn):
-        with open(fn, 'wb') as fh:
-            _, csel1 = roc1.cum_incorrect_and_error()
-            _, csel2 = roc2.cum_incorrect_and_error()
-            for cse1, cse2 in zip(csel1, csel2):
-                fh.write(str(cse1 - cse2) + '\n')
+    def write_cum_squared_error(roc1, roc2, fn, max_points=None):
+        Roc._write_values(Roc._curve_diffs(roc1, roc2, 1, max_points), fn)
 
     def area_under_cumulative_incorrect(self):
         """
         Return area under the cumulative incorrect curve, accumulated from
-        high to low mapping quality.
+        high to low mapping quality.  Each stratum contributes its width
+        times the height of the curve halfway through it.
         """
-        cum, auc = 0, 0.0
-        for idx, row in self.tab.iterrows():
-            ic, n = int(row['incor']), int(row['n'])
-            height = cum + ic/2.0
-            width = n
-            auc += height * width
-            cum += ic
-        return auc
+        incor = self.tab['incor'].values.astype(numpy.float64)
+        n = self.tab['n'].values.astype(numpy.float64)
+        cum_before = numpy.cumsum(incor) - incor
+        return float(numpy.sum((cum_before + incor / 2.0) * n))
 
     def sum_of_squared_error(self):
         """
@@ -97,6 +159,48 @@ class Roc(object):
         return self.tab['cum_se'].iloc[-1]
 
 
+class RocTally(object):
+    """
+    Numbers of correct and incorrect alignments for each distinct MAPQ,
+    accumulated a chunk at a time with numpy rather than one alignment at a
+    time with a Counter.
+    """
+
+    def __init__(self):
+        self.mapqs = None  # distinct MAPQs, ascending
+        self.counts = None  # correct, incorrect counts per MAPQ
+
+    def add(self, mapqs, correct):
+        """
+        Tally alignments with the given MAPQs and correctness (1 for
+        correct, 0 for incorrect).
+        """
+        mapqs, correct = numpy.asarray(mapqs), numpy.asarray(correct)
+        if len(mapqs) == 0:
+            return
+        keys, inv = numpy.unique(mapqs, return_inverse=True)
+        counts = numpy.bincount(inv.ravel() * 2 + (1 - correct.astype(numpy.int64)),
+                                minlength=2 * len(keys)).reshape(-1, 2)
+        if self.mapqs is not None:
+            keys, inv = numpy.unique(numpy.concatenate([self.mapqs, keys]), return_inverse=True)
+            merged = numpy.zeros((len(keys), 2), dtype=numpy.int64)
+            numpy.add.at(merged, inv.ravel(), numpy.concatenate([self.counts, counts]))
+            counts = merged
+        self.mapqs, self.counts = keys, counts
+
+    def empty(self):
+        return self.mapqs is None
+
+    def roc(self, mapq_strata=True):
+        """
+        Return Roc for the alignments tallied so far.
+        """
+        assert not self.empty()
+        # widen to Python float or int first, as a Counter's keys would be
+        mapqs = numpy.array(self.mapqs.tolist())
+        return Roc.from_counts(mapqs, self.counts[:, 0], self.counts[:, 1], mapq_strata=mapq_strata)
+
+
 if __name__ == "__main__":
 
     import sys
@@ -168,5 +272,88 @@ if __name__ == "__main__":
                        1.0: [1, 2]}, mapq_strata=False)
             self.assertAlmostEqual(3.02, roc.sum_of_squared_error())
 
+        def test_cum_inc_and_err_at(self):
+            roc = Roc({0.0: [1, 1],
+                       0.1: [0, 1],
+                       0.9: [1, 0],
+                       1.0: [1, 2]}, mapq_strata=False)
+            ci, ce = roc.cum_incorrect_and_error()
+            ci_at, ce_at = roc.cum_incorrect_and_error_at(range(len(ci)))
+            for x, y in zip(ci + ce, list(ci_at) + list(ce_at)):
+                self.assertAlmostEqual(x, y, places=10)
+            ci_at, _ = roc.cum_incorrect_and_error_at([0, 4, 7])
+            self.assertEqual(list(ci_at), [0.0, 2.0, 4.0])
+
+        def test_write_cum_diff(self):
+            import tempfile
+            import os
+            roc1 = Roc({2: [1, 1],
+                        1: [1, 2],
+                        0: [1, 1]})
+            roc2 = Roc({2: [2, 0],
+                        0: [1, 2]})
+            fd, fn = tempfile.mkstemp()
+            os.close(fd)
+            try:
+                Roc.write_cum_incorrect_diff(roc1, roc2, fn)
+                with open(fn) as fh:
+                    diffs = list(map(float, fh.read().split()))
+                ci1, _ = roc1.cum_incorrect_and_error()
+                ci2, _ = roc2.cum_incorrect_and_error()
+                self.assertEqual(len(ci2), len(diffs))
+                for x, y in zip(diffs, [a - b for a, b in zip(ci1, ci2)]):
+                    self.assertAlmostEqual(x, y, places=10)
+                Roc.write_cum_squared_error(roc1, roc2, fn)
+                with open(fn) as fh:
+                    diffs = list(map(float, fh.read().split()))
+                _, ce1 = roc1.cum_incorrect_and_error()
+                _, ce2 = roc2.cum_incorrect_and_error()
+                self.assertEqual(len(ce2), len(diffs))
+                for x, y in zip(diffs, [a - b for a, b in zip(ce1, ce2)]):
+                    self.assertAlmostEqual(x, y, places=10)
+                whole = numpy.concatenate(list(Roc._curve_diffs(roc1, roc2, 1)))
+                chunked = numpy.concatenate(list(Roc._curve_diffs(roc1, roc2, 1, chunk=2)))
+                self.assertTrue(numpy.array_equal(whole, chunked))
+                Roc.write_cum_squared_error(roc1, roc2, fn, max_points=3)
+                with open(fn) as fh:
+                    self.assertEqual(3, len(fh.read().split()))
+            finally:
+                os.remove(fn)
+
+        def test_from_counts_1(self):
+            roc = Roc.from_counts(numpy.array([0, 2, 1]), numpy.array([1, 1, 1]), numpy.array([1, 1, 2]))
+            self.assertEqual(list(roc.tab['mapq']), [2, 1, 0])
+            self.assertEqual(list(roc.tab['cum']), [2, 5, 7])
+            self.assertEqual(list(roc.tab['cum_incor']), [1, 3, 4])
+            self.assertEqual(list(roc.tab['cum_cor']), [1, 2, 3])
+            self.assertEqual(0.5 * 2.0 + 2.0 * 3.0 + 3.5 * 2.0, roc.area_under_cumulative_incorrect())
+
+        def test_tally_1(self):
+            # same alignments as test_roc_1, over two chunks
+            tally = RocTally()
+            tally.add(numpy.array([2.0, 1.0, 2.0]), numpy.array([1, 0, 0]))
+            tally.add(numpy.array([0.0, 1.0, 0.0, 1.0]), numpy.array([1, 0, 0, 1]))
+            self.assertEqual(list(tally.mapqs), [0.0, 1.0, 2.0])
+            roc = tally.roc()
+            expected = Roc({2: [1, 1],
+                            1: [1, 2],
+                            0: [1, 1]})
+            for col in ['mapq', 'pcor', 'cor', 'incor', 'cum', 'cum_se']:
+                self.assertEqual(list(roc.tab[col]), list(expected.tab[col]))
+
+        def test_tally_2(self):
+            # agrees with a Counter-based tally
+            rs = numpy.random.RandomState(0)
+            tally, cnt = RocTally(), Counter()
+            for _ in range(5):
+                mapqs = rs.randint(0, 40, size=200).astype(numpy.float32) / 4
+                correct = rs.randint(0, 2, size=200)
+                tally.add(mapqs, correct)
+                cnt.update(zip(mapqs.tolist(), correct.tolist()))
+            roc, expected = tally.roc(), Roc(cnt)
+            for col in ['mapq', 'cor', 'incor', 'cum_se']:
+                self.assertEqual(list(roc.tab[col]), list(expected.tab[col]))
+            self.assertEqual(roc.area_under_cumulative_incorrect(), expected.area_under_cumulative_incorrect())
+
     unittest.main(argv=[sys.argv[0]])
     sys.exit()
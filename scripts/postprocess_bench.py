@@ -0,0 +1,59 @@
+'''
+postprocess_bench.py
+
+Microbenchmark for fit.postprocess_predictions, which runs on every chunk
+of predictions, along with the conversion of its output to MAPQs.  Compares
+it to the original list-based implementation on random chunks, some of
+which have pcors of 1.0, checks that the two agree, and prints the time
+per chunk for each.
+
+Usage: python scripts/postprocess_bench.py [rows per chunk] [repetitions]
+'''
+
+from __future__ import print_function
+import os
+import sys
+import timeit
+import logging
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from fit import postprocess_predictions, _clamp_predictions, _pcor_to_mapq_f4
+from mapq import pcor_to_mapq_np
+
+
+def postprocess_predictions_lists(pcor_test, dataset_name, max_pcor=0.999999):
+    """ The original implementation, for comparison """
+    mn, mx = min(pcor_test), max(pcor_test)
+    if mx >= 1.0:
+        if mn == mx:
+            pcor_test = [max_pcor] * len(pcor_test)
+        max_noninf_pcor_test = max(filter(lambda x: x < 1.0, pcor_test))
+        pcor_test = [max_noninf_pcor_test + 1e-6 if p >= 1.0 else p for p in pcor_test]
+    return _clamp_predictions(pcor_test, 0.0, max_pcor)
+
+
+def old_chunk(pcor):
+    return pcor_to_mapq_np(np.array(postprocess_predictions_lists(pcor, 'bench'))).astype(np.float32)
+
+
+def new_chunk(pcor):
+    return _pcor_to_mapq_f4(postprocess_predictions(pcor.copy(), 'bench', inplace=True))
+
+
+def go():
+    nrows = int(sys.argv[1]) if len(sys.argv) > 1 else 250000
+    reps = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    logging.disable(logging.WARNING)
+    rs = np.random.RandomState(0)
+    pcor = rs.random_sample(nrows)
+    pcor[rs.random_sample(nrows) < 0.2] = 1.0  # like a random forest's votes
+    assert np.array_equal(old_chunk(pcor), new_chunk(pcor))
+    for name, fn in [('lists', old_chunk), ('numpy', new_chunk)]:
+        secs = min(timeit.repeat(lambda: fn(pcor), number=1, repeat=reps))
+        print('%s: %0.2f ms per %d-row chunk' % (name, secs * 1000, nrows))
+
+
+if __name__ == "__main__":
+    go()
@@ -96,8 +96,8 @@ class SnapAligner(Aligner):
             Outputs:
             
             'sam' is a filename where output SAM records will be
-            stored.  If 'sam' is none, SAM records will be added to
-            the outQ.
+            stored.  If 'sam' is None, SAM records are written to
+            the standard output of self.pipe.
         """
 
         if index is None:
@@ -147,7 +147,8 @@ class SnapAligner(Aligner):
         if sam is not None:
             args_output.append(sam)
         else:
-            raise RuntimeError("Must specify SAM output")
+            args_output.append('-')
+            popen_stdout = PIPE
 
         # Put all the arguments together
         cmd = ''
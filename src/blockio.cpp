@@ -0,0 +1,309 @@
+//
+//  blockio.cpp
+//  qtip
+//
+//  Copyright (c) 2016 JHU. All rights reserved.
+//
+
+#include "blockio.h"
+#include <iostream>
+#include <cassert>
+#include <algorithm>
+#include <sys/mman.h>
+#include <sys/stat.h>
+
+using namespace std;
+
+bool MappedFile::map(FILE *fh, bool writable) {
+	unmap();
+	struct stat st;
+	int fd = fileno(fh);
+	if(fd < 0 || fstat(fd, &st) != 0 || !S_ISREG(st.st_mode)) {
+		return false;
+	}
+	len_ = (size_t)st.st_size;
+	if(len_ == 0) {
+		return true; // nothing to map
+	}
+	void *p = mmap(NULL, len_, writable ? (PROT_READ | PROT_WRITE) : PROT_READ,
+	               MAP_PRIVATE, fd, 0);
+	if(p == MAP_FAILED) {
+		len_ = 0;
+		return false;
+	}
+	madvise(p, len_, MADV_SEQUENTIAL);
+	buf_ = (char *)p;
+	mapped_ = true;
+	return true;
+}
+
+void MappedFile::unmap() {
+	if(mapped_) {
+		munmap(buf_, len_);
+	}
+	buf_ = NULL;
+	len_ = 0;
+	mapped_ = false;
+}
+
+/**
+ * Return true iff the lines starting at a and b have the same first
+ * tab-delimited field.
+ */
+static bool same_first_field(const char *a, const char *b) {
+	while(*a == *b) {
+		if(*a == '\t' || *a == '\n') {
+			return true;
+		}
+		a++;
+		b++;
+	}
+	return (*a == '\t' || *a == '\n') && (*b == '\t' || *b == '\n');
+}
+
+/**
+ * Return offset of the first character of the line ending just before
+ * offset end.
+ */
+static size_t line_start(const char *buf, size_t end) {
+	assert(end > 0 && buf[end-1] == '\n');
+	size_t st = end - 1;
+	while(st > 0 && buf[st-1] != '\n') {
+		st--;
+	}
+	return st;
+}
+
+size_t LineBlockReader::find_cut(const char *buf, size_t len) const {
+	size_t end = len;
+	while(end > 0 && buf[end-1] != '\n') {
+		end--;
+	}
+	if(end == 0 || !keep_qnames_) {
+		return end;
+	}
+	// Walk backward over complete lines looking for two adjacent lines with
+	// different names
+	size_t cur = line_start(buf, end);
+	while(cur > 0) {
+		size_t prev = line_start(buf, cur);
+		if(!same_first_field(buf + prev, buf + cur)) {
+			return cur;
+		}
+		cur = prev;
+	}
+	return 0;
+}
+
+bool LineBlockReader::next(std::vector<char>& blk) {
+	blk.swap(carry_);
+	carry_.clear();
+	size_t target = blocksz_;
+	while(true) {
+		while(!eof_ && blk.size() < target) {
+			size_t off = blk.size();
+			blk.resize(target);
+			size_t nread = fread(&blk[off], 1, target - off, fh_);
+			blk.resize(off + nread);
+			if(nread < target - off) {
+				if(ferror(fh_)) {
+					cerr << "Error reading input file" << endl;
+					throw 1;
+				}
+				eof_ = true;
+			}
+		}
+		if(eof_) {
+			if(blk.empty()) {
+				return false;
+			}
+			if(blk.back() != '\n') {
+				blk.push_back('\n');
+			}
+			return true;
+		}
+		size_t cut = find_cut(&blk[0], blk.size());
+		if(cut > 0) {
+			carry_.assign(blk.begin() + cut, blk.end());
+			blk.resize(cut);
+			return true;
+		}
+		// no place to cut; read more
+		target += blocksz_;
+	}
+}
+
+bool LineBlockReader::next(std::vector<char>& storage, char *& blk, size_t& len) {
+	if(fh_ != NULL) {
+		if(!next(storage)) {
+			return false;
+		}
+		blk = &storage[0];
+		len = storage.size();
+		return true;
+	}
+	if(memlen_ == 0) {
+		return false;
+	}
+	size_t cut = memlen_;
+	if(memlen_ > blocksz_) {
+		// look for a cut point at or before blocksz_, then after it
+		cut = find_cut(mem_, blocksz_);
+		size_t lim = blocksz_;
+		while(cut == 0 && lim < memlen_) {
+			lim = std::min(lim + blocksz_, memlen_);
+			cut = find_cut(mem_, lim);
+		}
+		if(cut == 0) {
+			cut = memlen_;
+		}
+	}
+	blk = mem_;
+	len = cut;
+	mem_ += cut;
+	memlen_ -= cut;
+	if(blk[len-1] != '\n') {
+		// final line is missing its newline and there's no room to add one
+		assert(memlen_ == 0);
+		storage.assign(blk, blk + len);
+		storage.push_back('\n');
+		blk = &storage[0];
+		len = storage.size();
+	}
+	return true;
+}
+
+#ifdef BLOCKIO_MAIN
+
+#include <string>
+
+static void write_file(const char *fn, const string& s) {
+	FILE *fh = fopen(fn, "wb");
+	assert(fh != NULL);
+	fwrite(s.c_str(), 1, s.length(), fh);
+	fclose(fh);
+}
+
+static string read_all(const char *fn, size_t blocksz, bool keep, size_t& nblocks) {
+	FILE *fh = fopen(fn, "rb");
+	assert(fh != NULL);
+	LineBlockReader rd(fh, blocksz, keep);
+	vector<char> blk;
+	string all;
+	nblocks = 0;
+	while(rd.next(blk)) {
+		assert(!blk.empty());
+		assert(blk.back() == '\n');
+		all += string(blk.begin(), blk.end());
+		nblocks++;
+	}
+	assert(rd.done());
+	fclose(fh);
+	return all;
+}
+
+static void test1() {
+	const char *fn = ".blockio.test1.txt";
+	string s = "r1\t1\nr2\t2\nr3\t3\n";
+	write_file(fn, s);
+	for(size_t blocksz = 1; blocksz < 20; blocksz++) {
+		size_t nblocks = 0;
+		assert(read_all(fn, blocksz, false, nblocks) == s);
+		assert(nblocks >= 1 && nblocks <= 3);
+	}
+	// missing final newline is added
+	write_file(fn, "r1\t1\nr2\t2");
+	size_t nblocks = 0;
+	assert(read_all(fn, 4, false, nblocks) == string("r1\t1\nr2\t2\n"));
+	assert(nblocks == 2);
+	// empty file
+	write_file(fn, "");
+	assert(read_all(fn, 4, false, nblocks) == string(""));
+	assert(nblocks == 0);
+	remove(fn);
+}
+
+static void test2() {
+	const char *fn = ".blockio.test2.txt";
+	string s = "@HD\tVN:1.0\n"
+	           "a\t65\tx\n"
+	           "a\t129\tx\n"
+	           "b\t0\ty\n"
+	           "c\t65\tx\n"
+	           "c\t256\tx\n"
+	           "c\t129\tx\n";
+	write_file(fn, s);
+	for(size_t blocksz = 1; blocksz < 60; blocksz++) {
+		FILE *fh = fopen(fn, "rb");
+		LineBlockReader rd(fh, blocksz, true);
+		vector<char> blk;
+		string all;
+		while(rd.next(blk)) {
+			string b(blk.begin(), blk.end());
+			if(!all.empty()) {
+				// last name in previous block differs from first in this one
+				size_t st = all.rfind('\n', all.length() - 2);
+				st = (st == string::npos) ? 0 : st + 1;
+				string last = all.substr(st, all.find('\t', st) - st);
+				assert(last != b.substr(0, b.find('\t')));
+			}
+			all += b;
+		}
+		fclose(fh);
+		assert(all == s);
+	}
+	remove(fn);
+}
+
+static void test3() {
+	const char *fn = ".blockio.test3.txt";
+	string s = "@HD\tVN:1.0\n"
+	           "a\t65\tx\n"
+	           "a\t129\tx\n"
+	           "b\t0\ty\n"
+	           "c\t65\tx\n"
+	           "c\t129\tx";
+	write_file(fn, s);
+	FILE *fh = fopen(fn, "rb");
+	MappedFile mf;
+	assert(mf.map(fh, true));
+	assert(mf.size() == s.length());
+	for(size_t blocksz = 1; blocksz < 60; blocksz++) {
+		LineBlockReader rd(mf.data(), mf.size(), blocksz, true);
+		vector<char> storage;
+		char *blk = NULL;
+		size_t len = 0;
+		string all;
+		while(rd.next(storage, blk, len)) {
+			assert(blk[len-1] == '\n');
+			all += string(blk, len);
+		}
+		assert(rd.done());
+		assert(all == s + "\n");
+	}
+	// lines from the mapping
+	char buf[64];
+	LineReader lr(fh, buf, 64);
+	assert(lr.mapped());
+	const char *line = NULL;
+	size_t len = 0;
+	string all;
+	size_t nlines = 0;
+	while(lr.next(line, len)) {
+		all += string(line, len);
+		nlines++;
+	}
+	assert(nlines == 6);
+	assert(all == s);
+	fclose(fh);
+	remove(fn);
+}
+
+int main(void) {
+	test1();
+	test2();
+	test3();
+	cerr << "PASSED" << endl;
+}
+
+#endif
@@ -0,0 +1,184 @@
+//
+//  blockio.h
+//  qtip
+//
+//  Copyright (c) 2016 JHU. All rights reserved.
+//
+
+#ifndef __qtip__blockio__
+#define __qtip__blockio__
+
+#include <stdio.h>
+#include <string.h>
+#include <vector>
+
+/**
+ * A file mapped into memory.  Only regular files can be mapped; for others
+ * (e.g. pipes) map() returns false and the caller should fall back on stdio.
+ */
+class MappedFile {
+public:
+	MappedFile() : buf_(NULL), len_(0), mapped_(false) { }
+
+	~MappedFile() {
+		unmap();
+	}
+
+	/**
+	 * Map the file open as fh.  If writable, the mapping is private and
+	 * copy-on-write, so callers can modify it (e.g. to tokenize in place)
+	 * without changing the file.  Returns false if the file can't be mapped.
+	 */
+	bool map(FILE *fh, bool writable);
+
+	void unmap();
+
+	char *data() const {
+		return buf_;
+	}
+
+	size_t size() const {
+		return len_;
+	}
+
+protected:
+	char *buf_;
+	size_t len_;
+	bool mapped_;
+};
+
+/**
+ * Iterates over the lines of a file.  Regular files are mapped into memory
+ * and lines are returned as pointers into the mapping, so no copying is
+ * done.  Other files are read with fgets into the caller's buffer, in which
+ * case lines are limited to bufsz-1 characters.
+ */
+class LineReader {
+public:
+	LineReader(FILE *fh, char *buf, size_t bufsz) :
+		fh_(fh),
+		buf_(buf),
+		bufsz_(bufsz),
+		cur_(NULL),
+		end_(NULL)
+	{
+		if(mf_.map(fh, false)) {
+			cur_ = mf_.data();
+			end_ = cur_ + mf_.size();
+		}
+	}
+
+	/**
+	 * Set line to point to the next line and len to its length, including
+	 * the newline if there is one.  The line is not necessarily
+	 * NUL-terminated.  Returns false if there are no more lines.
+	 */
+	bool next(const char *& line, size_t& len) {
+		if(cur_ != NULL) {
+			if(cur_ == end_) {
+				return false;
+			}
+			const char *nl = (const char *)memchr(cur_, '\n', end_ - cur_);
+			line = cur_;
+			cur_ = (nl == NULL) ? end_ : nl + 1;
+			len = cur_ - line;
+			return true;
+		}
+		if(fgets(buf_, (int)bufsz_, fh_) == NULL) {
+			return false;
+		}
+		line = buf_;
+		len = strlen(buf_);
+		return true;
+	}
+
+	bool mapped() const {
+		return cur_ != NULL;
+	}
+
+protected:
+	FILE *fh_;
+	char *buf_;
+	size_t bufsz_;
+	MappedFile mf_;
+	const char *cur_;
+	const char *end_;
+};
+
+/**
+ * Reads a text file in large blocks that always end on a line boundary, so
+ * that each block can be handed to a different thread.  Optionally, blocks
+ * are only cut where the first tab-delimited field changes between lines,
+ * which keeps all the SAM records for a read (e.g. both mates) in the same
+ * block.
+ */
+class LineBlockReader {
+public:
+	LineBlockReader(
+		FILE *fh,
+		size_t blocksz,
+		bool keep_qnames_together) :
+		fh_(fh),
+		blocksz_(blocksz),
+		keep_qnames_(keep_qnames_together),
+		eof_(false),
+		mem_(NULL),
+		memlen_(0) { }
+
+	/**
+	 * Split an in-memory buffer, e.g. a MappedFile, into blocks rather than
+	 * reading from a file.  Blocks then point into the buffer.
+	 */
+	LineBlockReader(
+		char *buf,
+		size_t len,
+		size_t blocksz,
+		bool keep_qnames_together) :
+		fh_(NULL),
+		blocksz_(blocksz),
+		keep_qnames_(keep_qnames_together),
+		eof_(false),
+		mem_(buf),
+		memlen_(len) { }
+
+	/**
+	 * Fill blk with the next block.  The block ends with a newline.  Returns
+	 * false if there's no more input.
+	 */
+	bool next(std::vector<char>& blk);
+
+	/**
+	 * Set blk and len to the next block, which ends with a newline.  When
+	 * splitting an in-memory buffer, blk points into it; otherwise the block
+	 * is read into storage.  Returns false if there's no more input.
+	 */
+	bool next(std::vector<char>& storage, char *& blk, size_t& len);
+
+	/**
+	 * Return true iff the file is exhausted and no input is left over.
+	 */
+	bool done() const {
+		if(fh_ == NULL) {
+			return memlen_ == 0;
+		}
+		return eof_ && carry_.empty();
+	}
+
+protected:
+
+	/**
+	 * Return the offset just past the last newline in buf where the block
+	 * can be cut, or 0 if there's no such place.
+	 */
+	size_t find_cut(const char *buf, size_t len) const;
+
+	FILE *fh_;
+	size_t blocksz_;
+	bool keep_qnames_;
+	bool eof_;
+	std::vector<char> carry_; // input read but not yet returned
+	char *mem_;               // in-memory buffer not yet returned
+	size_t memlen_;
+};
+
+#endif /* defined(__qtip__blockio__) */
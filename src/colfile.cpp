@@ -0,0 +1,551 @@
+//
+//  colfile.cpp
+//  qtip
+//
+//  Copyright (c) 2016 JHU. All rights reserved.
+//
+
+#include "colfile.h"
+#include <iostream>
+#include <cassert>
+#include <cmath>
+#include <limits>
+#include <algorithm>
+#include <stdint.h>
+#include <string.h>
+
+using namespace std;
+
+const char *col_type_name(int typ) {
+	switch(typ) {
+		case COL_U8: return "<u8";
+		case COL_I4: return "<i4";
+		case COL_I2: return "<i2";
+		case COL_I1: return "<i1";
+		case COL_F4: return "<f4";
+		default: assert(false);
+	}
+	return NULL;
+}
+
+size_t col_type_size(int typ) {
+	switch(typ) {
+		case COL_U8: return 8;
+		case COL_I4: return 4;
+		case COL_I2: return 2;
+		case COL_I1: return 1;
+		case COL_F4: return 4;
+		default: assert(false);
+	}
+	return 0;
+}
+
+void record_col_types(bool paired, int n_ztz_fields, std::vector<int>& typs) {
+	typs.clear();
+	typs.push_back(COL_U8); // id
+	typs.push_back(COL_I4); // len
+	typs.push_back(COL_I4); // clip
+	typs.push_back(COL_F4); // alqual
+	typs.push_back(COL_F4); // clipqual
+	if(!paired) {
+		typs.push_back(COL_I4); // olen
+	}
+	typs.insert(typs.end(), n_ztz_fields, COL_F4);
+	if(paired) {
+		typs.push_back(COL_I4); // olen
+		typs.push_back(COL_I4); // oclip
+		typs.push_back(COL_F4); // oalqual
+		typs.push_back(COL_F4); // oclipqual
+		typs.push_back(COL_F4); // fraglen
+		typs.insert(typs.end(), n_ztz_fields, COL_F4);
+	}
+	typs.push_back(COL_I2); // mapq
+	typs.push_back(COL_I1); // correct
+}
+
+double col_stored_value(int typ, double v) {
+	switch(typ) {
+		case COL_U8: return (double)(uint64_t)v;
+		case COL_I4: return (double)(int32_t)v;
+		case COL_I2: return (double)(int16_t)v;
+		case COL_I1: return (double)(int8_t)v;
+		case COL_F4: return (double)(float)v;
+		default: assert(false);
+	}
+	return 0.0;
+}
+
+void record_col_names(bool paired, int n_ztz_fields, std::vector<std::string>& names) {
+	const char *fixed[] = {"id", "len", "clip", "alqual", "clipqual"};
+	names.assign(fixed, fixed + 5);
+	char buf[64];
+	if(!paired) {
+		names.push_back("olen");
+		for(int i = 0; i < n_ztz_fields; i++) {
+			snprintf(buf, 64, "ztz%d", i);
+			names.push_back(buf);
+		}
+	} else {
+		for(int i = 0; i < n_ztz_fields; i++) {
+			snprintf(buf, 64, "ztz_%d", i);
+			names.push_back(buf);
+		}
+		const char *ofixed[] = {"olen", "oclip", "oalqual", "oclipqual", "fraglen"};
+		names.insert(names.end(), ofixed, ofixed + 5);
+		for(int i = 0; i < n_ztz_fields; i++) {
+			snprintf(buf, 64, "oztz_%d", i);
+			names.push_back(buf);
+		}
+	}
+	names.push_back("mapq");
+	names.push_back("correct");
+}
+
+/**
+ * Convert column j of nrow row-major records with ncol columns to type typ
+ * and pack it into dst.  Update the column's minimum, maximum and NaN count
+ * with the converted values.
+ */
+template<typename T>
+static void pack_column(
+	const double *recs,
+	size_t nrow,
+	size_t ncol,
+	size_t j,
+	char *dst,
+	double& mn,
+	double& mx,
+	unsigned long long& nnan)
+{
+	T *d = (T *)dst;
+	for(size_t i = 0; i < nrow; i++) {
+		d[i] = (T)recs[i * ncol + j];
+		double v = (double)d[i];
+		if(std::isnan(v)) {
+			nnan++;
+		} else {
+			mn = min(mn, v);
+			mx = max(mx, v);
+		}
+	}
+}
+
+/**
+ * Pack nrow ids into dst, updating their minimum and maximum.
+ */
+static void pack_id_column(
+	const uint64_t *ids,
+	size_t nrow,
+	char *dst,
+	double& mn,
+	double& mx)
+{
+	memcpy(dst, ids, nrow * sizeof(uint64_t));
+	for(size_t i = 0; i < nrow; i++) {
+		mn = min(mn, (double)ids[i]);
+		mx = max(mx, (double)ids[i]);
+	}
+}
+
+/**
+ * FNV-1a hash of n bytes.
+ */
+static size_t hash_bytes(const char *b, size_t n) {
+	uint64_t h = 14695981039346656037ULL;
+	for(size_t i = 0; i < n; i++) {
+		h ^= (unsigned char)b[i];
+		h *= 1099511628211ULL;
+	}
+	return (size_t)h;
+}
+
+int ColumnarWriter::add(const uint64_t *ids, const double *recs, size_t nrec, size_t ncol) {
+	if(nrec == 0) {
+		return 0;
+	}
+	if(ncol_ == 0) {
+		// # columns excluding the id
+		size_t nfixed = paired_ ? 11 : 7;
+		size_t nztz = paired_ ? (ncol - nfixed) / 2 : ncol - nfixed;
+		record_col_types(paired_, (int)nztz, typs_);
+		if(ncol < nfixed || typs_.size() != ncol + 1) {
+			cerr << "Unexpected number of feature record columns: " << ncol + 1 << endl;
+			return -1;
+		}
+		ncol_ = ncol;
+		if(dedup()) {
+			typs_.push_back(COL_I4); // weight
+		}
+		nout_ = typs_.size();
+		ids_.resize(ROW_GROUP);
+		buf_.resize(ROW_GROUP * (nout_ - 1));
+		min_.resize(nout_, numeric_limits<double>::infinity());
+		max_.resize(nout_, -numeric_limits<double>::infinity());
+		nnan_.resize(nout_, 0);
+	}
+	assert(ncol == ncol_);
+	nrec_ += nrec;
+	if(dedup()) {
+		return add_dedup(ids, recs, nrec);
+	}
+	while(nrec > 0) {
+		size_t n = min(nrec, ROW_GROUP - nbuf_);
+		memcpy(&ids_[nbuf_], ids, n * sizeof(uint64_t));
+		memcpy(&buf_[nbuf_ * ncol_], recs, n * ncol_ * sizeof(double));
+		nbuf_ += n;
+		nrow_ += n;
+		ids += n;
+		recs += n * ncol_;
+		nrec -= n;
+		if(nbuf_ == ROW_GROUP && write_group() != 0) {
+			return -1;
+		}
+	}
+	return 0;
+}
+
+size_t ColumnarWriter::find_or_add_row(uint64_t id) {
+	if(2 * (nrow_ + 1) > slots_.size()) {
+		// grow and rehash, keeping the table at most half full
+		slots_.assign(max((size_t)1024, slots_.size() * 2), 0);
+		size_t mask = slots_.size() - 1;
+		for(size_t r = 0; r < nrow_; r++) {
+			size_t i = hash_bytes((const char *)&uniq_[r * ncol_], ncol_ * sizeof(double)) & mask;
+			while(slots_[i] != 0) {
+				i = (i + 1) & mask;
+			}
+			slots_[i] = r + 1;
+		}
+	}
+	size_t nbytes = ncol_ * sizeof(double);
+	size_t mask = slots_.size() - 1;
+	size_t i = hash_bytes((const char *)&row_[0], nbytes) & mask;
+	while(slots_[i] != 0) {
+		size_t r = slots_[i] - 1;
+		if(memcmp(&uniq_[r * ncol_], &row_[0], nbytes) == 0) {
+			return r;
+		}
+		i = (i + 1) & mask;
+	}
+	slots_[i] = (size_t)nrow_ + 1;
+	uniq_.insert(uniq_.end(), row_.begin(), row_.end());
+	uniq_ids_.push_back(id);
+	weight_.push_back(0.0);
+	return (size_t)nrow_++;
+}
+
+int ColumnarWriter::add_dedup(const uint64_t *ids, const double *recs, size_t nrec) {
+	row_.resize(ncol_);
+	idmap_buf_.resize(nrec * 12);
+	char *idm = &idmap_buf_[0];
+	for(size_t i = 0; i < nrec; i++) {
+		const double *rec = recs + i * ncol_;
+		for(size_t j = 0; j < ncol_; j++) {
+			row_[j] = col_stored_value(typs_[j + 1], rec[j]);
+		}
+		size_t r = find_or_add_row(ids[i]);
+		weight_[r] += 1.0;
+		uint32_t r32 = (uint32_t)r;
+		memcpy(idm, &ids[i], 8);
+		memcpy(idm + 8, &r32, 4);
+		idm += 12;
+	}
+	if(fwrite(&idmap_buf_[0], 12, nrec, idmap_fh_) != nrec) {
+		cerr << "Could not write feature record id map" << endl;
+		return -1;
+	}
+	return 0;
+}
+
+int ColumnarWriter::finish() {
+	if(dedup()) {
+		// all the distinct rows are known, so write them with their weights
+		assert(nbuf_ == 0);
+		for(size_t r = 0; r < nrow_; r++) {
+			ids_[nbuf_] = uniq_ids_[r];
+			memcpy(&buf_[nbuf_ * (ncol_ + 1)], &uniq_[r * ncol_], ncol_ * sizeof(double));
+			buf_[nbuf_ * (ncol_ + 1) + ncol_] = weight_[r];
+			nbuf_++;
+			if(nbuf_ == ROW_GROUP && write_group() != 0) {
+				return -1;
+			}
+		}
+		uniq_.clear();
+		uniq_ids_.clear();
+		weight_.clear();
+		slots_.clear();
+	}
+	return nbuf_ > 0 ? write_group() : 0;
+}
+
+int ColumnarWriter::write_group() {
+	colbuf_.resize(nbuf_ * 8);
+	// buf_ holds every column but the id, which is in ids_
+	size_t nval = nout_ - 1;
+	for(size_t j = 0; j < nout_; j++) {
+		char *dst = &colbuf_[0];
+		const double *src = &buf_[0];
+		double& mn = min_[j];
+		double& mx = max_[j];
+		unsigned long long& nnan = nnan_[j];
+		switch(typs_[j]) {
+			case COL_U8: assert(j == 0); pack_id_column(&ids_[0], nbuf_, dst, mn, mx); break;
+			case COL_I4: pack_column<int32_t>(src, nbuf_, nval, j - 1, dst, mn, mx, nnan); break;
+			case COL_I2: pack_column<int16_t>(src, nbuf_, nval, j - 1, dst, mn, mx, nnan); break;
+			case COL_I1: pack_column<int8_t>(src, nbuf_, nval, j - 1, dst, mn, mx, nnan); break;
+			case COL_F4: pack_column<float>(src, nbuf_, nval, j - 1, dst, mn, mx, nnan); break;
+			default: assert(false);
+		}
+		size_t sz = col_type_size(typs_[j]);
+		if(fwrite(dst, sz, nbuf_, fh_) != nbuf_) {
+			cerr << "Could not write feature records" << endl;
+			return -1;
+		}
+	}
+	nbuf_ = 0;
+	return 0;
+}
+
+void ColumnarWriter::print_stats(FILE *fh) const {
+	assert(nbuf_ == 0);
+	const char *names[] = {"min", "max"};
+	const std::vector<double> *vals[] = {&min_, &max_};
+	for(int k = 0; k < 2; k++) {
+		fprintf(fh, "%s", names[k]);
+		for(size_t j = 0; j < nout_; j++) {
+			if(nnan_[j] == nrow_) {
+				fprintf(fh, ",nan");
+			} else {
+				fprintf(fh, ",%.17g", (*vals[k])[j]);
+			}
+		}
+		fprintf(fh, "\n");
+	}
+	fprintf(fh, "nans");
+	for(size_t j = 0; j < nout_; j++) {
+		fprintf(fh, ",%llu", nnan_[j]);
+	}
+	fprintf(fh, "\n");
+}
+
+#ifdef COLFILE_MAIN
+
+#include <string>
+
+/**
+ * Read back value of column j, row i from a file written by ColumnarWriter.
+ */
+static double read_back(FILE *fh, const vector<int>& typs, unsigned long long nrow, size_t i, size_t j) {
+	size_t rowsz = 0;
+	for(size_t k = 0; k < typs.size(); k++) {
+		rowsz += col_type_size(typs[k]);
+	}
+	size_t g = i / ColumnarWriter::ROW_GROUP;
+	size_t grows = min((unsigned long long)ColumnarWriter::ROW_GROUP, nrow - g * ColumnarWriter::ROW_GROUP);
+	size_t off = g * ColumnarWriter::ROW_GROUP * rowsz;
+	for(size_t k = 0; k < j; k++) {
+		off += grows * col_type_size(typs[k]);
+	}
+	off += (i % ColumnarWriter::ROW_GROUP) * col_type_size(typs[j]);
+	fseek(fh, (long)off, SEEK_SET);
+	char b[8];
+	size_t nread = fread(b, 1, col_type_size(typs[j]), fh);
+	assert(nread == col_type_size(typs[j]));
+	switch(typs[j]) {
+		case COL_U8: return (double)*(uint64_t *)b;
+		case COL_I4: return (double)*(int32_t *)b;
+		case COL_I2: return (double)*(int16_t *)b;
+		case COL_I1: return (double)*(int8_t *)b;
+		case COL_F4: return (double)*(float *)b;
+	}
+	return 0.0;
+}
+
+static void test1() {
+	const char *fn = ".colfile.test1.bin";
+	for(int paired = 0; paired < 2; paired++) {
+		int nztz = 3;
+		vector<int> typs;
+		record_col_types(paired == 1, nztz, typs);
+		size_t ncol = typs.size();
+		assert(ncol == (paired ? 12 + 2 * 3 : 8 + 3));
+		assert(typs[0] == COL_U8);
+		assert(typs[ncol-2] == COL_I2);
+		assert(typs[ncol-1] == COL_I1);
+		vector<string> names;
+		record_col_names(paired == 1, nztz, names);
+		assert(names.size() == ncol);
+		assert(names[0] == "id");
+		assert(names[ncol-2] == "mapq");
+		assert(names[paired ? 5 : 6] == (paired ? "ztz_0" : "ztz0"));
+		size_t nrow = ColumnarWriter::ROW_GROUP * 2 + 100, nval = ncol - 1;
+		vector<uint64_t> ids(nrow);
+		vector<double> recs(nrow * nval);
+		for(size_t i = 0; i < nrow; i++) {
+			ids[i] = (i * 7) % 1000;
+			for(size_t j = 1; j < ncol; j++) {
+				recs[i * nval + j - 1] = (j == ncol - 1) ? (double)(i % 3) - 1.0 : (double)((i * 7 + j) % 1000);
+			}
+		}
+		FILE *fh = fopen(fn, "wb");
+		ColumnarWriter w(fh, paired == 1);
+		// add in uneven batches
+		size_t i = 0, batch = 1;
+		while(i < nrow) {
+			size_t n = min(batch, nrow - i);
+			assert(w.add(&ids[i], &recs[i * nval], n, nval) == 0);
+			i += n;
+			batch = batch * 3 + 1;
+		}
+		assert(w.finish() == 0);
+		assert(w.nrow() == nrow);
+		fclose(fh);
+		fh = fopen(fn, "rb");
+		size_t rows[] = {0, 1, ColumnarWriter::ROW_GROUP - 1, ColumnarWriter::ROW_GROUP, nrow - 1};
+		for(size_t r = 0; r < 5; r++) {
+			assert(read_back(fh, typs, nrow, rows[r], 0) == (double)ids[rows[r]]);
+			for(size_t j = 1; j < ncol; j++) {
+				assert(read_back(fh, typs, nrow, rows[r], j) == recs[rows[r] * nval + j - 1]);
+			}
+		}
+		fclose(fh);
+	}
+	remove(fn);
+}
+
+static void test2() {
+	const char *fn = ".colfile.test2.bin";
+	const char *meta_fn = ".colfile.test2.meta";
+	vector<int> typs;
+	record_col_types(false, 2, typs);
+	size_t nval = typs.size() - 1, nrow = 5;
+	vector<uint64_t> ids(nrow);
+	vector<double> recs(nrow * nval, 1.0);
+	double nan = numeric_limits<double>::quiet_NaN();
+	for(size_t i = 0; i < nrow; i++) {
+		ids[i] = i + 10;
+		recs[i * nval + 2] = 0.1 * (double)i;          // alqual
+		recs[i * nval + 5] = (i % 2 == 0) ? nan : -3.0; // ztz0
+		recs[i * nval + 6] = nan;                      // ztz1
+	}
+	FILE *fh = fopen(fn, "wb");
+	ColumnarWriter w(fh, false);
+	assert(w.add(&ids[0], &recs[0], nrow, nval) == 0);
+	assert(w.finish() == 0);
+	fclose(fh);
+	FILE *meta_fh = fopen(meta_fn, "wb");
+	w.print_stats(meta_fh);
+	fclose(meta_fh);
+	meta_fh = fopen(meta_fn, "rb");
+	char buf[1024];
+	string lines[3];
+	for(int k = 0; k < 3; k++) {
+		assert(fgets(buf, 1024, meta_fh) != NULL);
+		lines[k] = buf;
+	}
+	fclose(meta_fh);
+	// min,id,len,clip,alqual,clipqual,olen,ztz0,ztz1,mapq,correct
+	assert(lines[0].find("min,10,1,1,0,1,1,-3,nan,1,1\n") == 0);
+	assert(lines[1].find("max,14,1,1,0.40000000596046448,1,1,-3,nan,1,1\n") == 0);
+	assert(lines[2] == "nans,0,0,0,0,0,0,3,5,0,0\n");
+	remove(fn);
+	remove(meta_fn);
+}
+
+static void test3() {
+	const char *fn = ".colfile.test3.bin";
+	const char *idmap_fn = ".colfile.test3.idmap";
+	vector<int> typs;
+	record_col_types(false, 1, typs);
+	size_t ncol = typs.size(), nval = ncol - 1, nrow = ColumnarWriter::ROW_GROUP + 10;
+	// 3 distinct rows; alqual differs only beyond float precision between
+	// records 0 and 1, so they collapse
+	vector<uint64_t> ids(nrow);
+	vector<double> recs(nrow * nval, 0.0);
+	for(size_t i = 0; i < nrow; i++) {
+		ids[i] = i * 2;
+		recs[i * nval + 2] = (i % 3 == 0) ? 1.0 : ((i % 3 == 1) ? 1.0 + 1e-12 : 2.0);
+		recs[i * nval + 5] = (i % 3 == 2) ? 5.0 : 0.0;
+	}
+	FILE *fh = fopen(fn, "wb");
+	FILE *idmap_fh = fopen(idmap_fn, "wb");
+	ColumnarWriter w(fh, false, idmap_fh);
+	assert(w.dedup());
+	assert(w.add(&ids[0], &recs[0], 7, nval) == 0);
+	assert(w.add(&ids[7], &recs[7 * nval], nrow - 7, nval) == 0);
+	assert(w.finish() == 0);
+	fclose(fh);
+	fclose(idmap_fh);
+	assert(w.nrec() == nrow);
+	assert(w.nrow() == 2);
+	typs.push_back(COL_I4);
+	fh = fopen(fn, "rb");
+	assert(read_back(fh, typs, 2, 0, 0) == 0.0);
+	assert(read_back(fh, typs, 2, 1, 0) == 4.0);
+	assert(read_back(fh, typs, 2, 1, 6) == 5.0);
+	size_t n2 = nrow / 3; // # i with i % 3 == 2
+	assert(read_back(fh, typs, 2, 0, ncol) == (double)(nrow - n2));
+	assert(read_back(fh, typs, 2, 1, ncol) == (double)n2);
+	fclose(fh);
+	idmap_fh = fopen(idmap_fn, "rb");
+	for(size_t i = 0; i < nrow; i++) {
+		uint64_t id;
+		uint32_t row;
+		assert(fread(&id, 8, 1, idmap_fh) == 1);
+		assert(fread(&row, 4, 1, idmap_fh) == 1);
+		assert(id == i * 2);
+		assert(row == ((i % 3 == 2) ? 1 : 0));
+	}
+	fclose(idmap_fh);
+	remove(fn);
+	remove(idmap_fn);
+}
+
+static void test4() {
+	// ids too big for a double to hold exactly survive, with or without
+	// de-duplication
+	const char *fn = ".colfile.test4.bin";
+	const char *idmap_fn = ".colfile.test4.idmap";
+	vector<int> typs;
+	record_col_types(false, 0, typs);
+	size_t nval = typs.size() - 1;
+	uint64_t ids[] = {(1ULL << 53) + 1, 0xfffffffffffffffeULL};
+	vector<double> recs(2 * nval, 0.0);
+	for(int dedup = 0; dedup < 2; dedup++) {
+		FILE *fh = fopen(fn, "wb");
+		FILE *idmap_fh = dedup ? fopen(idmap_fn, "wb") : NULL;
+		ColumnarWriter w(fh, false, idmap_fh);
+		assert(w.add(ids, &recs[0], 2, nval) == 0);
+		assert(w.finish() == 0);
+		fclose(fh);
+		uint64_t got[2];
+		if(dedup) {
+			fclose(idmap_fh);
+			idmap_fh = fopen(idmap_fn, "rb");
+			for(int i = 0; i < 2; i++) {
+				uint32_t row;
+				assert(fread(&got[i], 8, 1, idmap_fh) == 1);
+				assert(fread(&row, 4, 1, idmap_fh) == 1);
+			}
+			fclose(idmap_fh);
+			assert(w.nrow() == 1);
+		} else {
+			fh = fopen(fn, "rb");
+			assert(fread(got, 8, 2, fh) == 2);
+			fclose(fh);
+		}
+		assert(got[0] == ids[0] && got[1] == ids[1]);
+	}
+	remove(fn);
+	remove(idmap_fn);
+}
+
+int main(void) {
+	test1();
+	test2();
+	test3();
+	test4();
+	cerr << "PASSED" << endl;
+}
+
+#endif
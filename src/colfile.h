@@ -0,0 +1,177 @@
+//
+//  colfile.h
+//  qtip
+//
+//  Copyright (c) 2016 JHU. All rights reserved.
+//
+
+#ifndef __qtip__colfile__
+#define __qtip__colfile__
+
+#include <stdio.h>
+#include <string.h>
+#include <stdint.h>
+#include <vector>
+#include <string>
+
+/**
+ * Types that columns of a feature-record file can be stored as.
+ */
+enum {
+	COL_U8 = 0, // 8-byte unsigned int; alignment ids
+	COL_I4,     // 4-byte signed int; lengths and clipping
+	COL_I2,     // 2-byte signed int; MAPQ
+	COL_I1,     // 1-byte signed int; correctness
+	COL_F4      // 4-byte float; everything else
+};
+
+/**
+ * Return numpy name for column type, e.g. "<u8".
+ */
+const char *col_type_name(int typ);
+
+/**
+ * Return size in bytes of column type.
+ */
+size_t col_type_size(int typ);
+
+/**
+ * Return v converted to column type typ and back, i.e. as it would be read
+ * back from a file.
+ */
+double col_stored_value(int typ, double v);
+
+/**
+ * Fill typs with the column types of an unpaired or paired feature record
+ * with n_ztz_fields ZT:Z values per mate, in the same order as the columns
+ * named in the record file's header.
+ */
+void record_col_types(bool paired, int n_ztz_fields, std::vector<int>& typs);
+
+/**
+ * Fill names with the column names of an unpaired or paired feature record
+ * with n_ztz_fields ZT:Z values per mate, as in the record file's header.
+ */
+void record_col_names(bool paired, int n_ztz_fields, std::vector<std::string>& names);
+
+/**
+ * Destination for feature records.  A record is an alignment id, which can
+ * be too big for a double to hold exactly, plus a row of doubles holding
+ * the record's other columns.
+ */
+class RecordWriter {
+public:
+	virtual ~RecordWriter() { }
+
+	/**
+	 * Add nrec records: ids[i] is the id of record i and recs holds their
+	 * rows of ncol values each, laid out one after another.
+	 */
+	virtual int add(const uint64_t *ids, const double *recs, size_t nrec, size_t ncol) = 0;
+};
+
+/**
+ * Writes feature records in a columnar layout.  Records are gathered into
+ * row groups of ROW_GROUP rows each.  A full group is written one column
+ * after another, each column packed with its own type.  Only the final
+ * group may be short, so the offset of any column in any group can be
+ * computed from the row count and column types alone.
+ *
+ * If given an id-map file, the writer instead de-duplicates records: only
+ * the first record with a given combination of values (in every column but
+ * the id, as stored) becomes a row, and an extra "weight" column gives the
+ * number of records that row stands for.  For every record, the id-map
+ * file gets the record's id (8 bytes) and the index of its row (4 bytes).
+ * Rows are held in memory and written by finish().
+ */
+class ColumnarWriter : public RecordWriter {
+public:
+
+	static const size_t ROW_GROUP = 65536;
+
+	ColumnarWriter(FILE *fh, bool paired, FILE *idmap_fh = NULL) :
+		fh_(fh),
+		paired_(paired),
+		idmap_fh_(idmap_fh),
+		ncol_(0),
+		nout_(0),
+		nbuf_(0),
+		nrow_(0),
+		nrec_(0) { }
+
+	/**
+	 * Add nrec records, each an id and ncol values, as for RecordWriter.
+	 * The first call fixes the number of columns, and with it the number
+	 * of ZT:Z fields and so the column types.
+	 */
+	int add(const uint64_t *ids, const double *recs, size_t nrec, size_t ncol);
+
+	/**
+	 * Write records not yet written as a final, possibly short, group.
+	 */
+	int finish();
+
+	/**
+	 * Return # rows in the table, which is less than the # records added
+	 * if de-duplicating.
+	 */
+	unsigned long long nrow() const {
+		return nrow_;
+	}
+
+	unsigned long long nrec() const {
+		return nrec_;
+	}
+
+	bool dedup() const {
+		return idmap_fh_ != NULL;
+	}
+
+	size_t ncol() const {
+		return ncol_;
+	}
+
+	/**
+	 * Print lines with the minimum, maximum and number of NaNs in each
+	 * column, as stored (i.e. after conversion to the column's type), to
+	 * the metadata file.  A column with no non-NaN values has NaN as its
+	 * minimum and maximum.  Call after finish().
+	 */
+	void print_stats(FILE *fh) const;
+
+protected:
+
+	int write_group();
+
+	int add_dedup(const uint64_t *ids, const double *recs, size_t nrec);
+
+	/**
+	 * Return index of the row equal to row_, adding row_ as a new row
+	 * with id id if there isn't one.
+	 */
+	size_t find_or_add_row(uint64_t id);
+
+	FILE *fh_;
+	bool paired_;
+	FILE *idmap_fh_;
+	size_t ncol_;                // # values per record, excl. id
+	size_t nout_;                // # columns written, incl. id and weight
+	std::vector<int> typs_;
+	std::vector<uint64_t> ids_;  // ids of current group
+	std::vector<double> buf_;    // row-major values of current group, excl. id
+	size_t nbuf_;                // # records in current group
+	std::vector<char> colbuf_;   // one packed column
+	unsigned long long nrow_;    // # rows in table
+	unsigned long long nrec_;    // # records added
+	std::vector<double> row_;    // record being de-duplicated, as stored
+	std::vector<double> uniq_;   // row-major distinct rows, excl. id
+	std::vector<uint64_t> uniq_ids_; // id of first record per distinct row
+	std::vector<double> weight_; // # records per distinct row
+	std::vector<size_t> slots_;  // hash table of 1 + row index; 0 = empty
+	std::vector<char> idmap_buf_;
+	std::vector<double> min_;    // per-column minimum of non-NaN values
+	std::vector<double> max_;    // per-column maximum of non-NaN values
+	std::vector<unsigned long long> nnan_; // per-column # NaNs
+};
+
+#endif /* defined(__qtip__colfile__) */
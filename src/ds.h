@@ -453,6 +453,15 @@ public:
 		return n_;
 	}
 	
+	/**
+	 * Set the number of items added, e.g. when restoring a sample that was
+	 * saved along with its count.
+	 */
+	void set_size(size_t n) {
+		assert(n >= list_.size());
+		n_ = n;
+	}
+
 	/**
 	 * Return true iff no items have yet been added.
 	 */
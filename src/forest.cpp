@@ -0,0 +1,411 @@
+//
+//  forest.cpp
+//  qtip
+//
+//  Copyright (c) 2016 JHU. All rights reserved.
+//
+
+#include "forest.h"
+#include <iostream>
+#include <cassert>
+#include <cmath>
+#include <limits>
+#include <string.h>
+#include <stdint.h>
+
+using namespace std;
+
+double Forest::predict(const float *x) const {
+	double sum = (kind == FOREST_BOOSTED) ? base : 0.0;
+	const size_t nt = roots_.size();
+	for(size_t t = 0; t < nt; t++) {
+		int i = roots_[t];
+		while(left_[i] >= 0) {
+			i = ((double)x[feature_[i]] <= threshold_[i]) ? left_[i] : right_[i];
+		}
+		if(kind == FOREST_BOOSTED) {
+			sum += scale * value_[i];
+		} else {
+			sum += value_[i];
+		}
+	}
+	if(kind == FOREST_MEAN && nt > 0) {
+		sum /= nt;
+	}
+	return sum;
+}
+
+/**
+ * Read n items of type T from fh, appending them to v.
+ */
+template<typename T>
+static bool read_array(FILE *fh, size_t n, vector<T>& v) {
+	size_t off = v.size();
+	v.resize(off + n);
+	return n == 0 || fread(&v[off], sizeof(T), n, fh) == n;
+}
+
+template<typename T>
+static bool read_one(FILE *fh, T& t) {
+	return fread(&t, sizeof(T), 1, fh) == 1;
+}
+
+int Forest::read(FILE *fh) {
+	uint32_t cat = 0, knd = 0, nfeat = 0, nt = 0;
+	if(!read_one(fh, cat) || !read_one(fh, knd) || !read_one(fh, nfeat)) {
+		cerr << "Error: could not read forest header" << endl;
+		return -1;
+	}
+	if(knd != FOREST_MEAN && knd != FOREST_BOOSTED) {
+		cerr << "Error: unknown kind of forest: " << knd << endl;
+		return -1;
+	}
+	category = (char)cat;
+	kind = (int)knd;
+	features.clear();
+	for(uint32_t i = 0; i < nfeat; i++) {
+		uint32_t len = 0;
+		vector<char> name;
+		if(!read_one(fh, len) || !read_array(fh, len, name)) {
+			cerr << "Error: could not read forest feature names" << endl;
+			return -1;
+		}
+		features.push_back(string(name.begin(), name.end()));
+	}
+	if(!read_one(fh, base) || !read_one(fh, scale) || !read_one(fh, nt)) {
+		cerr << "Error: could not read forest header" << endl;
+		return -1;
+	}
+	roots_.clear();
+	feature_.clear(); threshold_.clear();
+	left_.clear(); right_.clear(); value_.clear();
+	for(uint32_t t = 0; t < nt; t++) {
+		uint32_t nnode = 0;
+		int root = (int)feature_.size();
+		if(!read_one(fh, nnode) ||
+		   !read_array(fh, nnode, feature_) ||
+		   !read_array(fh, nnode, threshold_) ||
+		   !read_array(fh, nnode, left_) ||
+		   !read_array(fh, nnode, right_) ||
+		   !read_array(fh, nnode, value_))
+		{
+			cerr << "Error: could not read tree " << t << " of forest for category "
+			     << category << endl;
+			return -1;
+		}
+		if(nnode == 0) {
+			cerr << "Error: empty tree in forest for category " << category << endl;
+			return -1;
+		}
+		// make child indexes absolute
+		for(size_t i = root; i < feature_.size(); i++) {
+			if(left_[i] < 0) {
+				left_[i] = -1;
+				continue;
+			}
+			if(left_[i] >= (int)nnode || right_[i] < 0 || right_[i] >= (int)nnode ||
+			   feature_[i] < 0 || feature_[i] >= (int)nfeat)
+			{
+				cerr << "Error: bad node in tree " << t << " of forest for category "
+				     << category << endl;
+				return -1;
+			}
+			left_[i] += root;
+			right_[i] += root;
+		}
+		roots_.push_back(root);
+	}
+	return 0;
+}
+
+int load_forests(const string& fn, vector<Forest>& forests) {
+	FILE *fh = fopen(fn.c_str(), "rb");
+	if(fh == NULL) {
+		cerr << "Could not open model file \"" << fn << "\"" << endl;
+		return -1;
+	}
+	char magic[8];
+	uint32_t ncat = 0;
+	if(fread(magic, 1, 8, fh) != 8 || memcmp(magic, "QTIPFOR1", 8) != 0 || !read_one(fh, ncat)) {
+		cerr << "Error: \"" << fn << "\" is not a qtip model file" << endl;
+		fclose(fh);
+		return -1;
+	}
+	forests.clear();
+	forests.resize(ncat);
+	for(uint32_t i = 0; i < ncat; i++) {
+		if(forests[i].read(fh) != 0) {
+			fclose(fh);
+			return -1;
+		}
+	}
+	fclose(fh);
+	return 0;
+}
+
+int ForestEvaluator::add(const uint64_t *ids, const double *recs, size_t nrec, size_t ncol) {
+	if(nrec == 0) {
+		return 0;
+	}
+	if(forest_ == NULL) {
+		cerr << "Error: no model for " << (paired_ ? "paired" : "unpaired")
+		     << " alignments in this category" << endl;
+		return -1;
+	}
+	if(ncol_ == 0) {
+		// work out which record column holds each feature; column 0 is
+		// the id, which isn't among the values
+		size_t nfixed = paired_ ? 11 : 7;
+		vector<string> names;
+		vector<int> typs;
+		if(ncol >= nfixed) {
+			size_t nztz = paired_ ? (ncol - nfixed) / 2 : ncol - nfixed;
+			record_col_names(paired_, (int)nztz, names);
+			record_col_types(paired_, (int)nztz, typs);
+		}
+		if(names.size() != ncol + 1) {
+			cerr << "Unexpected number of feature record columns: " << ncol + 1 << endl;
+			return -1;
+		}
+		const vector<string>& fs = forest_->features;
+		for(size_t j = 0; j < fs.size(); j++) {
+			size_t c = 1;
+			while(c <= ncol && names[c] != fs[j]) {
+				c++;
+			}
+			if(c > ncol) {
+				cerr << "Error: model feature \"" << fs[j]
+				     << "\" is not among the feature record columns" << endl;
+				return -1;
+			}
+			cols_.push_back(c - 1);
+			typs_.push_back(typs[c]);
+		}
+		x_.resize(fs.size());
+		max_.resize(fs.size(), numeric_limits<double>::quiet_NaN());
+		ncol_ = ncol;
+	}
+	assert(ncol == ncol_);
+	const size_t nfeat = cols_.size();
+	for(size_t i = 0; i < nrec; i++) {
+		const double *rec = recs + i * ncol;
+		bool has_nan = false;
+		for(size_t j = 0; j < nfeat; j++) {
+			double v = col_stored_value(typs_[j], rec[cols_[j]]);
+			if(std::isnan(v)) {
+				has_nan = true;
+			} else if(std::isnan(max_[j]) || v > max_[j]) {
+				max_[j] = v;
+			}
+			x_[j] = (float)v;
+		}
+		unsigned long long line = ids[i];
+		if(has_nan) {
+			deferred_.push_back(preds_.size());
+			for(size_t j = 0; j < nfeat; j++) {
+				deferred_x_.push_back(col_stored_value(typs_[j], rec[cols_[j]]));
+			}
+			preds_.push_back(Prediction(line, 0.0));
+		} else {
+			preds_.push_back(Prediction(line, forest_->predict(&x_[0])));
+		}
+	}
+	return 0;
+}
+
+/**
+ * Deal with probabilities of 1, which would give infinite MAPQs, then clamp
+ * to [0, max_pcor].  Same as fit.postprocess_predictions.
+ */
+static void postprocess_chunk(Prediction *ps, size_t n, double max_pcor) {
+	double mx = -numeric_limits<double>::infinity();
+	double max_noninf = -numeric_limits<double>::infinity();
+	for(size_t i = 0; i < n; i++) {
+		mx = max(mx, ps[i].mapq);
+		if(ps[i].mapq < 1.0) {
+			max_noninf = max(max_noninf, ps[i].mapq);
+		}
+	}
+	if(mx >= 1.0) {
+		if(max_noninf == -numeric_limits<double>::infinity()) {
+			cerr << "Warning: all data points in a chunk are predicted correct; "
+			     << "results unreliable" << endl;
+			for(size_t i = 0; i < n; i++) {
+				ps[i].mapq = max_pcor;
+			}
+		} else {
+			for(size_t i = 0; i < n; i++) {
+				if(ps[i].mapq >= 1.0) {
+					ps[i].mapq = max_noninf + 1e-6;
+				}
+			}
+		}
+	}
+	for(size_t i = 0; i < n; i++) {
+		ps[i].mapq = max(min(ps[i].mapq, max_pcor), 0.0);
+	}
+}
+
+int ForestEvaluator::finish(size_t chunk_rows, double max_pcor) {
+	const size_t nfeat = cols_.size();
+	for(size_t i = 0; i < deferred_.size(); i++) {
+		const double *v = &deferred_x_[i * nfeat];
+		for(size_t j = 0; j < nfeat; j++) {
+			double fill = std::isnan(max_[j]) ? 0.0 : max_[j] + 1;
+			x_[j] = (float)(std::isnan(v[j]) ? fill : v[j]);
+		}
+		preds_[deferred_[i]].mapq = forest_->predict(&x_[0]);
+	}
+	deferred_.clear();
+	deferred_x_.clear();
+	if(chunk_rows == 0) {
+		chunk_rows = preds_.size();
+	}
+	for(size_t i = 0; i < preds_.size(); i += chunk_rows) {
+		postprocess_chunk(&preds_[i], min(chunk_rows, preds_.size() - i), max_pcor);
+	}
+	// MAPQs are passed along as single-precision, as from fit.py
+	for(size_t i = 0; i < preds_.size(); i++) {
+		preds_[i].mapq = (float)fabs(-10.0 * log10(1.0 - preds_[i].mapq));
+	}
+	return 0;
+}
+
+#ifdef FOREST_MAIN
+
+/**
+ * Write a forest file with one category, 'u', whose two trees split on
+ * features clip and ztz0.  hi is the value of the first tree's left leaf.
+ */
+static void write_test_forest(const char *fn, uint32_t kind, double hi = 0.8) {
+	FILE *fh = fopen(fn, "wb");
+	assert(fh != NULL);
+	fwrite("QTIPFOR1", 1, 8, fh);
+	uint32_t ncat = 1, cat = 'u', nfeat = 2, nt = 2, nnode = 3;
+	fwrite(&ncat, 4, 1, fh);
+	fwrite(&cat, 4, 1, fh);
+	fwrite(&kind, 4, 1, fh);
+	fwrite(&nfeat, 4, 1, fh);
+	const char *names[] = {"clip", "ztz0"};
+	for(int i = 0; i < 2; i++) {
+		uint32_t len = (uint32_t)strlen(names[i]);
+		fwrite(&len, 4, 1, fh);
+		fwrite(names[i], 1, len, fh);
+	}
+	double base = 0.5, scale = 0.1;
+	fwrite(&base, 8, 1, fh);
+	fwrite(&scale, 8, 1, fh);
+	fwrite(&nt, 4, 1, fh);
+	for(uint32_t t = 0; t < nt; t++) {
+		int32_t feature[] = {(int32_t)t, -2, -2};
+		double threshold[] = {t == 0 ? 2.5 : 10.5, -2.0, -2.0};
+		int32_t left[] = {1, -1, -1};
+		int32_t right[] = {2, -1, -1};
+		double value[] = {t == 0 ? 0.2 : 0.4, t == 0 ? hi : 1.0, t == 0 ? 0.6 : 0.9};
+		fwrite(&nnode, 4, 1, fh);
+		fwrite(feature, 4, 3, fh);
+		fwrite(threshold, 8, 3, fh);
+		fwrite(left, 4, 3, fh);
+		fwrite(right, 4, 3, fh);
+		fwrite(value, 8, 3, fh);
+	}
+	fclose(fh);
+}
+
+/**
+ * Unpaired record with one ZT:Z field.
+ */
+static void push_record(vector<uint64_t>& ids, vector<double>& recs, uint64_t id, double clip, double ztz0) {
+	double rec[] = {100, clip, 0, 0, 0, ztz0, 30, -1};
+	ids.push_back(id);
+	recs.insert(recs.end(), rec, rec + 8);
+}
+
+static void test1() {
+	const char *fn = ".forest.test1.bin";
+	write_test_forest(fn, FOREST_MEAN);
+	vector<Forest> forests;
+	assert(load_forests(fn, forests) == 0);
+	assert(forests.size() == 1);
+	const Forest& f = forests[0];
+	assert(f.category == 'u');
+	assert(f.kind == FOREST_MEAN);
+	assert(f.ntree() == 2);
+	assert(f.features.size() == 2);
+	assert(f.features[1] == "ztz0");
+	float x[] = {2.0f, 20.0f};
+	assert(fabs(f.predict(x) - (0.8 + 0.9) / 2) < 1e-12);
+	x[0] = 3.0f; x[1] = 10.0f;
+	assert(fabs(f.predict(x) - (0.6 + 1.0) / 2) < 1e-12);
+
+	write_test_forest(fn, FOREST_BOOSTED);
+	assert(load_forests(fn, forests) == 0);
+	assert(forests[0].kind == FOREST_BOOSTED);
+	assert(fabs(forests[0].predict(x) - (0.5 + 0.1 * 0.6 + 0.1 * 1.0)) < 1e-12);
+	remove(fn);
+}
+
+static void test2() {
+	const char *fn = ".forest.test2.bin";
+	write_test_forest(fn, FOREST_MEAN);
+	vector<Forest> forests;
+	assert(load_forests(fn, forests) == 0);
+	ForestEvaluator ev(&forests[0], false);
+	vector<uint64_t> ids;
+	vector<double> recs;
+	push_record(ids, recs, 3, 2, 20);   // (0.8 + 0.9) / 2
+	push_record(ids, recs, 5, 3, 10);   // (0.6 + 1.0) / 2
+	push_record(ids, recs, 8, 3, NAN);  // ztz0 filled with 21: (0.6 + 0.9) / 2
+	push_record(ids, recs, 9, 2, 11);   // (0.8 + 0.9) / 2
+	assert(ev.add(&ids[0], &recs[0], 4, 8) == 0);
+	assert(ev.ndeferred() == 1);
+	assert(ev.finish(0) == 0);
+	const vector<Prediction>& ps = ev.predictions();
+	assert(ps.size() == 4);
+	assert(ps[0].line == 3 && ps[2].line == 8 && ps[3].line == 9);
+	double pcors[] = {0.85, 0.8, 0.75, 0.85};
+	for(int i = 0; i < 4; i++) {
+		assert(fabs(ps[i].mapq - (float)(-10.0 * log10(1.0 - pcors[i]))) < 1e-5);
+	}
+
+	// records laid out differently from the category's are an error
+	ForestEvaluator bad(&forests[0], true);
+	assert(bad.add(&ids[0], &recs[0], 1, 8) != 0);
+	ForestEvaluator none(NULL, false);
+	assert(none.add(&ids[0], &recs[0], 1, 8) != 0);
+	remove(fn);
+}
+
+static void test3() {
+	// probabilities of 1 are replaced one chunk at a time, then clamped
+	const char *fn = ".forest.test3.bin";
+	write_test_forest(fn, FOREST_MEAN, 1.0);
+	vector<Forest> forests;
+	assert(load_forests(fn, forests) == 0);
+	ForestEvaluator ev(&forests[0], false);
+	vector<uint64_t> ids;
+	vector<double> recs;
+	push_record(ids, recs, 1, 2, 10);  // 1.0
+	push_record(ids, recs, 2, 3, 10);  // 0.8
+	push_record(ids, recs, 3, 2, 10);  // 1.0
+	push_record(ids, recs, 4, 2, 20);  // 0.95
+	push_record(ids, recs, 5, 2, 10);  // 1.0, alone in its chunk
+	assert(ev.add(&ids[0], &recs[0], 5, 8) == 0);
+	assert(ev.finish(2) == 0);
+	const vector<Prediction>& ps = ev.predictions();
+	assert(ps.size() == 5);
+	double pcors[] = {0.800001, 0.8, 0.950001, 0.95, 0.999999};
+	for(int i = 0; i < 5; i++) {
+		assert(ps[i].mapq == (float)fabs(-10.0 * log10(1.0 - pcors[i])));
+	}
+	remove(fn);
+}
+
+int main(void) {
+	test1();
+	test2();
+	test3();
+	cerr << "PASSED" << endl;
+}
+
+#endif
@@ -0,0 +1,140 @@
+//
+//  forest.h
+//  qtip
+//
+//  Copyright (c) 2016 JHU. All rights reserved.
+//
+
+#ifndef __qtip__forest__
+#define __qtip__forest__
+
+#include <stdio.h>
+#include <vector>
+#include <string>
+#include "colfile.h"
+#include "predmerge.h"
+
+/**
+ * How a forest combines the values of its trees' leaves.
+ */
+enum {
+	FOREST_MEAN = 0,  // average, e.g. random forest or extra trees
+	FOREST_BOOSTED    // base + scale * sum, e.g. gradient boosting
+};
+
+/**
+ * A tree ensemble trained by fit.py and exported with
+ * MapqFit.export_forests, for one category of alignment.  Nodes of all the
+ * trees are stored in flat arrays; a node is a leaf iff its left child is
+ * -1.  Samples go left iff their value for the node's feature, as a float,
+ * is <= the node's threshold, as in scikit-learn.
+ *
+ * The file is little-endian and starts with "QTIPFOR1" and a uint32 number
+ * of categories.  Each category has uint32 category character, kind and
+ * number of features, then each feature name as a uint32 length and its
+ * bytes, then double base and scale and uint32 number of trees.  Each tree
+ * has a uint32 number of nodes n, then int32 feature[n], double
+ * threshold[n], int32 left[n], int32 right[n] and double value[n], with
+ * child indexes relative to the tree.
+ */
+class Forest {
+public:
+
+	Forest() : category(0), kind(FOREST_MEAN), base(0.0), scale(1.0) { }
+
+	/**
+	 * Return prediction for sample with feature values x, in the order of
+	 * features.
+	 */
+	double predict(const float *x) const;
+
+	size_t ntree() const {
+		return roots_.size();
+	}
+
+	/**
+	 * Read the next forest from fh.  Returns -1 on error.
+	 */
+	int read(FILE *fh);
+
+	char category;
+	int kind;
+	std::vector<std::string> features;
+	double base;
+	double scale;
+
+protected:
+
+	std::vector<int> roots_;     // index of each tree's root node
+	std::vector<int> feature_;
+	std::vector<double> threshold_;
+	std::vector<int> left_;      // -1 for leaves
+	std::vector<int> right_;
+	std::vector<double> value_;
+};
+
+/**
+ * Read all the forests from the file named fn.  Returns -1 on error.
+ */
+int load_forests(const std::string& fn, std::vector<Forest>& forests);
+
+/**
+ * Receives the feature records of one category of alignment, as written by
+ * qtip-parse, and predicts the probability each is correct with the
+ * category's forest.
+ *
+ * Feature values are first converted the way they are when the feature
+ * table is written and read back.  NaNs are replaced with 1 more than the
+ * greatest value of the feature over all records, or 0 if there isn't one,
+ * as when predicting from a table.  That value isn't known until every
+ * record has been seen, so records with NaNs are set aside and predicted by
+ * finish().
+ */
+class ForestEvaluator : public RecordWriter {
+public:
+
+	/**
+	 * forest may be NULL if there's no model for the category, in which
+	 * case it's an error to add records.
+	 */
+	ForestEvaluator(const Forest *forest, bool paired) :
+		forest_(forest),
+		paired_(paired),
+		ncol_(0) { }
+
+	int add(const uint64_t *ids, const double *recs, size_t nrec, size_t ncol);
+
+	/**
+	 * Predict for the records set aside, then turn probabilities into
+	 * MAPQs.  Like fit.py, probabilities of 1 are dealt with one chunk of
+	 * chunk_rows records at a time (all records at once if 0) and then all
+	 * are clamped to [0, max_pcor].
+	 */
+	int finish(size_t chunk_rows, double max_pcor = 0.999999);
+
+	/**
+	 * Predictions in ascending order by line; MAPQs once finished.
+	 */
+	const std::vector<Prediction>& predictions() const {
+		return preds_;
+	}
+
+	size_t ndeferred() const {
+		return deferred_.size();
+	}
+
+protected:
+
+	const Forest *forest_;
+	bool paired_;
+	size_t ncol_;
+	std::vector<size_t> cols_;       // index of each feature among record values
+	std::vector<int> typs_;          // type of each feature's column
+	std::vector<float> x_;
+	std::vector<double> max_;        // greatest non-NaN value per feature
+	std::vector<Prediction> preds_;  // holds probability until finish()
+	std::vector<size_t> deferred_;   // preds_ indexes of records with NaNs
+	std::vector<double> deferred_x_; // their feature values
+};
+
+#endif /* defined(__qtip__forest__) */
@@ -7,3 +7,387 @@
 //
 
 #include "input_model.h"
+#include <stdlib.h>
+#include <string.h>
+#include <cassert>
+#include <iostream>
+
+using namespace std;
+
+template<typename T>
+static void write_one(FILE *fh, T t) {
+	fwrite(&t, sizeof(T), 1, fh);
+}
+
+static void write_str(FILE *fh, const char *str) {
+	uint32_t len = (uint32_t)strlen(str);
+	write_one(fh, len);
+	fwrite(str, 1, len, fh);
+}
+
+template<typename T>
+static bool read_one(FILE *fh, T& t) {
+	return fread(&t, sizeof(T), 1, fh) == 1;
+}
+
+/**
+ * Read a string written by write_str into buf.
+ */
+static bool read_str(FILE *fh, string& buf) {
+	uint32_t len = 0;
+	if(!read_one(fh, len)) {
+		return false;
+	}
+	buf.resize(len);
+	return len == 0 || fread(&buf[0], 1, len, fh) == len;
+}
+
+/**
+ * Write an edit transcript as a uint32 number of runs of the same
+ * character, then each run's character and uint32 length.  Transcripts are
+ * mostly long runs of matches, so this is much smaller than the string.
+ */
+static void write_xscript(FILE *fh, const char *xscript) {
+	size_t len = strlen(xscript);
+	uint32_t nrun = 0;
+	for(size_t i = 0; i < len; i++) {
+		if(i == 0 || xscript[i] != xscript[i-1]) {
+			nrun++;
+		}
+	}
+	write_one(fh, nrun);
+	size_t i = 0;
+	while(i < len) {
+		size_t j = i + 1;
+		while(j < len && xscript[j] == xscript[i]) {
+			j++;
+		}
+		write_one(fh, xscript[i]);
+		write_one(fh, (uint32_t)(j - i));
+		i = j;
+	}
+}
+
+/**
+ * Read an edit transcript written by write_xscript into buf.
+ */
+static bool read_xscript(FILE *fh, string& buf) {
+	uint32_t nrun = 0;
+	if(!read_one(fh, nrun)) {
+		return false;
+	}
+	buf.clear();
+	for(uint32_t i = 0; i < nrun; i++) {
+		char c = 0;
+		uint32_t runlen = 0;
+		if(!read_one(fh, c) || !read_one(fh, runlen)) {
+			return false;
+		}
+		buf.append(runlen, c);
+	}
+	return true;
+}
+
+static void save_unpaired(
+	FILE *fh,
+	char cat,
+	const ReservoirSampledEList<TemplateUnpaired>& templates)
+{
+	const EList<TemplateUnpaired>& ts = templates.list();
+	write_one(fh, (uint32_t)cat);
+	write_one(fh, (uint64_t)templates.size());
+	write_one(fh, (uint64_t)ts.size());
+	for(size_t i = 0; i < ts.size(); i++) {
+		const TemplateUnpaired& t = ts[i];
+		write_one(fh, (int32_t)t.best_score_);
+		write_one(fh, (int32_t)t.len_);
+		write_one(fh, (int32_t)t.opp_len_);
+		write_one(fh, t.fw_flag_);
+		write_one(fh, t.mate_flag_);
+		write_str(fh, t.qual_);
+		write_xscript(fh, t.edit_xscript_);
+	}
+}
+
+static void save_paired(
+	FILE *fh,
+	char cat,
+	const ReservoirSampledEList<TemplatePaired>& templates)
+{
+	const EList<TemplatePaired>& ts = templates.list();
+	write_one(fh, (uint32_t)cat);
+	write_one(fh, (uint64_t)templates.size());
+	write_one(fh, (uint64_t)ts.size());
+	for(size_t i = 0; i < ts.size(); i++) {
+		const TemplatePaired& t = ts[i];
+		write_one(fh, (int32_t)t.score_12_);
+		write_one(fh, (int32_t)t.score_1_);
+		write_one(fh, (int32_t)t.len_1_);
+		write_one(fh, t.fw_flag_1_);
+		write_str(fh, t.qual_1_);
+		write_xscript(fh, t.edit_xscript_1_);
+		write_one(fh, (int32_t)t.score_2_);
+		write_one(fh, (int32_t)t.len_2_);
+		write_one(fh, t.fw_flag_2_);
+		write_str(fh, t.qual_2_);
+		write_xscript(fh, t.edit_xscript_2_);
+		write_one(fh, (char)(t.upstream1_ ? 1 : 0));
+		write_one(fh, (uint64_t)t.fraglen_);
+	}
+}
+
+int save_input_model(
+	const string& fn,
+	const ReservoirSampledEList<TemplateUnpaired>& u_templates,
+	const ReservoirSampledEList<TemplateUnpaired>& b_templates,
+	const ReservoirSampledEList<TemplatePaired>& c_templates,
+	const ReservoirSampledEList<TemplatePaired>& d_templates)
+{
+	FILE *fh = fopen(fn.c_str(), "wb");
+	if(fh == NULL) {
+		cerr << "Could not open output input-model file \"" << fn << "\"" << endl;
+		return -1;
+	}
+	fwrite("QTIPIMOD", 1, 8, fh);
+	write_one(fh, INPUT_MODEL_VERSION);
+	save_unpaired(fh, 'u', u_templates);
+	save_unpaired(fh, 'b', b_templates);
+	save_paired(fh, 'c', c_templates);
+	save_paired(fh, 'd', d_templates);
+	if(ferror(fh)) {
+		cerr << "Error writing input-model file \"" << fn << "\"" << endl;
+		fclose(fh);
+		return -1;
+	}
+	fclose(fh);
+	return 0;
+}
+
+/**
+ * Read a category's header and return the number of templates kept, or -1
+ * on error.  Sets n to the number offered.
+ */
+static long long load_category_header(FILE *fh, char cat, uint64_t& n) {
+	uint32_t c = 0;
+	uint64_t ntemplates = 0;
+	if(!read_one(fh, c) || !read_one(fh, n) || !read_one(fh, ntemplates)) {
+		cerr << "Error: input-model file ended before '" << cat << "' templates" << endl;
+		return -1;
+	}
+	if(c != (uint32_t)cat || ntemplates > n) {
+		cerr << "Error: bad header for '" << cat << "' templates in input-model file" << endl;
+		return -1;
+	}
+	return (long long)ntemplates;
+}
+
+static int load_unpaired(
+	FILE *fh,
+	char cat,
+	ReservoirSampledEList<TemplateUnpaired>& templates)
+{
+	uint64_t n = 0;
+	long long ntemplates = load_category_header(fh, cat, n);
+	if(ntemplates < 0) {
+		return -1;
+	}
+	string qual, xscript;
+	for(long long i = 0; i < ntemplates; i++) {
+		int32_t best_score = 0, len = 0, opp_len = 0;
+		char fw_flag = 0, mate_flag = 0;
+		if(!read_one(fh, best_score) || !read_one(fh, len) ||
+		   !read_one(fh, opp_len) || !read_one(fh, fw_flag) ||
+		   !read_one(fh, mate_flag) || !read_str(fh, qual) ||
+		   !read_xscript(fh, xscript))
+		{
+			cerr << "Error: input-model file ended in '" << cat << "' templates" << endl;
+			return -1;
+		}
+		templates.list().expand();
+		templates.list().back().init(
+			best_score, len, fw_flag, mate_flag, opp_len,
+			qual.c_str(), xscript.c_str());
+	}
+	templates.set_size((size_t)n);
+	return 0;
+}
+
+static int load_paired(
+	FILE *fh,
+	char cat,
+	ReservoirSampledEList<TemplatePaired>& templates)
+{
+	uint64_t n = 0;
+	long long ntemplates = load_category_header(fh, cat, n);
+	if(ntemplates < 0) {
+		return -1;
+	}
+	string qual_1, xscript_1, qual_2, xscript_2;
+	for(long long i = 0; i < ntemplates; i++) {
+		int32_t score_12 = 0, score_1 = 0, len_1 = 0, score_2 = 0, len_2 = 0;
+		char fw_flag_1 = 0, fw_flag_2 = 0, upstream1 = 0;
+		uint64_t fraglen = 0;
+		if(!read_one(fh, score_12) ||
+		   !read_one(fh, score_1) || !read_one(fh, len_1) ||
+		   !read_one(fh, fw_flag_1) || !read_str(fh, qual_1) ||
+		   !read_xscript(fh, xscript_1) ||
+		   !read_one(fh, score_2) || !read_one(fh, len_2) ||
+		   !read_one(fh, fw_flag_2) || !read_str(fh, qual_2) ||
+		   !read_xscript(fh, xscript_2) ||
+		   !read_one(fh, upstream1) || !read_one(fh, fraglen))
+		{
+			cerr << "Error: input-model file ended in '" << cat << "' templates" << endl;
+			return -1;
+		}
+		templates.list().expand();
+		templates.list().back().init(
+			score_12,
+			score_1, len_1, fw_flag_1, qual_1.c_str(), xscript_1.c_str(),
+			score_2, len_2, fw_flag_2, qual_2.c_str(), xscript_2.c_str(),
+			upstream1 != 0, (size_t)fraglen);
+	}
+	templates.set_size((size_t)n);
+	return 0;
+}
+
+int load_input_model(
+	const string& fn,
+	ReservoirSampledEList<TemplateUnpaired>& u_templates,
+	ReservoirSampledEList<TemplateUnpaired>& b_templates,
+	ReservoirSampledEList<TemplatePaired>& c_templates,
+	ReservoirSampledEList<TemplatePaired>& d_templates)
+{
+	assert(u_templates.empty() && b_templates.empty());
+	assert(c_templates.empty() && d_templates.empty());
+	FILE *fh = fopen(fn.c_str(), "rb");
+	if(fh == NULL) {
+		cerr << "Could not open input-model file \"" << fn << "\"" << endl;
+		return -1;
+	}
+	char magic[8];
+	uint32_t version = 0;
+	if(fread(magic, 1, 8, fh) != 8 || memcmp(magic, "QTIPIMOD", 8) != 0 || !read_one(fh, version)) {
+		cerr << "Error: \"" << fn << "\" is not a qtip input-model file" << endl;
+		fclose(fh);
+		return -1;
+	}
+	if(version != INPUT_MODEL_VERSION) {
+		cerr << "Error: input-model file \"" << fn << "\" has version "
+		     << version << "; expected " << INPUT_MODEL_VERSION << endl;
+		fclose(fh);
+		return -1;
+	}
+	int ret = 0;
+	if(load_unpaired(fh, 'u', u_templates) != 0 ||
+	   load_unpaired(fh, 'b', b_templates) != 0 ||
+	   load_paired(fh, 'c', c_templates) != 0 ||
+	   load_paired(fh, 'd', d_templates) != 0)
+	{
+		cerr << "Could not load input model from \"" << fn << "\"" << endl;
+		ret = -1;
+	}
+	fclose(fh);
+	return ret;
+}
+
+#ifdef INPUT_MODEL_MAIN
+
+#include <unistd.h>
+
+static void add_unpaired(
+	ReservoirSampledEList<TemplateUnpaired>& ts,
+	int best_score,
+	const char *qual,
+	const char *xscript)
+{
+	ts.list().expand();
+	ts.list().back().init(best_score, (int)strlen(qual), 'T', '1', 50, qual, xscript);
+	ts.set_size(ts.size() + 1);
+}
+
+static void add_paired(
+	ReservoirSampledEList<TemplatePaired>& ts,
+	int score_1,
+	int score_2,
+	size_t fraglen)
+{
+	ts.list().expand();
+	ts.list().back().init(score_1 + score_2,
+	                      score_1, 4, 'T', "IIII", "====",
+	                      score_2, 3, 'F', "#,I", "=X=",
+	                      true, fraglen);
+	ts.set_size(ts.size() + 1);
+}
+
+/**
+ * Save and load an input model, one category of which is empty and one of
+ * which was offered more templates than it kept.
+ */
+static void test1() {
+	const char *fn = ".input_model.test1.bin";
+	ReservoirSampledEList<TemplateUnpaired> u(10), b(10);
+	ReservoirSampledEList<TemplatePaired> c(10), d(10);
+	add_unpaired(u, -12, "ABC,DEF", "==X====");
+	add_unpaired(u, 0, "", "");
+	add_paired(c, -5, -7, 350);
+	c.set_size(1000);
+	assert(save_input_model(fn, u, b, c, d) == 0);
+
+	ReservoirSampledEList<TemplateUnpaired> u2(10), b2(10);
+	ReservoirSampledEList<TemplatePaired> c2(10), d2(10);
+	assert(load_input_model(fn, u2, b2, c2, d2) == 0);
+	assert(u2.size() == 2 && u2.list().size() == 2);
+	assert(b2.empty() && b2.list().empty());
+	assert(c2.size() == 1000 && c2.list().size() == 1);
+	assert(d2.empty() && d2.list().empty());
+	const TemplateUnpaired& t = u2.list()[0];
+	assert(t.best_score_ == -12);
+	assert(t.len_ == 7);
+	assert(t.fw_flag_ == 'T');
+	assert(t.mate_flag_ == '1');
+	assert(t.opp_len_ == 50);
+	assert(strcmp(t.qual_, "ABC,DEF") == 0);
+	assert(strcmp(t.edit_xscript_, "==X====") == 0);
+	assert(strcmp(u2.list()[1].qual_, "") == 0);
+	const TemplatePaired& p = c2.list()[0];
+	assert(p.score_12_ == -12);
+	assert(p.score_1_ == -5 && p.score_2_ == -7);
+	assert(p.len_1_ == 4 && p.len_2_ == 3);
+	assert(p.fw_flag_1_ == 'T' && p.fw_flag_2_ == 'F');
+	assert(strcmp(p.qual_1_, "IIII") == 0);
+	assert(strcmp(p.qual_2_, "#,I") == 0);
+	assert(strcmp(p.edit_xscript_1_, "====") == 0);
+	assert(strcmp(p.edit_xscript_2_, "=X=") == 0);
+	assert(p.upstream1_);
+	assert(p.fraglen_ == 350);
+	remove(fn);
+}
+
+/**
+ * Files that aren't input models, or are cut short, are rejected.
+ */
+static void test2() {
+	const char *fn = ".input_model.test2.bin";
+	FILE *fh = fopen(fn, "wb");
+	fwrite("QTIPMAPQ", 1, 8, fh);
+	fclose(fh);
+	ReservoirSampledEList<TemplateUnpaired> u(10), b(10);
+	ReservoirSampledEList<TemplatePaired> c(10), d(10);
+	assert(load_input_model(fn, u, b, c, d) != 0);
+
+	add_unpaired(u, -3, "IIIII", "=====");
+	assert(save_input_model(fn, u, b, c, d) == 0);
+	assert(truncate(fn, 30) == 0);
+	ReservoirSampledEList<TemplateUnpaired> u2(10), b2(10);
+	ReservoirSampledEList<TemplatePaired> c2(10), d2(10);
+	assert(load_input_model(fn, u2, b2, c2, d2) != 0);
+	remove(fn);
+}
+
+int main(void) {
+	test1();
+	test2();
+	cerr << "PASSED" << endl;
+}
+
+#endif
@@ -11,6 +11,8 @@
 
 #include <stdio.h>
 #include <algorithm>
+#include <string>
+#include <stdint.h>
 #include "ds.h"
 #include "template.h"
 #include "rnglib.hpp"
@@ -166,4 +168,45 @@ protected:
 	float low_score_bias_; // unused
 };
 
+/**
+ * Version of input model files written by save_input_model.
+ */
+static const uint32_t INPUT_MODEL_VERSION = 1;
+
+/**
+ * Write the template reservoirs making up the input model, along with the
+ * number of templates each was offered, to the file named fn, so that reads
+ * can be simulated from them again without reparsing the input SAM.
+ *
+ * The file is little-endian and starts with "QTIPIMOD" and a uint32 version.
+ * Then for each category, u, b, c and d in that order, comes a uint32
+ * category character, uint64 number of templates offered and uint64 number
+ * kept, then the kept templates.  An unpaired template is int32 best score,
+ * read length and opposite mate's length, char fw flag and mate flag, then
+ * the quality string and edit transcript.  A paired template is int32 score
+ * of the pair, then for each mate int32 score and read length, char fw flag,
+ * quality string and edit transcript, then char mate-1-upstream flag and
+ * uint64 fragment length.  Strings are a uint32 length and their bytes,
+ * except edit transcripts, which are a uint32 number of runs of the same
+ * character followed by each run's char and uint32 length.  Returns -1 on
+ * error.
+ */
+int save_input_model(
+	const std::string& fn,
+	const ReservoirSampledEList<TemplateUnpaired>& u_templates,
+	const ReservoirSampledEList<TemplateUnpaired>& b_templates,
+	const ReservoirSampledEList<TemplatePaired>& c_templates,
+	const ReservoirSampledEList<TemplatePaired>& d_templates);
+
+/**
+ * Read an input model written by save_input_model into the given
+ * reservoirs, which should be empty.  Returns -1 on error.
+ */
+int load_input_model(
+	const std::string& fn,
+	ReservoirSampledEList<TemplateUnpaired>& u_templates,
+	ReservoirSampledEList<TemplateUnpaired>& b_templates,
+	ReservoirSampledEList<TemplatePaired>& c_templates,
+	ReservoirSampledEList<TemplatePaired>& d_templates);
+
 #endif /* defined(__qtip__input_model__) */
@@ -2,6 +2,8 @@
 #include <iostream>
 #include <cassert>
 #include <stdio.h>
+#include <string.h>
+#include <stdint.h>
 
 using namespace std;
 
@@ -119,6 +121,95 @@ bool PredictionMerger::advanceFile(size_t i) {
     return true;
 }
 
+int PredictionTable::map(const string& fn) {
+	FILE *fh = fopen(fn.c_str(), "rb");
+	if(fh == NULL) {
+		cerr << "Could not open prediction file \"" << fn << "\"" << endl;
+		return -1;
+	}
+	bool mapped = mf_.map(fh, false);
+	fclose(fh);
+	if(!mapped) {
+		cerr << "Could not map prediction file \"" << fn << "\"" << endl;
+		return -1;
+	}
+	owned_.clear();
+	mapq_ = NULL;
+	mapq_u2_ = NULL;
+	n_ = 0;
+	const char *data = mf_.data();
+	size_t len = mf_.size();
+	int encoding = MAPQ_F4;
+	const size_t hdrlen = 24;
+	if(len >= 8 && memcmp(data, "QTIPMAPQ", 8) == 0) {
+		uint32_t version = 0, enc = 0;
+		uint64_t nlines = 0;
+		if(len >= hdrlen) {
+			memcpy(&version, data + 8, 4);
+			memcpy(&enc, data + 12, 4);
+			memcpy(&nlines, data + 16, 8);
+		}
+		if(len < hdrlen || version != VERSION) {
+			cerr << "Prediction file \"" << fn << "\" has unsupported version "
+			     << version << "; expected " << VERSION << endl;
+			mf_.unmap();
+			return -1;
+		}
+		if(enc != MAPQ_F4 && enc != MAPQ_U2) {
+			cerr << "Prediction file \"" << fn << "\" has unknown MAPQ encoding "
+			     << enc << endl;
+			mf_.unmap();
+			return -1;
+		}
+		encoding = (int)enc;
+		data += hdrlen;
+		len -= hdrlen;
+		size_t sz = (encoding == MAPQ_U2) ? 2 : 4;
+		if(len != nlines * sz) {
+			cerr << "Prediction file \"" << fn << "\" has " << len
+			     << " bytes of MAPQs; expected " << (nlines * sz) << endl;
+			mf_.unmap();
+			return -1;
+		}
+	} else if(len % sizeof(float) != 0) {
+		cerr << "Prediction file \"" << fn << "\" has " << len
+		     << " bytes; expected a multiple of " << sizeof(float) << endl;
+		mf_.unmap();
+		return -1;
+	}
+	if(encoding == MAPQ_U2) {
+		mapq_u2_ = (const unsigned short *)data;
+		n_ = len / 2;
+	} else {
+		mapq_ = (const float *)data;
+		n_ = len / sizeof(float);
+	}
+	return 0;
+}
+
+void PredictionTable::add(const Prediction& p) {
+	assert(p.valid());
+	if(owned_.empty()) {
+		mf_.unmap();
+		mapq_u2_ = NULL;
+	}
+	if(p.line >= owned_.size()) {
+		owned_.resize(p.line + 1, -1.0f);
+	}
+	owned_[p.line] = (float)p.mapq;
+	mapq_ = &owned_[0];
+	n_ = owned_.size();
+}
+
+unsigned long long PredictionTable::end() const {
+	size_t i = n_;
+	double mapq = 0.0;
+	while(i > 0 && !get(i-1, mapq)) {
+		i--;
+	}
+	return i;
+}
+
 #ifdef PREDMERGE_MAIN
 
 #include <fstream>
@@ -311,10 +402,129 @@ static void test3() {
     assert(!pred.valid());
 }
 
+static void test4() {
+	// line-indexed table, filled out of order
+	PredictionTable t;
+	double mapq = 0.0;
+	assert(!t.get(0, mapq));
+	assert(t.end() == 0);
+	t.add(Prediction(6, 37.0));
+	t.add(Prediction(1, 17.0));
+	t.add(Prediction(3, 30.0));
+	assert(t.get(1, mapq) && mapq == 17.0);
+	assert(t.get(3, mapq) && mapq == 30.0);
+	assert(t.get(6, mapq) && mapq == 37.0);
+	assert(!t.get(0, mapq));
+	assert(!t.get(2, mapq));
+	assert(!t.get(7, mapq));
+	assert(t.end() == 7);
+}
+
+static void test5() {
+	// .mapq file as written by MapqPredictions
+	string fn(".predmerge.test5.mapq");
+	FILE *fh = fopen(fn.c_str(), "wb");
+	if(fh == NULL) {
+		cerr << "could not write test file" << endl;
+		throw 1;
+	}
+	float mapqs[] = {-1.0f, 10.5f, 0.0f, -1.0f, 44.0f, -1.0f};
+	if(fwrite(mapqs, sizeof(float), 6, fh) != 6) {
+		cerr << "error writing mapqs" << endl;
+		throw 1;
+	}
+	fclose(fh);
+	PredictionTable t;
+	if(t.map(fn) != 0) {
+		throw 1;
+	}
+	double mapq = 0.0;
+	assert(!t.get(0, mapq));
+	assert(t.get(1, mapq) && mapq == 10.5);
+	assert(t.get(2, mapq) && mapq == 0.0);
+	assert(!t.get(3, mapq));
+	assert(t.get(4, mapq) && mapq == 44.0);
+	assert(!t.get(5, mapq));
+	assert(!t.get(6, mapq));
+	assert(t.end() == 5);
+	remove(fn.c_str());
+}
+
+static void write_mapq_file(const string& fn, uint32_t version, uint32_t enc,
+                            const void *mapqs, uint64_t nlines, size_t sz)
+{
+	FILE *fh = fopen(fn.c_str(), "wb");
+	if(fh == NULL) {
+		cerr << "could not write test file" << endl;
+		throw 1;
+	}
+	if(fwrite("QTIPMAPQ", 1, 8, fh) != 8 ||
+	   fwrite(&version, 4, 1, fh) != 1 ||
+	   fwrite(&enc, 4, 1, fh) != 1 ||
+	   fwrite(&nlines, 8, 1, fh) != 1 ||
+	   fwrite(mapqs, sz, nlines, fh) != nlines)
+	{
+		cerr << "error writing mapq file" << endl;
+		throw 1;
+	}
+	fclose(fh);
+}
+
+static void test6() {
+	// versioned .mapq files, float and quantized
+	string fn(".predmerge.test6.mapq");
+	float mapqs[] = {-1.0f, 10.5f, 0.0f, 44.0f, -1.0f};
+	write_mapq_file(fn, 1, MAPQ_F4, mapqs, 5, sizeof(float));
+	PredictionTable t;
+	if(t.map(fn) != 0) {
+		throw 1;
+	}
+	double mapq = 0.0;
+	assert(!t.get(0, mapq));
+	assert(t.get(1, mapq) && mapq == 10.5);
+	assert(t.get(2, mapq) && mapq == 0.0);
+	assert(t.get(3, mapq) && mapq == 44.0);
+	assert(!t.get(4, mapq));
+	assert(t.end() == 4);
+
+	unsigned short qmapqs[] = {0xffff, 10500, 0, 0xffff, 60123, 0xffff};
+	write_mapq_file(fn, 1, MAPQ_U2, qmapqs, 6, 2);
+	if(t.map(fn) != 0) {
+		throw 1;
+	}
+	assert(!t.get(0, mapq));
+	assert(t.get(1, mapq) && mapq == 10.5);
+	assert(t.get(2, mapq) && mapq == 0.0);
+	assert(!t.get(3, mapq));
+	assert(t.get(4, mapq) && mapq == 60.123);
+	assert(!t.get(5, mapq));
+	assert(t.end() == 5);
+
+	// adding a prediction replaces the mapped file
+	t.add(Prediction(2, 7.0));
+	assert(!t.get(1, mapq));
+	assert(t.get(2, mapq) && mapq == 7.0);
+
+	// unknown versions and truncated files are rejected
+	write_mapq_file(fn, 2, MAPQ_F4, mapqs, 5, sizeof(float));
+	assert(t.map(fn) != 0);
+	write_mapq_file(fn, 1, MAPQ_F4, mapqs, 4, sizeof(float));
+	FILE *fh = fopen(fn.c_str(), "r+b");
+	uint64_t nlines = 5;
+	fseek(fh, 16, SEEK_SET);
+	fwrite(&nlines, 8, 1, fh);
+	fclose(fh);
+	assert(t.map(fn) != 0);
+	remove(fn.c_str());
+}
+
 int main(void) {
 	test1();
 	test2();
 	test3();
+	test4();
+	test5();
+	test6();
 	cout << "ALL TESTS PASSED" << endl;
 }
 #endif
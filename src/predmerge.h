@@ -1,7 +1,12 @@
+#ifndef __qtip__predmerge__
+#define __qtip__predmerge__
+
+#include <stdio.h>
 #include <stdlib.h>
 #include <vector>
 #include <string>
 #include <limits>
+#include "blockio.h"
 
 /**
  * A single MAPQ prediction and associated line number
@@ -50,3 +55,76 @@ private:
     std::vector<bool> done_;
     int next_; // -1 if next is unknown, index of next file to read from otherwise
 };
+
+/**
+ * Encodings of the MAPQs in a .mapq file.
+ */
+enum {
+	MAPQ_F4 = 0, // float; negative if no prediction
+	MAPQ_U2      // uint16 thousandths of a MAPQ; 0xffff if no prediction
+};
+
+/**
+ * MAPQ predictions indexed by line number, so the prediction for any line
+ * can be looked up directly.  A prediction file written by MapqPredictions
+ * (ending in .mapq) starts with "QTIPMAPQ", then little-endian uint32
+ * version and encoding and uint64 number of lines, followed by one MAPQ per
+ * line starting with line 0.  Files without the header are bare arrays of
+ * floats.  Files are mapped into memory rather than read.  Predictions can
+ * also be added one at a time, in any order, e.g. from legacy files of
+ * (line, MAPQ) pairs read with PredictionMerger.
+ */
+class PredictionTable {
+public:
+
+	static const unsigned int VERSION = 1;
+
+	PredictionTable() : mapq_(NULL), mapq_u2_(NULL), n_(0) { }
+
+	/**
+	 * Map the .mapq file named fn.  Returns -1 on error.
+	 */
+	int map(const std::string& fn);
+
+	/**
+	 * Add prediction p, replacing the mapped file if there is one.
+	 */
+	void add(const Prediction& p);
+
+	/**
+	 * Return true iff there's a prediction for the line, and set mapq to it.
+	 */
+	bool get(unsigned long long line, double& mapq) const {
+		if(line >= n_) {
+			return false;
+		}
+		if(mapq_u2_ != NULL) {
+			if(mapq_u2_[line] == 0xffff) {
+				return false;
+			}
+			mapq = mapq_u2_[line] / 1000.0;
+			return true;
+		}
+		if(!(mapq_[line] >= 0.0f)) {
+			return false;
+		}
+		mapq = mapq_[line];
+		return true;
+	}
+
+	/**
+	 * Return 1 more than the greatest line number with a prediction, or 0 if
+	 * there are none.
+	 */
+	unsigned long long end() const;
+
+private:
+
+	MappedFile mf_;
+	std::vector<float> owned_; // predictions added with add()
+	const float *mapq_;
+	const unsigned short *mapq_u2_; // instead of mapq_ if quantized
+	size_t n_;
+};
+
+#endif /* defined(__qtip__predmerge__) */
@@ -8,11 +8,16 @@
 #include <string>
 #include <vector>
 #include <limits>
+#include <cmath>
+#include <pthread.h>
 #include "ds.h"
 #include "template.h"
 #include "input_model.h"
 #include "rnglib.hpp"
 #include "simplesim.h"
+#include "blockio.h"
+#include "colfile.h"
+#include "qtip_parse.h"
 
 using namespace std;
 
@@ -70,7 +75,8 @@ using namespace std;
 /**
  * Implementations of the various passes that qtip makes over SAM files.
  *
- * NOTE: uses strtok so not multithreaded.
+ * Tokenizing uses strtok_r with state local to each parser, so separate
+ * blocks of the input SAM can be parsed on separate threads.
  */
 
 /* 64K buffer for all input and output */
@@ -96,6 +102,7 @@ struct Alignment {
 	
 	void clear() {
 		rest_of_line = NULL;
+		end_of_line = NULL;
 		valid = false;
 		qname = NULL;
 		typ = NULL;
@@ -190,7 +197,8 @@ struct Alignment {
 	 */
 	char * parse_extra(char *extra) {
 		char *ztz = NULL;
-		extra = strtok(extra, "\t");
+		char *saveptr = NULL;
+		extra = strtok_r(extra, "\t", &saveptr);
 		bool found_ztz = false, found_mdz = false;
 		while(extra != NULL && (!found_mdz || !found_ztz)) {
 			if(strncmp(extra, "ZT:Z:", 5) == 0) {
@@ -203,7 +211,7 @@ struct Alignment {
 				mdz_to_list();
 				found_mdz = true;
 			}
-			extra = strtok(NULL, "\t");
+			extra = strtok_r(NULL, "\t", &saveptr);
 		}
 		if(cigar != NULL && mdz != NULL && !cigar_equal_x) {
 			cigar_and_mdz_to_edit_xscript();
@@ -713,6 +721,7 @@ struct Alignment {
 	}
 	
 	char *rest_of_line;
+	char *end_of_line; // NUL terminating the line
 	bool valid;
 	char *qname;
 	char *typ;
@@ -755,42 +764,39 @@ struct Alignment {
 };
 
 /**
- * strtok already used to parse up to rname.  Parse the rest and return char *
- * to the extra flags.
- *
- * This function uses strtok so it will interrrupt any strtoks already in
- * progress.  But when it returns, it's finished with its stateful strtok
- * session, so there's nothing keeping the caller from starting another
- * strtok.
+ * Fields up to and including FLAG were already tokenized.  Parse the rest
+ * and return char * to the extra flags.
  */
 static char * parse_from_rname_on(Alignment& al) {
 	assert(al.rest_of_line != NULL);
-	al.rname = strtok(al.rest_of_line, "\t"); assert(al.rname != NULL);
-	char *pos_str = strtok(NULL, "\t"); assert(pos_str != NULL);
+	char *saveptr = NULL;
+	al.rname = strtok_r(al.rest_of_line, "\t", &saveptr); assert(al.rname != NULL);
+	char *pos_str = strtok_r(NULL, "\t", &saveptr); assert(pos_str != NULL);
 	al.pos = (size_t)atoll(pos_str);
-	char *mapq_str = strtok(NULL, "\t"); assert(mapq_str != NULL);
+	char *mapq_str = strtok_r(NULL, "\t", &saveptr); assert(mapq_str != NULL);
 	al.mapq = atoi(mapq_str);
 	assert(al.mapq < 256);
 
 	// sets cigar_ops, cigar_run
 	// if CIGAR string uses = and X, then also sets edit transcript
-	al.cigar = strtok(NULL, "\t");
+	al.cigar = strtok_r(NULL, "\t", &saveptr);
 	assert(al.cigar != NULL);
 	al.parse_cigar();
 
-	al.rnext = strtok(NULL, "\t"); assert(al.rnext != NULL);
-	char *pnext_str = strtok(NULL, "\t"); assert(pnext_str != NULL);
+	al.rnext = strtok_r(NULL, "\t", &saveptr); assert(al.rnext != NULL);
+	char *pnext_str = strtok_r(NULL, "\t", &saveptr); assert(pnext_str != NULL);
 	al.pnext = atoi(pnext_str);
-	strtok(NULL, "\t"); // ignore tlen
-	al.seq = strtok(NULL, "\t"); assert(al.seq != NULL);
+	strtok_r(NULL, "\t", &saveptr); // ignore tlen
+	al.seq = strtok_r(NULL, "\t", &saveptr); assert(al.seq != NULL);
 	al.len = strlen(al.seq);
 
 	// sets qual, avg_aligned_qual and avg_clipped_qual
-	al.qual = strtok(NULL, "\t");
+	al.qual = strtok_r(NULL, "\t", &saveptr);
 	assert(al.qual != NULL);
 	al.calc_qual_averages();
 
-	al.rest_of_line = al.qual + strlen(al.qual) + 1;
+	// don't run past the end of the line if there are no extra fields
+	al.rest_of_line = std::min(al.qual + strlen(al.qual) + 1, al.end_of_line);
 	return al.rest_of_line;
 }
 
@@ -805,18 +811,505 @@ int sim_unp_min = 30000;
 int sim_conc_min = 30000;
 int sim_disc_min = 10000;
 int sim_bad_end_min = 10000;
+int parse_threads = 1;
+int sim_threads = 1;
+bool dedup_features = false; // write de-duplicated, weighted feature tables
+
+/* size of the blocks of input SAM handed to each parsing thread */
+const static size_t PASS1_BLOCKSZ = 4 * 1024 * 1024;
+
+/**
+ * Destination for the feature records of one alignment category.  Records
+ * are either written straight to out or, when a block of the input is
+ * parsed on a worker thread, accumulated so that they can be written in
+ * input order later.  Accumulated records have alignment ids relative to
+ * the start of the block, which are rebased when they're flushed.
+ */
+struct RecordSink {
+
+	RecordSink() : out(NULL), buffered(false), ncol(0), rec_start(0) { }
+
+	bool active() const {
+		return out != NULL || buffered;
+	}
+
+	void clear() {
+		buf.clear();
+		ids.clear();
+		rec_start = 0;
+	}
+
+	/**
+	 * Start a record for the alignment with the given id.
+	 */
+	void push_id(size_t line) {
+		ids.push_back(line);
+	}
+
+	void push(double d) {
+		buf.push_back(d);
+	}
+
+	/**
+	 * Finish the current record, writing it out unless we're accumulating.
+	 */
+	int end_record() {
+		if(ncol == 0) {
+			ncol = buf.size() - rec_start;
+		}
+		assert(buf.size() - rec_start == ncol);
+		if(buffered) {
+			rec_start = buf.size();
+			return 0;
+		}
+		return write_all(out);
+	}
+
+	/**
+	 * Write out all accumulated records, adding id_base to their alignment
+	 * ids, then clear them.
+	 */
+	int flush(RecordWriter *o, size_t id_base) {
+		for(size_t i = 0; i < ids.size(); i++) {
+			ids[i] += id_base;
+		}
+		rec_start = 0;
+		return write_all(o);
+	}
+
+	RecordWriter *out;
+	bool buffered;
+	vector<double> buf;    // values of each record but its id
+	vector<uint64_t> ids;  // id of each record
+	size_t ncol;           // # values per record, once known
+	size_t rec_start;      // offset in buf where current record starts
+
+protected:
+
+	int write_all(RecordWriter *o) {
+		if(ids.empty()) {
+			return 0;
+		}
+		assert(buf.size() == ids.size() * ncol);
+		if(o->add(&ids.front(), &buf.front(), ids.size(), ncol) != 0) {
+			return -1;
+		}
+		buf.clear();
+		ids.clear();
+		return 0;
+	}
+};
+
+/**
+ * Copy string into the character arena and return its offset.
+ */
+static size_t arena_add(vector<char>& arena, const char *str) {
+	size_t off = arena.size();
+	arena.insert(arena.end(), str, str + strlen(str) + 1);
+	return off;
+}
+
+/**
+ * Destination for the unpaired input-model templates of one category.
+ * Templates are either offered straight to the reservoir or, when a block
+ * is parsed on a worker thread, buffered and offered later.  All categories
+ * draw from the same random number generator, so buffered templates are
+ * offered in input order across categories (see SamPass1Parser::absorb) to
+ * keep the samples the same as in a single-threaded run.
+ */
+struct UnpairedTemplateSink {
+
+	struct Candidate {
+		int best_score;
+		int len;
+		char fw_flag;
+		char mate_flag;
+		int opp_len;
+		size_t qual_off;
+		size_t edit_xscript_off;
+	};
+
+	UnpairedTemplateSink() : reservoir(NULL), buffered(false) { }
+
+	bool active() const {
+		return reservoir != NULL || buffered;
+	}
+
+	void clear() {
+		cands.clear();
+		strs.clear();
+	}
+
+	void add(
+		int best_score,
+		int len,
+		char fw_flag,
+		char mate_flag,
+		int opp_len,
+		const char *qual,
+		const char *edit_xscript)
+	{
+		if(buffered) {
+			Candidate c;
+			c.best_score = best_score;
+			c.len = len;
+			c.fw_flag = fw_flag;
+			c.mate_flag = mate_flag;
+			c.opp_len = opp_len;
+			c.qual_off = arena_add(strs, qual);
+			c.edit_xscript_off = arena_add(strs, edit_xscript);
+			cands.push_back(c);
+			return;
+		}
+		size_t off = reservoir->add_part1();
+		if(off < reservoir->k()) {
+			reservoir->list().back().init(
+				best_score, len, fw_flag, mate_flag, opp_len, qual, edit_xscript);
+		}
+	}
+
+	/**
+	 * Offer the ith buffered template to the given reservoir.
+	 */
+	void replay(ReservoirSampledEList<TemplateUnpaired>& res, size_t i) const {
+		const Candidate& c = cands[i];
+		size_t off = res.add_part1();
+		if(off < res.k()) {
+			res.list().back().init(
+				c.best_score, c.len, c.fw_flag, c.mate_flag, c.opp_len,
+				&strs[c.qual_off], &strs[c.edit_xscript_off]);
+		}
+	}
 
-vector<double> write_buf;
+	ReservoirSampledEList<TemplateUnpaired> *reservoir;
+	bool buffered;
+	vector<Candidate> cands;
+	vector<char> strs;
+};
 
 /**
- * No guarantee about state of strtok upon return.
+ * Paired-end counterpart of UnpairedTemplateSink.
  */
-static int print_unpaired(
-	Alignment& al, // already parsed up through flags
+struct PairedTemplateSink {
+
+	struct Candidate {
+		int score_12;
+		int score_1;
+		int len_1;
+		char fw_flag_1;
+		size_t qual_1_off;
+		size_t edit_xscript_1_off;
+		int score_2;
+		int len_2;
+		char fw_flag_2;
+		size_t qual_2_off;
+		size_t edit_xscript_2_off;
+		bool upstream1;
+		size_t fraglen;
+	};
+
+	PairedTemplateSink() : reservoir(NULL), buffered(false) { }
+
+	bool active() const {
+		return reservoir != NULL || buffered;
+	}
+
+	void clear() {
+		cands.clear();
+		strs.clear();
+	}
+
+	void add(
+		int score_12,
+		int score_1,
+		int len_1,
+		char fw_flag_1,
+		const char *qual_1,
+		const char *edit_xscript_1,
+		int score_2,
+		int len_2,
+		char fw_flag_2,
+		const char *qual_2,
+		const char *edit_xscript_2,
+		bool upstream1,
+		size_t fraglen)
+	{
+		if(buffered) {
+			Candidate c;
+			c.score_12 = score_12;
+			c.score_1 = score_1;
+			c.len_1 = len_1;
+			c.fw_flag_1 = fw_flag_1;
+			c.qual_1_off = arena_add(strs, qual_1);
+			c.edit_xscript_1_off = arena_add(strs, edit_xscript_1);
+			c.score_2 = score_2;
+			c.len_2 = len_2;
+			c.fw_flag_2 = fw_flag_2;
+			c.qual_2_off = arena_add(strs, qual_2);
+			c.edit_xscript_2_off = arena_add(strs, edit_xscript_2);
+			c.upstream1 = upstream1;
+			c.fraglen = fraglen;
+			cands.push_back(c);
+			return;
+		}
+		size_t j = reservoir->add_part1();
+		if(j < reservoir->k()) {
+			reservoir->list().back().init(
+				score_12, score_1, len_1, fw_flag_1, qual_1, edit_xscript_1,
+				score_2, len_2, fw_flag_2, qual_2, edit_xscript_2,
+				upstream1, fraglen);
+		}
+	}
+
+	/**
+	 * Offer the ith buffered template to the given reservoir.
+	 */
+	void replay(ReservoirSampledEList<TemplatePaired>& res, size_t i) const {
+		const Candidate& c = cands[i];
+		size_t j = res.add_part1();
+		if(j < res.k()) {
+			res.list().back().init(
+				c.score_12, c.score_1, c.len_1, c.fw_flag_1,
+				&strs[c.qual_1_off], &strs[c.edit_xscript_1_off],
+				c.score_2, c.len_2, c.fw_flag_2,
+				&strs[c.qual_2_off], &strs[c.edit_xscript_2_off],
+				c.upstream1, c.fraglen);
+		}
+	}
+
+	ReservoirSampledEList<TemplatePaired> *reservoir;
+	bool buffered;
+	vector<Candidate> cands;
+	vector<char> strs;
+};
+
+/**
+ * Given a SAM record for an aligned read, count the number of comma-delimited
+ * records in the ZT:Z extra field.
+ */
+static int infer_num_ztzs(const char *rest_of_line) {
+	int n_ztz_fields = 1;
+	const char *cur = strstr(rest_of_line, "\tZT:Z:");
+	if(cur != NULL) {
+		for(cur += 6; *cur != '\0'; cur++) {
+			if(*cur == ',') {
+				n_ztz_fields++;
+			}
+		}
+	}
+	return n_ztz_fields;
+}
+
+/**
+ *
+ */
+static size_t infer_read_length(const char *rest_of_line) {
+	size_t tabs = 0;
+	size_t len = 0;
+	const char *cur = rest_of_line;
+	while(true) {
+		if(*cur++ == '\t') {
+			tabs++;
+			if(tabs == 7) {
+				while(*cur++ != '\t') {
+					len++;
+				}
+				return len;
+			}
+		}
+	}
+	assert(false);
+	return 0;
+}
+
+/**
+ * Tallies of SAM lines and alignment categories seen in the first pass.
+ */
+struct Pass1Counts {
+
+	Pass1Counts() { reset(); }
+
+	void reset() {
+		nline = nhead = nsec = nsupp = npair = nunp = 0;
+		nunp_al = nunp_unal = npair_badend = npair_conc = 0;
+		npair_disc = npair_unal = ntyp_mismatch = 0;
+	}
+
+	void add(const Pass1Counts& o) {
+		nline += o.nline;
+		nhead += o.nhead;
+		nsec += o.nsec;
+		nsupp += o.nsupp;
+		npair += o.npair;
+		nunp += o.nunp;
+		nunp_al += o.nunp_al;
+		nunp_unal += o.nunp_unal;
+		npair_badend += o.npair_badend;
+		npair_conc += o.npair_conc;
+		npair_disc += o.npair_disc;
+		npair_unal += o.npair_unal;
+		ntyp_mismatch += o.ntyp_mismatch;
+	}
+
+	size_t nline, nhead, nsec, nsupp, npair, nunp;
+	size_t nunp_al, nunp_unal, npair_badend, npair_conc;
+	size_t npair_disc, npair_unal, ntyp_mismatch;
+};
+
+/**
+ * Parses SAM lines one at a time, pairing up mates and sending feature
+ * records and input-model templates for each category of alignment
+ * (unpaired, bad-end, concordant, discordant) to the corresponding sinks.
+ * All tokenizing state lives in the parser, so parsers on different threads
+ * can run concurrently.
+ */
+class SamPass1Parser {
+
+public:
+
+	SamPass1Parser() :
+		u_mod(NULL), b_mod(NULL), c_mod(NULL), d_mod(NULL)
+	{
+		reset();
+	}
+
+	/**
+	 * Forget about all lines parsed so far.  Sinks are cleared but keep
+	 * their destinations.
+	 */
+	void reset() {
+		counts.reset();
+		u_nztz = b_nztz = c_nztz = d_nztz = -1;
+		u_recs.clear(); b_recs.clear(); c_recs.clear(); d_recs.clear();
+		u_templates.clear(); b_templates.clear();
+		c_templates.clear(); d_templates.clear();
+		template_order_.clear();
+		al1_.clear();
+		al2_.clear();
+		al_cur1_ = true;
+		line1_ = true;
+	}
+
+	/**
+	 * Make this parser buffer everything that the given parser writes
+	 * directly, so it can parse a block on a worker thread and be absorbed
+	 * into the given parser afterwards.
+	 */
+	void buffer_like(const SamPass1Parser& o) {
+		u_recs.buffered = o.u_recs.active();
+		b_recs.buffered = o.b_recs.active();
+		c_recs.buffered = o.c_recs.active();
+		d_recs.buffered = o.d_recs.active();
+		u_templates.buffered = o.u_templates.active();
+		b_templates.buffered = o.b_templates.active();
+		c_templates.buffered = o.c_templates.active();
+		d_templates.buffered = o.d_templates.active();
+	}
+
+	/**
+	 * Write out the records and offer the templates buffered by a parser
+	 * set up with buffer_like(*this), as though we had parsed its lines
+	 * ourselves, just after the lines we've seen so far.
+	 */
+	int absorb(SamPass1Parser& o) {
+		size_t base = counts.nline;
+		if(u_recs.out != NULL && o.u_recs.flush(u_recs.out, base) != 0) return -1;
+		if(b_recs.out != NULL && o.b_recs.flush(b_recs.out, base) != 0) return -1;
+		if(c_recs.out != NULL && o.c_recs.flush(c_recs.out, base) != 0) return -1;
+		if(d_recs.out != NULL && o.d_recs.flush(d_recs.out, base) != 0) return -1;
+		size_t ui = 0, bi = 0, ci = 0, di = 0;
+		for(size_t i = 0; i < o.template_order_.size(); i++) {
+			switch(o.template_order_[i]) {
+				case 'u': o.u_templates.replay(*u_templates.reservoir, ui++); break;
+				case 'b': o.b_templates.replay(*b_templates.reservoir, bi++); break;
+				case 'c': o.c_templates.replay(*c_templates.reservoir, ci++); break;
+				case 'd': o.d_templates.replay(*d_templates.reservoir, di++); break;
+				default: assert(false);
+			}
+		}
+		if(u_nztz < 0) u_nztz = o.u_nztz;
+		if(b_nztz < 0) b_nztz = o.b_nztz;
+		if(c_nztz < 0) c_nztz = o.c_nztz;
+		if(d_nztz < 0) d_nztz = o.d_nztz;
+		counts.add(o.counts);
+		return 0;
+	}
+
+	/**
+	 * Return a buffer the caller can copy the next line into if it isn't
+	 * already in memory that stays put until the line after it is parsed,
+	 * e.g. when reading with fgets.  We alternate between two buffers so
+	 * that a mate stays valid while we parse the next line.
+	 */
+	char *line_buf() {
+		return line1_ ? linebuf1_ : linebuf2_;
+	}
+
+	int parse_line(char *line, size_t len);
+
+	// Outputs for unpaired (u), bad-end (b), concordant (c) and discordant
+	// (d) alignments
+	RecordSink u_recs, b_recs, c_recs, d_recs;
+	FILE *u_mod, *b_mod, *c_mod, *d_mod;
+	UnpairedTemplateSink u_templates, b_templates;
+	PairedTemplateSink c_templates, d_templates;
+
+	// # ZT:Z fields in first record of each category, or -1 if none yet
+	int u_nztz, b_nztz, c_nztz, d_nztz;
+
+	Pass1Counts counts;
+
+protected:
+
+	int print_unpaired(
+		Alignment& al, // already parsed up through flags
+		size_t ordlen,
+		FILE *fh_model,
+		RecordSink& recs,
+		UnpairedTemplateSink& unp_model);
+
+	int print_paired_helper(
+		Alignment& al1,
+		Alignment& al2,
+		FILE *fh_model,
+		RecordSink& recs,
+		PairedTemplateSink& paired_model);
+
+	/**
+	 * Call print_paired_helper with the first alignment
+	 * (according to appearance in the SAM) first.
+	 */
+	int print_paired(
+		Alignment& al1,
+		Alignment& al2,
+		FILE *fh_model,
+		RecordSink& recs,
+		PairedTemplateSink& paired_model)
+	{
+		return print_paired_helper(al1.line < al2.line ? al1 : al2,
+		                           al1.line < al2.line ? al2 : al1,
+		                           fh_model,
+		                           recs,
+		                           paired_model);
+	}
+
+	char linebuf1_[BUFSZ], linebuf2_[BUFSZ];
+	bool line1_;
+	Alignment al1_, al2_;
+	bool al_cur1_;
+	vector<double> ztz1_buf_;
+	vector<double> ztz2_buf_;
+
+	// category of each buffered template, in input order
+	vector<char> template_order_;
+};
+
+int SamPass1Parser::print_unpaired(
+	Alignment& al,
 	size_t ordlen,
 	FILE *fh_model,
-	FILE *fh_recs,
-	ReservoirSampledEList<TemplateUnpaired> *unp_model)
+	RecordSink& recs,
+	UnpairedTemplateSink& unp_model)
 {
 	assert(al.is_aligned());
 	char *extra = parse_from_rname_on(al);
@@ -828,7 +1321,8 @@ static int print_unpaired(
 		     << " required for use with qtip." << endl;
 		throw 1;
 	}
-	char *ztz_tok = strtok(ztz, ",");
+	char *saveptr = NULL;
+	char *ztz_tok = strtok_r(ztz, ",", &saveptr);
 	assert(ztz_tok != NULL);
 	al.best_score = atoi(ztz_tok);
 	char fw_flag = al.is_fw() ? 'T' : 'F';
@@ -846,28 +1340,25 @@ static int print_unpaired(
 			al.edit_xscript.ptr());
 	}
 
-	if(unp_model != NULL) {
-		size_t off = unp_model->add_part1();
-		if(off < unp_model->k()) {
-			unp_model->list().back().init(
-				al.best_score,
-				(int)al.len,
-				fw_flag,
-				al.mate_flag(),
-				(int)ordlen,
-				al.qual,
-				al.edit_xscript.ptr());
-		}
+	if(unp_model.active()) {
+		unp_model.add(
+			al.best_score,
+			(int)al.len,
+			fw_flag,
+			al.mate_flag(),
+			(int)ordlen,
+			al.qual,
+			al.edit_xscript.ptr());
 	}
 	
-	if(fh_recs != NULL) {
+	if(recs.active()) {
 		// Output information relevant to MAPQ model
-		write_buf.push_back((double)al.line);
-		write_buf.push_back((double)al.len);
-		write_buf.push_back((double)(al.left_clip + al.right_clip));
-		write_buf.push_back((double)al.tot_aligned_qual);
-		write_buf.push_back((double)al.tot_clipped_qual);
-		write_buf.push_back((double)ordlen);
+		recs.push_id(al.line);
+		recs.push((double)al.len);
+		recs.push((double)(al.left_clip + al.right_clip));
+		recs.push((double)al.tot_aligned_qual);
+		recs.push((double)al.tot_clipped_qual);
+		recs.push((double)ordlen);
 
 		// ... including all the ZT:Z fields
 		while(ztz_tok != NULL) {
@@ -875,7 +1366,7 @@ static int print_unpaired(
 			if(*buf == 'N') {
 				// Handle NA
 				assert(*(++buf) == 'A');
-				write_buf.push_back(std::numeric_limits<double>::quiet_NaN());
+				recs.push(std::numeric_limits<double>::quiet_NaN());
 			} else {
 				bool neg = false;
 				bool added = false;
@@ -893,48 +1384,37 @@ static int print_unpaired(
 					} else {
 						double ztz_d;
 						sscanf(ztz_tok, "%lf", &ztz_d);
-						write_buf.push_back(ztz_d);
+						recs.push(ztz_d);
 						added = true;
 						break;
 					}
 					buf++;
 				}
 				if(!added) {
-					write_buf.push_back((double)(neg ? (-ztz_i) : ztz_i));
+					recs.push((double)(neg ? (-ztz_i) : ztz_i));
 				}
 			}
-			ztz_tok = strtok(NULL, ",");
+			ztz_tok = strtok_r(NULL, ",", &saveptr);
 		}
 
 		// ... and finish with MAPQ and correct
-		write_buf.push_back((double)al.mapq);
-		write_buf.push_back((double)al.correct);
+		recs.push((double)al.mapq);
+		recs.push((double)al.correct);
 
 		// Flush output buffer
-		size_t nwritten = fwrite(&(write_buf.front()), 8,
-			write_buf.size(), fh_recs);
-		if(nwritten != write_buf.size()) {
-			cerr << "Could not write all " << write_buf.size()
-				 << " doubles to record file" << endl;
+		if(recs.end_record() != 0) {
 			return -1;
 		}
-		write_buf.clear();
 	}
 	return 0;
 }
 
-vector<double> ztz1_buf;
-vector<double> ztz2_buf;
-
-/**
- * No guarantee about state of strtok upon return.
- */
-static int print_paired_helper(
+int SamPass1Parser::print_paired_helper(
 	Alignment& al1,
 	Alignment& al2,
 	FILE *fh_model,
-	FILE *fh_recs,
-	ReservoirSampledEList<TemplatePaired> *paired_model)
+	RecordSink& recs,
+	PairedTemplateSink& paired_model)
 {
 	assert(al1.is_aligned());
 	assert(al2.is_aligned());
@@ -958,7 +1438,8 @@ static int print_paired_helper(
 	assert(al1.cigar != NULL);
 	assert(al2.cigar != NULL);
 
-	char *ztz_tok1 = strtok(ztz1, ",");
+	char *saveptr1 = NULL;
+	char *ztz_tok1 = strtok_r(ztz1, ",", &saveptr1);
 	assert(ztz_tok1 != NULL);
 	al1.best_score = atoi(ztz_tok1);
 	char fw_flag1 = al1.is_fw() ? 'T' : 'F';	
@@ -968,8 +1449,8 @@ static int print_paired_helper(
     double alqual1_d;
     double clipqual1_d;
 
-	if(fh_recs != NULL) {
-		ztz1_buf.clear();
+	if(recs.active()) {
+		ztz1_buf_.clear();
 		
 		//
 		// Mate 1
@@ -980,11 +1461,11 @@ static int print_paired_helper(
 		clip1_d = (double)al1.left_clip + al1.right_clip;
 		alqual1_d = (double)al1.tot_aligned_qual;
 		clipqual1_d = (double)(double)al1.tot_clipped_qual;
-		write_buf.push_back((double)al1.line);
-		write_buf.push_back(len1_d);
-		write_buf.push_back(clip1_d);
-		write_buf.push_back(alqual1_d);
-		write_buf.push_back(clipqual1_d);
+		recs.push_id(al1.line);
+		recs.push(len1_d);
+		recs.push(clip1_d);
+		recs.push(alqual1_d);
+		recs.push(clipqual1_d);
 
 		// ... including all the ZT:Z fields
 		while(ztz_tok1 != NULL) {
@@ -992,8 +1473,8 @@ static int print_paired_helper(
 			if(*buf == 'N') {
 				// Handle NA
 				assert(*(++buf) == 'A');
-				write_buf.push_back(std::numeric_limits<double>::quiet_NaN());
-				ztz1_buf.push_back(std::numeric_limits<double>::quiet_NaN());
+				recs.push(std::numeric_limits<double>::quiet_NaN());
+				ztz1_buf_.push_back(std::numeric_limits<double>::quiet_NaN());
 			} else {
 				bool neg = false;
 				bool added = false;
@@ -1011,8 +1492,8 @@ static int print_paired_helper(
 					} else {
 						double ztz_d;
 						sscanf(ztz_tok1, "%lf", &ztz_d);
-						write_buf.push_back(ztz_d);
-						ztz1_buf.push_back(ztz_d);
+						recs.push(ztz_d);
+						ztz1_buf_.push_back(ztz_d);
 						added = true;
 						break;
 					}
@@ -1020,21 +1501,22 @@ static int print_paired_helper(
 				}
 				if(!added) {
 					double ztz_add = (double)(neg ? (-ztz_i) : ztz_i);
-					write_buf.push_back(ztz_add);
-					ztz1_buf.push_back(ztz_add);
+					recs.push(ztz_add);
+					ztz1_buf_.push_back(ztz_add);
 				}
 			}
-			ztz_tok1 = strtok(NULL, ",");
+			ztz_tok1 = strtok_r(NULL, ",", &saveptr1);
 		}
 	}
 	
-	char *ztz_tok2 = strtok(ztz2, ",");
+	char *saveptr2 = NULL;
+	char *ztz_tok2 = strtok_r(ztz2, ",", &saveptr2);
 	assert(ztz_tok2 != NULL);
 	al2.best_score = atoi(ztz_tok2);
 	char fw_flag2 = al2.is_fw() ? 'T' : 'F';
 	
-	if(fh_recs != NULL) {
-		ztz2_buf.clear();
+	if(recs.active()) {
+		ztz2_buf_.clear();
 		
 		//
 		// Mate 2
@@ -1046,11 +1528,11 @@ static int print_paired_helper(
         const double alqual2_d = (double)al2.tot_aligned_qual;
         const double clipqual2_d = (double)al2.tot_clipped_qual;
 		const double fraglen_d = (double)fraglen;
-		write_buf.push_back(len2_d);
-		write_buf.push_back(clip2_d);
-		write_buf.push_back(alqual2_d);
-		write_buf.push_back(clipqual2_d);
-		write_buf.push_back(fraglen_d);
+		recs.push(len2_d);
+		recs.push(clip2_d);
+		recs.push(alqual2_d);
+		recs.push(clipqual2_d);
+		recs.push(fraglen_d);
 
 		// ... including all the ZT:Z fields
 		while(ztz_tok2 != NULL) {
@@ -1058,8 +1540,8 @@ static int print_paired_helper(
 			if(*buf == 'N') {
 				// Handle NA
 				assert(*(++buf) == 'A');
-				write_buf.push_back(std::numeric_limits<double>::quiet_NaN());
-				ztz2_buf.push_back(std::numeric_limits<double>::quiet_NaN());
+				recs.push(std::numeric_limits<double>::quiet_NaN());
+				ztz2_buf_.push_back(std::numeric_limits<double>::quiet_NaN());
 			} else {
 				bool neg = false;
 				bool added = false;
@@ -1077,8 +1559,8 @@ static int print_paired_helper(
 					} else {
 						double ztz_d;
 						sscanf(ztz_tok2, "%lf", &ztz_d);
-						write_buf.push_back(ztz_d);
-						ztz2_buf.push_back(ztz_d);
+						recs.push(ztz_d);
+						ztz2_buf_.push_back(ztz_d);
 						added = true;
 						break;
 					}
@@ -1086,44 +1568,42 @@ static int print_paired_helper(
 				}
 				if(!added) {
 					double ztz_add = (double)(neg ? (-ztz_i) : ztz_i);
-					write_buf.push_back(ztz_add);
-					ztz2_buf.push_back(ztz_add);
+					recs.push(ztz_add);
+					ztz2_buf_.push_back(ztz_add);
 				}
 			}
-			ztz_tok2 = strtok(NULL, ",");
+			ztz_tok2 = strtok_r(NULL, ",", &saveptr2);
 		}
 
 		// ... and finish with MAPQ and correct
-		write_buf.push_back((double)al1.mapq);
-		write_buf.push_back((double)al1.correct);
+		recs.push((double)al1.mapq);
+		recs.push((double)al1.correct);
+		if(recs.end_record() != 0) {
+			return -1;
+		}
 
 		//
 		// Now mate 2 again
 		//
-		write_buf.push_back((double)al2.line);
-		write_buf.push_back(len2_d);
-		write_buf.push_back(clip2_d);
-		write_buf.push_back(alqual2_d);
-		write_buf.push_back(clipqual2_d);
-		write_buf.insert(write_buf.end(), ztz2_buf.begin(), ztz2_buf.end());
-		write_buf.push_back(len1_d);
-		write_buf.push_back(clip1_d);
-		write_buf.push_back(alqual1_d);
-		write_buf.push_back(clipqual1_d);
-		write_buf.push_back(fraglen_d);
-		write_buf.insert(write_buf.end(), ztz1_buf.begin(), ztz1_buf.end());
-		write_buf.push_back((double)al2.mapq);
-		write_buf.push_back((double)al2.correct);
+		recs.push_id(al2.line);
+		recs.push(len2_d);
+		recs.push(clip2_d);
+		recs.push(alqual2_d);
+		recs.push(clipqual2_d);
+		recs.buf.insert(recs.buf.end(), ztz2_buf_.begin(), ztz2_buf_.end());
+		recs.push(len1_d);
+		recs.push(clip1_d);
+		recs.push(alqual1_d);
+		recs.push(clipqual1_d);
+		recs.push(fraglen_d);
+		recs.buf.insert(recs.buf.end(), ztz1_buf_.begin(), ztz1_buf_.end());
+		recs.push((double)al2.mapq);
+		recs.push((double)al2.correct);
 		
 		// Flush output buffer
-		size_t nwritten = fwrite(&(write_buf.front()), 8,
-			write_buf.size(), fh_recs);
-		if(nwritten != write_buf.size()) {
-			cerr << "Could not write all " << write_buf.size()
-				 << " doubles to record file" << endl;
+		if(recs.end_record() != 0) {
 			return -1;
 		}
-		write_buf.clear();
 	}
 
 	if(fh_model != NULL) {
@@ -1145,393 +1625,605 @@ static int print_paired_helper(
 			(unsigned long long)fraglen);
 	}
 
-	if(paired_model != NULL) {
-		size_t j = paired_model->add_part1();
-		if(j < paired_model->k()) {
-			paired_model->list().back().init(
-				al1.best_score + al2.best_score,
-				al1.best_score,
-				(int)al1.len,
-				fw_flag1,
-				al1.qual,
-				al1.edit_xscript.ptr(),
-				al2.best_score,
-				(int)al2.len,
-				fw_flag2,
-				al2.qual,
-				al2.edit_xscript.ptr(),
-				upstream1,
-				fraglen);
-		}
+	if(paired_model.active()) {
+		paired_model.add(
+			al1.best_score + al2.best_score,
+			al1.best_score,
+			(int)al1.len,
+			fw_flag1,
+			al1.qual,
+			al1.edit_xscript.ptr(),
+			al2.best_score,
+			(int)al2.len,
+			fw_flag2,
+			al2.qual,
+			al2.edit_xscript.ptr(),
+			upstream1,
+			fraglen);
 	}
 	return 0;
 }
 
 /**
- * Call print_paired_helper with the first alignment
- * (according to appearance in the SAM) first.
- */
-static int print_paired(
-	Alignment& al1,
-	Alignment& al2,
-	FILE *fh_model,
-	FILE *fh_recs,
-	ReservoirSampledEList<TemplatePaired> *paired_model)
-{
-	return print_paired_helper(al1.line < al2.line ? al1 : al2,
-	                           al1.line < al2.line ? al2 : al1,
-	                           fh_model,
-	                           fh_recs,
-	                           paired_model);
-}
-
-/**
- * Given a SAM record for an aligned read, count the number of comma-delimited
- * records in the ZT:Z extra field.
- */
-static int infer_num_ztzs(const char *rest_of_line) {
-	const char * cur = rest_of_line;
-	int n_ztz_fields = 1;
-	while(*cur != '\0') {
-		if(*cur++ == '\t') {
-			if(*cur++ == 'Z') {
-				if(*cur++ == 'T') {
-					if(strncmp(cur, ":Z:", 3) == 0) {
-						while(*cur++ != '\n') {
-							if(*cur == ',') {
-								n_ztz_fields++;
-							}
-						}
-					}
-				}
-			}
-		}
-	}
-	return n_ztz_fields;
-}
-
-/**
- *
+ * Parse a line, writing out records used to train a MAPQ model as well as
+ * records used to build an input model.  The line has length len, has had
+ * its newline removed, and is NUL-terminated.  It's tokenized in place and
+ * must stay put until the next line is parsed, since it might be a mate.
  */
-static size_t infer_read_length(const char *rest_of_line) {
-	size_t tabs = 0;
-	size_t len = 0;
-	const char *cur = rest_of_line;
-	while(true) {
-		if(*cur++ == '\t') {
-			tabs++;
-			if(tabs == 7) {
-				while(*cur++ != '\t') {
-					len++;
-				}
-				return len;
-			}
-		}
+int SamPass1Parser::parse_line(char *line, size_t len) {
+	counts.nline++;
+	if(line[0] == '@') {
+		counts.nhead++;
+		return 0; // skip header
 	}
-	assert(false);
-	return 0;
-}
-
-/**
- * Print column headers for an unpaired file of feature records.
- */
-static void print_unpaired_header(FILE *fh, int n_ztz_fields, unsigned long long nrow) {
-	fprintf(fh, "id,len,clip,alqual,clipqual,olen");
-	for(int i = 0; i < n_ztz_fields; i++) {
-		fprintf(fh, ",ztz%d", i);
-	}
-	fprintf(fh, ",mapq,correct,%llu\n", nrow);
-}
-
-/**
- * Print column headers for a paired-end file of feature records.
- */
-static void print_paired_header(FILE *fh, int n_ztz_fields, unsigned long long nrow) {
-	fprintf(fh, "id,len,clip,alqual,clipqual");
-	for(int i = 0; i < n_ztz_fields; i++) {
-		fprintf(fh, ",ztz_%d", i);
+	char *saveptr = NULL;
+	char *qname = strtok_r(line, "\t", &saveptr); assert(qname != NULL);
+	assert(qname == line);
+	char *flag_str = strtok_r(NULL, "\t", &saveptr); assert(flag_str != NULL);
+	int flag = atoi(flag_str);
+	if((flag & 256) != 0) {
+		counts.nsec++;
+		return 0;
 	}
-	fprintf(fh, ",olen,oclip,oalqual,oclipqual,fraglen");
-	for(int i = 0; i < n_ztz_fields; i++) {
-		fprintf(fh, ",oztz_%d", i);
+	if((flag & 2048) != 0) {
+		counts.nsupp++;
+		return 0;
 	}
-	fprintf(fh, ",mapq,correct,%llu\n", nrow);
-}
 
-/**
- * Read the input SAM file while simultaneously writing out records used to
- * train a MAPQ model as well as records used to build an input model.
- */
-static int sam_pass1(
-	FILE *fh,
-	const string& orec_u_fn, FILE *orec_u_fh,
-	const string& orec_u_meta_fn, FILE *orec_u_meta_fh,
-	const string& omod_u_fn, FILE *omod_u_fh,
-	const string& orec_b_fn, FILE *orec_b_fh,
-	const string& orec_b_meta_fn, FILE *orec_b_meta_fh,
-	const string& omod_b_fn, FILE *omod_b_fh,
-	const string& orec_c_fn, FILE *orec_c_fh,
-	const string& orec_c_meta_fn, FILE *orec_c_meta_fh,
-	const string& omod_c_fn, FILE *omod_c_fh,
-	const string& orec_d_fn, FILE *orec_d_fh,
-	const string& orec_d_meta_fn, FILE *orec_d_meta_fh,
-	const string& omod_d_fn, FILE *omod_d_fh,
-	ReservoirSampledEList<TemplateUnpaired> *u_templates,
-	ReservoirSampledEList<TemplateUnpaired> *b_templates,
-	ReservoirSampledEList<TemplatePaired> *c_templates,
-	ReservoirSampledEList<TemplatePaired> *d_templates,
-	bool quiet)
-{
-	/* Advise the kernel of our access pattern.  */
-	/* posix_fadvise(fd, 0, 0, 1); */ /* FDADVICE_SEQUENTIAL */
-
-    bool c_head = false, d_head = false, u_head = false, b_head = false;
-    int c_nztz = 0, d_nztz = 0, u_nztz = 0, b_nztz = 0;
-
-	char linebuf1[BUFSZ], linebuf2[BUFSZ];
-	int line1 = 1;
+	/* switch which buffer "line" points to */
+	line1_ = !line1_;
 	
-	Alignment al1, al2;
+	Alignment& al_cur  = al_cur1_ ? al1_ : al2_;
+	assert(!al_cur.valid);
+	al_cur.clear();
+	Alignment& al_prev = al_cur1_ ? al2_ : al1_;
+	al_cur1_ = !al_cur1_;
 	
-	int al_cur1 = 1;
+	al_cur.end_of_line = line + len;
+	/* for re-parsing */
+	al_cur.rest_of_line = std::min(flag_str + strlen(flag_str) + 1, al_cur.end_of_line);
+	al_cur.qname = qname;
+	al_cur.flag = flag;
+	al_cur.line = counts.nline;
 	
-	int nline = 0, nhead = 0, nsec = 0, nsupp = 0, npair = 0, nunp = 0;
-	int nunp_al = 0, nunp_unal = 0, npair_badend = 0, npair_conc = 0,
-	    npair_disc = 0, npair_unal = 0, ntyp_mismatch = 0;
-	
-	while(1) {
-		char *line = line1 ? linebuf1 : linebuf2;
-		if(fgets(line, BUFSZ, fh) == NULL) {
-			break; /* done */
-		}
-		nline++;
-		if(line[0] == '@') {
-			nhead++;
-			continue; // skip header
-		}
-		char *qname = strtok(line, "\t"); assert(qname != NULL);
-		assert(qname == line);
-		char *flag_str = strtok(NULL, "\t"); assert(flag_str != NULL);
-		int flag = atoi(flag_str);
-		if((flag & 256) != 0) {
-			nsec++;
-			continue;
+	/* If we're able to mate up ends at this time, do it */
+	Alignment *mate1 = NULL, *mate2 = NULL;
+	if(al_cur.mate_flag() != '0' && al_prev.valid) {
+		if(al_cur.mate_flag() == '1') {
+			if(al_prev.mate_flag() != '2') {
+				fprintf(stderr, "Consecutive records were both paired-end "
+				                "but were not from opposite ends: "
+				                "last_name=%s, name=%s\n",
+				                al_prev.qname, al_cur.qname);
+				throw 1;
+			}
+			assert(al_prev.mate_flag() == '2');
+			mate1 = &al_cur;
+			mate2 = &al_prev;
+		} else {
+			assert(al_cur.mate_flag() == '2');
+			assert(al_prev.mate_flag() == '1');
+			mate1 = &al_prev;
+			mate2 = &al_cur;
 		}
-		if((flag & 2048) != 0) {
-			nsupp++;
-			continue;
+		mate1->valid = mate2->valid = false;
+		counts.npair++;
+	}
+	
+	if(strncmp(al_cur.qname, sim_startswith, strlen(sim_startswith)) == 0) {
+		// skip to final !
+		char *cur = al_cur.qname;
+		assert(al_cur.typ == NULL);
+		while(*cur != '\0') {
+			if(*cur == sim_sep) {
+				al_cur.typ = cur+1;
+			}
+			cur++;
 		}
-
-		/* switch which buffer "line" points to */
-		line1 = !line1;
-		
-		Alignment& al_cur  = al_cur1 ? al1 : al2;
-		assert(!al_cur.valid);
-		al_cur.clear();
-		Alignment& al_prev = al_cur1 ? al2 : al1;
-		al_cur1 = !al_cur1;
+		assert(al_cur.typ != NULL);
+	}
+	
+	if(al_cur.mate_flag() == '0') {
+		counts.nunp++;
 		
-		al_cur.rest_of_line = flag_str + strlen(flag_str) + 1; /* for re-parsing */
-		al_cur.qname = qname;
-		al_cur.flag = flag;
-		al_cur.line = nline;
+		// Case 1: Current read is unpaired and unaligned, we can safely skip
+		if(!al_cur.is_aligned()) {
+			counts.nunp_unal++;
+			return 0;
+		}
 		
-		/* If we're able to mate up ends at this time, do it */
-		Alignment *mate1 = NULL, *mate2 = NULL;
-		if(al_cur.mate_flag() != '0' && al_prev.valid) {
-			if(al_cur.mate_flag() == '1') {
-				if(al_prev.mate_flag() != '2') {
-					fprintf(stderr, "Consecutive records were both paired-end "
-					                "but were not from opposite ends: "
-					                "last_name=%s, name=%s\n",
-					                al_prev.qname, al_cur.qname);
-					throw 1;
-				}
-				assert(al_prev.mate_flag() == '2');
-				mate1 = &al_cur;
-				mate2 = &al_prev;
-			} else {
-				assert(al_cur.mate_flag() == '2');
-				assert(al_prev.mate_flag() == '1');
-				mate1 = &al_prev;
-				mate2 = &al_cur;
+		// Case 2: Current read is unpaired and aligned
+		else if(al_cur.typ == NULL || al_cur.typ[0] == 'u') {
+			// If this is the first alignment, determine number of ZT:Z
+			// fields for the header line of the record output file
+			if(counts.nunp_al == 0 && u_recs.active()) {
+				u_nztz = infer_num_ztzs(al_cur.rest_of_line);
+			}
+
+			counts.nunp_al++;
+			if(print_unpaired(al_cur, 0, u_mod, u_recs, u_templates) != 0) {
+			    return -1;
+			}
+			if(u_templates.buffered) {
+				template_order_.push_back('u');
 			}
-			mate1->valid = mate2->valid = false;
-			npair++;
 		}
 		
-		if(strncmp(al_cur.qname, sim_startswith, strlen(sim_startswith)) == 0) {
-			// skip to final !
-			char *cur = al_cur.qname;
-			assert(al_cur.typ == NULL);
-			while(*cur != '\0') {
-				if(*cur == sim_sep) {
-					al_cur.typ = cur+1;
-				}
-				cur++;
-			}
-			assert(al_cur.typ != NULL);
+		else if(al_cur.typ != NULL) {
+			counts.ntyp_mismatch++; // type mismatch
+		}
+	}
+	
+	else if(mate1 != NULL) {
+		// Case 3: Current read is paired and unaligned, opposite mate is
+		// also unaligned; nothing more to do!
+		assert(mate2 != NULL);
+		if(!mate1->is_aligned() && !mate2->is_aligned()) {
+			counts.npair_unal++;
+			return 0;
 		}
 		
-		if(al_cur.mate_flag() == '0') {
-			nunp++;
-			
-			// Case 1: Current read is unpaired and unaligned, we can safely skip
-			if(!al_cur.is_aligned()) {
-				nunp_unal++;
-				continue;
-			}
-			
-			// Case 2: Current read is unpaired and aligned
-			else if(al_cur.typ == NULL || al_cur.typ[0] == 'u') {
+		// Case 4: Current read is paired and aligned, opposite mate is unaligned
+		// Case 5: Current read is paired and unaligned, opposite mate is aligned
+		//         we handle both here
+		else if(mate1->is_aligned() != mate2->is_aligned()) {
+			bool m1al = mate1->is_aligned();
+			Alignment& alm = m1al ? *mate1 : *mate2;
+			if(alm.typ == NULL || (alm.typ[0] == 'b' && alm.typ[1] == alm.mate_flag())) {
 				// If this is the first alignment, determine number of ZT:Z
-				// fields and write a header line to the record output file
-				if(nunp_al == 0 && orec_u_fh != NULL) {
-                    u_head = true;
-                    u_nztz = infer_num_ztzs(al_cur.rest_of_line);
+				// fields for the header line of the record output file
+				if(counts.npair_badend == 0 && b_recs.active()) {
+					b_nztz = infer_num_ztzs(alm.rest_of_line);
 				}
 
-				nunp_al++;
-				if(print_unpaired(al_cur, 0, omod_u_fh, orec_u_fh, u_templates) != 0) {
+				counts.npair_badend++;
+				// the call to infer_read_length is needed because we
+				// haven't parsed the sequence
+				if(print_unpaired(
+				    alm,
+					infer_read_length(m1al ? mate2->rest_of_line : mate1->rest_of_line),
+					b_mod, b_recs, b_templates) != 0)
+				{
 				    return -1;
 				}
+				if(b_templates.buffered) {
+					template_order_.push_back('b');
+				}
 			}
 			
-			else if(al_cur.typ != NULL) {
-				ntyp_mismatch++; // type mismatch
+			else if(alm.typ != NULL) {
+				counts.ntyp_mismatch++; // type mismatch
 			}
 		}
 		
-		else if(mate1 != NULL) {
-			// Case 3: Current read is paired and unaligned, opposite mate is
-			// also unaligned; nothing more to do!
-			assert(mate2 != NULL);
-			if(!mate1->is_aligned() && !mate2->is_aligned()) {
-				npair_unal++;
-				continue;
-			}
+		else {
+			assert(mate1->is_concordant() == mate2->is_concordant());
 			
-			// Case 4: Current read is paired and aligned, opposite mate is unaligned
-			// Case 5: Current read is paired and unaligned, opposite mate is aligned
-			//         we handle both here
-			else if(mate1->is_aligned() != mate2->is_aligned()) {
-				bool m1al = mate1->is_aligned();
-				Alignment& alm = m1al ? *mate1 : *mate2;
-				if(alm.typ == NULL || (alm.typ[0] == 'b' && alm.typ[1] == alm.mate_flag())) {
-					// If this is the first alignment, determine number of ZT:Z
-					// fields and write a header line to the record output file
-					if(npair_badend == 0 && orec_b_fh != NULL) {
-                        b_head = true;
-                        b_nztz = infer_num_ztzs(alm.rest_of_line);
+			if(mate1->is_concordant()) {
+				if(mate1->typ == NULL || mate1->typ[0] == 'c') {
+					if(counts.npair_conc == 0 && c_recs.active()) {
+						c_nztz = infer_num_ztzs(mate1->rest_of_line);
 					}
 
-					npair_badend++;
-					// the call to infer_read_length is needed because we
-					// haven't parsed the sequence
-					if(print_unpaired(
-					    alm,
-						infer_read_length(m1al ? mate2->rest_of_line : mate1->rest_of_line),
-						omod_b_fh, orec_b_fh, b_templates) != 0)
+					// Case 6: Current read is paired and both mates
+					// aligned, concordantly
+					counts.npair_conc++;
+					if(print_paired(*mate1, *mate2, c_mod,
+					                c_recs, c_templates) != 0)
 					{
 					    return -1;
 					}
+					if(c_templates.buffered) {
+						template_order_.push_back('c');
+					}
 				}
 				
-				else if(alm.typ != NULL) {
-					ntyp_mismatch++; // type mismatch
+				else if(mate1->typ != NULL) {
+					counts.ntyp_mismatch++; // type mismatch
 				}
 			}
 			
 			else {
-				assert(mate1->is_concordant() == mate2->is_concordant());
-				
-				if(mate1->is_concordant()) {
-					if(mate1->typ == NULL || mate1->typ[0] == 'c') {
-						if(npair_conc == 0 && orec_c_fh != NULL) {
-                            c_head = true;
-                            c_nztz = infer_num_ztzs(mate1->rest_of_line);
-						}
+				if(mate1->typ == NULL || mate1->typ[0] == 'd') {
+					if(counts.npair_disc == 0 && d_recs.active()) {
+						d_nztz = infer_num_ztzs(mate1->rest_of_line);
+					}
 
-						// Case 6: Current read is paired and both mates
-						// aligned, concordantly
-						npair_conc++;
-						if(print_paired(*mate1, *mate2, omod_c_fh,
-						                orec_c_fh, c_templates) != 0)
-						{
-						    return -1;
-						}
+					// Case 7: Current read is paired and both mates aligned, not condordantly
+					counts.npair_disc++;
+					if(print_paired(*mate1, *mate2, d_mod, d_recs, d_templates) != 0) {
+					    return -1;
 					}
-					
-					else if(mate1->typ != NULL) {
-						ntyp_mismatch++; // type mismatch
+					if(d_templates.buffered) {
+						template_order_.push_back('d');
 					}
 				}
-				
-				else {
-					if(mate1->typ == NULL || mate1->typ[0] == 'd') {
-						if(npair_disc == 0 && orec_d_fh != NULL) {
-                            d_head = true;
-                            d_nztz = infer_num_ztzs(mate1->rest_of_line);
-						}
-
-						// Case 7: Current read is paired and both mates aligned, not condordantly
-						npair_disc++;
-						if(print_paired(*mate1, *mate2, omod_d_fh, orec_d_fh, d_templates) != 0) {
-						    return -1;
-						}
-					}
 
-					else if(mate1->typ != NULL) {
-						ntyp_mismatch++; // type mismatch
-					}
+				else if(mate1->typ != NULL) {
+					counts.ntyp_mismatch++; // type mismatch
 				}
 			}
 		}
-		
-		else {
-			// This read is paired but we haven't seen the mate yet
-			assert(al_cur.mate_flag() != '0');
-			al_cur.valid = true;
+	}
+	
+	else {
+		// This read is paired but we haven't seen the mate yet
+		assert(al_cur.mate_flag() != '0');
+		al_cur.valid = true;
+	}
+	return 0;
+}
+
+/**
+ * Parse all the lines in a block in place.  The block should end with a
+ * newline; if it doesn't, the final line is copied somewhere it can be
+ * NUL-terminated.
+ */
+static int parse_block(SamPass1Parser& parser, char *blk, size_t blklen) {
+	char *cur = blk;
+	char *end = blk + blklen;
+	while(cur < end) {
+		char *nl = (char *)memchr(cur, '\n', end - cur);
+		if(nl == NULL) {
+			size_t len = end - cur;
+			if(len >= BUFSZ) {
+				cerr << "Error: SAM line longer than " << (BUFSZ-1)
+				     << " characters" << endl;
+				return -1;
+			}
+			char *line = parser.line_buf();
+			memcpy(line, cur, len);
+			line[len] = '\0';
+			return parser.parse_line(line, len);
+		}
+		*nl = '\0';
+		if(parser.parse_line(cur, nl - cur) != 0) {
+			return -1;
+		}
+		cur = nl + 1;
+	}
+	return 0;
+}
+
+/**
+ * One block of input SAM being parsed on a worker thread.
+ */
+struct Pass1Job {
+	SamPass1Parser *parser;
+	char *blk;
+	size_t len;
+	bool failed;
+};
+
+static void *pass1_worker(void *vjob) {
+	Pass1Job *job = (Pass1Job *)vjob;
+	try {
+		job->failed = parse_block(*job->parser, job->blk, job->len) != 0;
+	} catch(int e) {
+		job->failed = true;
+	}
+	return NULL;
+}
+
+/**
+ * Read the input SAM file while simultaneously writing out records used to
+ * train a MAPQ model as well as records used to build an input model.
+ * Regular files are mapped into memory and parsed in place.
+ */
+static int sam_pass1(FILE *fh, SamPass1Parser& parser) {
+	MappedFile mf;
+	if(mf.map(fh, true)) {
+		return parse_block(parser, mf.data(), mf.size());
+	}
+	while(1) {
+		char *line = parser.line_buf();
+		if(fgets(line, BUFSZ, fh) == NULL) {
+			break; /* done */
+		}
+		size_t len = strlen(line);
+		if(len > 0 && line[len-1] == '\n') {
+			line[--len] = '\0';
+		}
+		if(parser.parse_line(line, len) != 0) {
+			return -1;
+		}
+	}
+	return 0;
+}
+
+/**
+ * Like sam_pass1 but splits the input into blocks, keeping records with the
+ * same name (e.g. mates) in the same block, and parses nthreads blocks at a
+ * time on separate threads.  When the input is a stream, the next blocks are
+ * read while the current ones are parsed.  Results are absorbed into parser
+ * in input order, so output is identical to sam_pass1's.
+ */
+static int sam_pass1_threaded(FILE *fh, SamPass1Parser& parser, int nthreads) {
+	// Template record files aren't written in a defined order by workers
+	assert(parser.u_mod == NULL && parser.b_mod == NULL);
+	assert(parser.c_mod == NULL && parser.d_mod == NULL);
+	vector<SamPass1Parser *> workers(nthreads);
+	for(int i = 0; i < nthreads; i++) {
+		workers[i] = new SamPass1Parser();
+		workers[i]->buffer_like(parser);
+	}
+	MappedFile mf;
+	bool mapped = mf.map(fh, true);
+	LineBlockReader rd = mapped ?
+		LineBlockReader(mf.data(), mf.size(), PASS1_BLOCKSZ, true) :
+		LineBlockReader(fh, PASS1_BLOCKSZ, true);
+	vector<vector<char> > store(nthreads), next_store(nthreads);
+	vector<Pass1Job> jobs(nthreads), next_jobs(nthreads);
+	vector<pthread_t> tids(nthreads);
+	int nblk = 0;
+	while(nblk < nthreads && rd.next(store[nblk], jobs[nblk].blk, jobs[nblk].len)) {
+		nblk++;
+	}
+	int ret = 0;
+	while(nblk > 0 && ret == 0) {
+		for(int i = 0; i < nblk; i++) {
+			workers[i]->reset();
+			jobs[i].parser = workers[i];
+			jobs[i].failed = false;
+			if(pthread_create(&tids[i], NULL, pass1_worker, &jobs[i]) != 0) {
+				cerr << "Error: could not create parsing thread" << endl;
+				throw 1;
+			}
+		}
+		// get the next round of blocks while this round is parsed
+		int nnext = 0;
+		while(nnext < nthreads &&
+		      rd.next(next_store[nnext], next_jobs[nnext].blk, next_jobs[nnext].len))
+		{
+			nnext++;
+		}
+		for(int i = 0; i < nblk; i++) {
+			pthread_join(tids[i], NULL);
+		}
+		for(int i = 0; i < nblk && ret == 0; i++) {
+			if(jobs[i].failed || parser.absorb(*workers[i]) != 0) {
+				ret = -1;
+			}
 		}
+		store.swap(next_store);
+		jobs.swap(next_jobs);
+		nblk = nnext;
+	}
+	for(int i = 0; i < nthreads; i++) {
+		delete workers[i];
 	}
+	return ret;
+}
+
+int parse_feature_records(
+	FILE *fh,
+	int nthreads,
+	RecordWriter *u,
+	RecordWriter *b,
+	RecordWriter *c,
+	RecordWriter *d)
+{
+	SamPass1Parser parser;
+	parser.u_recs.out = u;
+	parser.b_recs.out = b;
+	parser.c_recs.out = c;
+	parser.d_recs.out = d;
+	return (nthreads > 1) ?
+		sam_pass1_threaded(fh, parser, nthreads) :
+		sam_pass1(fh, parser);
+}
+
+#ifndef QTIP_PARSE_NO_MAIN
+
+/**
+ * Print the lines of a feature record file's metadata, after the column
+ * names, describing its columnar layout: the row group size and then the
+ * type of each column.  A de-duplicated file has a final weight column.
+ */
+static void print_format_header(FILE *fh, bool paired, int n_ztz_fields, bool weighted) {
+	fprintf(fh, "format,columnar,%llu\n", (unsigned long long)ColumnarWriter::ROW_GROUP);
+	vector<int> typs;
+	record_col_types(paired, n_ztz_fields, typs);
+	if(weighted) {
+		typs.push_back(COL_I4);
+	}
+	fprintf(fh, "types");
+	for(size_t i = 0; i < typs.size(); i++) {
+		fprintf(fh, ",%s", col_type_name(typs[i]));
+	}
+	fprintf(fh, "\n");
+}
+
+/**
+ * Print column headers for an unpaired or paired-end file of feature
+ * records.
+ */
+static void print_record_header(FILE *fh, bool paired, int n_ztz_fields, unsigned long long nrow, bool weighted) {
+	vector<string> names;
+	record_col_names(paired, n_ztz_fields, names);
+	for(size_t i = 0; i < names.size(); i++) {
+		fprintf(fh, "%s%s", i == 0 ? "" : ",", names[i].c_str());
+	}
+	fprintf(fh, "%s,%llu\n", weighted ? ",weight" : "", nrow);
+	print_format_header(fh, paired, n_ztz_fields, weighted);
+}
+
+static void print_unpaired_header(FILE *fh, int n_ztz_fields, unsigned long long nrow, bool weighted) {
+	print_record_header(fh, false, n_ztz_fields, nrow, weighted);
+}
+
+static void print_paired_header(FILE *fh, int n_ztz_fields, unsigned long long nrow, bool weighted) {
+	print_record_header(fh, true, n_ztz_fields, nrow, weighted);
+}
+
+/**
+ * Return # rows in a feature record file, given the # records parsed.
+ */
+static unsigned long long table_nrow(const ColumnarWriter& w, unsigned long long nrec) {
+	return w.dedup() ? w.nrow() : nrec;
+}
+
+/**
+ * Write metadata for the feature record files and, unless quiet, a summary
+ * of what was parsed.
+ */
+static void sam_pass1_finish(
+	const SamPass1Parser& parser,
+	FILE *orec_u_meta_fh,
+	FILE *orec_b_meta_fh,
+	FILE *orec_c_meta_fh,
+	FILE *orec_d_meta_fh,
+	const ColumnarWriter& orec_u_w,
+	const ColumnarWriter& orec_b_w,
+	const ColumnarWriter& orec_c_w,
+	const ColumnarWriter& orec_d_w,
+	bool quiet)
+{
+	const Pass1Counts& c = parser.counts;
 
     // Write metadata
-    if(u_head) {
-		print_unpaired_header(orec_u_meta_fh, u_nztz, nunp_al);
+    if(parser.u_nztz >= 0) {
+		print_unpaired_header(orec_u_meta_fh, parser.u_nztz,
+		                      table_nrow(orec_u_w, c.nunp_al), orec_u_w.dedup());
     }
-    if(b_head) {
-		print_unpaired_header(orec_b_meta_fh, b_nztz, npair_badend);
+    if(parser.b_nztz >= 0) {
+		print_unpaired_header(orec_b_meta_fh, parser.b_nztz,
+		                      table_nrow(orec_b_w, c.npair_badend), orec_b_w.dedup());
     }
-    if(c_head) {
-		print_paired_header(orec_c_meta_fh, c_nztz, npair_conc * 2);
+    if(parser.c_nztz >= 0) {
+		print_paired_header(orec_c_meta_fh, parser.c_nztz,
+		                    table_nrow(orec_c_w, c.npair_conc * 2), orec_c_w.dedup());
     }
-    if(d_head) {
-		print_paired_header(orec_d_meta_fh, d_nztz, npair_disc * 2);
+    if(parser.d_nztz >= 0) {
+		print_paired_header(orec_d_meta_fh, parser.d_nztz,
+		                    table_nrow(orec_d_w, c.npair_disc * 2), orec_d_w.dedup());
     }
 
 	if(!quiet) {
-		cerr << "  " << nline << " lines" << endl;
-		cerr << "  " << nhead << " header lines" << endl;
-		cerr << "  " << nsec << " secondary alignments ignored" << endl;
-		cerr << "  " << nsupp << " supplementary alignments ignored" << endl;
-		cerr << "  " << ntyp_mismatch << " alignment type didn't match simulated type" << endl;
-		cerr << "  " << nunp << " unpaired" << endl;
-		if(nunp > 0) {
-			cerr << "    " << nunp_al << " aligned" << endl;
-			cerr << "    " << nunp_unal << " unaligned" << endl;
-		}
-		cerr << "  " << npair << " paired-end" << endl;
-		if(npair > 0) {
-			cerr << "    " << npair_conc << " concordant" << endl;
-			cerr << "    " << npair_disc << " discordant" << endl;
-			cerr << "    " << npair_badend << " bad-end" << endl;
-			cerr << "    " << npair_unal << " unaligned" << endl;
+		cerr << "  " << c.nline << " lines" << endl;
+		cerr << "  " << c.nhead << " header lines" << endl;
+		cerr << "  " << c.nsec << " secondary alignments ignored" << endl;
+		cerr << "  " << c.nsupp << " supplementary alignments ignored" << endl;
+		cerr << "  " << c.ntyp_mismatch << " alignment type didn't match simulated type" << endl;
+		cerr << "  " << c.nunp << " unpaired" << endl;
+		if(c.nunp > 0) {
+			cerr << "    " << c.nunp_al << " aligned" << endl;
+			cerr << "    " << c.nunp_unal << " unaligned" << endl;
+		}
+		cerr << "  " << c.npair << " paired-end" << endl;
+		if(c.npair > 0) {
+			cerr << "    " << c.npair_conc << " concordant" << endl;
+			cerr << "    " << c.npair_disc << " discordant" << endl;
+			cerr << "    " << c.npair_badend << " bad-end" << endl;
+			cerr << "    " << c.npair_unal << " unaligned" << endl;
+		}
+		const ColumnarWriter *ws[] = {&orec_u_w, &orec_b_w, &orec_c_w, &orec_d_w};
+		const char *names[] = {"unpaired", "bad-end", "concordant", "discordant"};
+		for(int i = 0; i < 4; i++) {
+			if(ws[i]->dedup() && ws[i]->nrec() > 0) {
+				cerr << "  " << ws[i]->nrec() << " " << names[i] << " feature records collapsed to "
+				     << ws[i]->nrow() << " distinct rows" << endl;
+			}
 		}
 	}
-	
+}
+
+/**
+ * Running mean and standard deviation (Welford).
+ */
+struct RunningStats {
+	RunningStats() : n(0), mean(0.0), m2(0.0) { }
+
+	void add(double x) {
+		n++;
+		double delta = x - mean;
+		mean += delta / n;
+		m2 += delta * (x - mean);
+	}
+
+	double sd() const {
+		return n > 1 ? sqrt(m2 / (n - 1)) : 0.0;
+	}
+
+	size_t n;
+	double mean;
+	double m2;
+};
+
+static void print_fingerprint_row(
+	FILE *fh,
+	char cat,
+	size_t count,
+	size_t ntemplates,
+	const RunningStats& len,
+	const RunningStats& score,
+	const RunningStats& fraglen)
+{
+	fprintf(fh, "%c,%llu,%llu,%0.4lf,%0.4lf,%0.4lf,%0.4lf,%0.4lf,%0.4lf\n",
+			cat, (unsigned long long)count, (unsigned long long)ntemplates,
+			len.mean, len.sd(), score.mean, score.sd(),
+			fraglen.mean, fraglen.sd());
+}
+
+static void fingerprint_unpaired(
+	FILE *fh,
+	char cat,
+	ReservoirSampledEList<TemplateUnpaired>& templates)
+{
+	RunningStats len, score, fraglen;
+	const EList<TemplateUnpaired>& ts = templates.list();
+	for(size_t i = 0; i < ts.size(); i++) {
+		len.add(ts[i].len_);
+		score.add(ts[i].best_score_);
+	}
+	print_fingerprint_row(fh, cat, templates.size(), ts.size(), len, score, fraglen);
+}
+
+static void fingerprint_paired(
+	FILE *fh,
+	char cat,
+	ReservoirSampledEList<TemplatePaired>& templates)
+{
+	RunningStats len, score, fraglen;
+	const EList<TemplatePaired>& ts = templates.list();
+	for(size_t i = 0; i < ts.size(); i++) {
+		len.add(ts[i].len_1_);
+		len.add(ts[i].len_2_);
+		score.add(ts[i].score_12_);
+		fraglen.add((double)ts[i].fraglen_);
+	}
+	print_fingerprint_row(fh, cat, templates.size(), ts.size(), len, score, fraglen);
+}
+
+/**
+ * Write a summary of the input model that can be compared across runs to
+ * decide whether a MAPQ model trained for one input applies to another:
+ * per-category counts along with the mean and standard deviation of read
+ * length, alignment score and fragment length over the sampled templates.
+ */
+static int write_fingerprint(
+	const string& fn,
+	ReservoirSampledEList<TemplateUnpaired>& u_templates,
+	ReservoirSampledEList<TemplateUnpaired>& b_templates,
+	ReservoirSampledEList<TemplatePaired>& c_templates,
+	ReservoirSampledEList<TemplatePaired>& d_templates)
+{
+	FILE *fh = fopen(fn.c_str(), "wb");
+	if(fh == NULL) {
+		cerr << "Could not open output fingerprint file \"" << fn << "\"" << endl;
+		return -1;
+	}
+	fprintf(fh, "category,count,ntemplates,len_mean,len_sd,score_mean,"
+	            "score_sd,fraglen_mean,fraglen_sd\n");
+	fingerprint_unpaired(fh, 'u', u_templates);
+	fingerprint_unpaired(fh, 'b', b_templates);
+	fingerprint_paired(fh, 'c', c_templates);
+	fingerprint_paired(fh, 'd', d_templates);
+	fclose(fh);
 	return 0;
 }
 
+
 #define FILEDEC(fn, fh, buf, typ, do_open) \
 	char buf [BUFSZ]; \
 	FILE * fh = NULL; \
@@ -1563,6 +2255,9 @@ int main(int argc, char **argv) {
 		     << "sim-disc-min "
 		     << "sim-bad-end-min "
 		     << "seed "
+		     << "parse-threads "
+		     << "sim-threads "
+		     << "dedup-features "
 		     << endl;
 		return 0;
 	}
@@ -1575,7 +2270,10 @@ int main(int argc, char **argv) {
     string orec_b_meta_fn;
     string orec_c_meta_fn;
     string orec_d_meta_fn;
+	string orec_u_idmap_fn, orec_b_idmap_fn, orec_c_idmap_fn, orec_d_idmap_fn;
 	string prefix, mod_prefix;
+	string fingerprint_fn;
+	string save_model_fn, load_model_fn;
 	vector<string> fastas, sams;
 	char buf_input_sam[BUFSZ];
 	
@@ -1666,6 +2364,30 @@ int main(int argc, char **argv) {
 				else if(strcmp(argv[i], "sim-bad-end-min") == 0) {
 					sim_bad_end_min = atoi(argv[++i]);
 				}
+				else if(strcmp(argv[i], "parse-threads") == 0) {
+					parse_threads = atoi(argv[++i]);
+					if(parse_threads < 1) {
+						cerr << "Error: parse-threads must be at least 1" << endl;
+						return -1;
+					}
+				}
+				else if(strcmp(argv[i], "sim-threads") == 0) {
+					sim_threads = atoi(argv[++i]);
+					if(sim_threads < 1) {
+						cerr << "Error: sim-threads must be at least 1" << endl;
+						return -1;
+					}
+				}
+				else if(strcmp(argv[i], "dedup-features") == 0) {
+					i++;
+					dedup_features = strcmp(argv[i], "True") == 0 || strcmp(argv[i], "1") == 0;
+				}
+				else if(strcmp(argv[i], "save-input-model") == 0) {
+					save_model_fn = argv[++i];
+				}
+				else if(strcmp(argv[i], "load-input-model") == 0) {
+					load_model_fn = argv[++i];
+				}
 				else if(strcmp(argv[i], "seed") == 0) {
 					// Unsure whether this is a good way to do this
 					i++;
@@ -1691,6 +2413,12 @@ int main(int argc, char **argv) {
 				orec_b_meta_fn = prefix + string("_rec_b.meta");
 				orec_c_meta_fn = prefix + string("_rec_c.meta");
 				orec_d_meta_fn = prefix + string("_rec_d.meta");
+
+				// line id -> row maps for de-duplicated matrices
+				orec_u_idmap_fn = prefix + string("_rec_u.idmap");
+				orec_b_idmap_fn = prefix + string("_rec_b.idmap");
+				orec_c_idmap_fn = prefix + string("_rec_c.idmap");
+				orec_d_idmap_fn = prefix + string("_rec_d.idmap");
 			} else {
 				mod_prefix = argv[i];
 				mod_prefix_set++;
@@ -1700,6 +2428,7 @@ int main(int argc, char **argv) {
 				omod_b_fn = mod_prefix + string("_mod_b.csv");
 				omod_c_fn = mod_prefix + string("_mod_c.csv");
 				omod_d_fn = mod_prefix + string("_mod_d.csv");
+				fingerprint_fn = mod_prefix + string("_fingerprint.csv");
 
 				// simulated (tandem) reads
 				oread_u_fn = mod_prefix + string("_reads_u.fastq");
@@ -1717,28 +2446,59 @@ int main(int argc, char **argv) {
 				cerr << "Warning: More than one model output prefix specified; using last one: \"" << mod_prefix << "\"" << endl;
 			}
 		}
-		if(sams.empty() || !prefix_set) {
+		if((sams.empty() && load_model_fn.empty()) || !prefix_set) {
 			cerr << "Usage: qtip_parse_input [modes]* -- [argument value]* -- [sam]* -- [fasta]* -- [record prefix] -- [read/model prefix]" << endl;
+			cerr << "[sam] can be - to read SAM from standard input, and is "
+			     << "omitted when simulating from a saved input model" << endl;
 			cerr << "[record prefix] is prefix for record files" << endl;
 			cerr << "[read/model prefix] is prefix for simulated read and model files" << endl;
 			cerr << "Modes:" << endl;
 			cerr << "  f: write feature records for learning/prediction" << endl;
-			cerr << "  i: write input-model templates (requires [read/model prefix])" << endl;
+			cerr << "  i: write input-model fingerprint (requires [read/model prefix])" << endl;
 			cerr << "  s: simulate reads based on input model templates (requires [read/model prefix])" << endl;
 			cerr << "Arguments:" << endl;
 			// TODO: better documentation here
 			cerr << "  wiggle <int>: if the reported alignment is within "
 			     << "this many of the true alignment, it's considered correct"
 			     << endl;
+			cerr << "  parse-threads <int>: parse input SAM using this many "
+			     << "threads" << endl;
+			cerr << "  sim-threads <int>: simulate reads using this many "
+			     << "threads" << endl;
+			cerr << "  dedup-features <True|False>: write each distinct "
+			     << "feature record once, with a weight, plus a map from "
+			     << "alignment ids to rows" << endl;
+			cerr << "  save-input-model <file>: save input model templates "
+			     << "for use with load-input-model" << endl;
+			cerr << "  load-input-model <file>: take input model templates "
+			     << "from file instead of parsing SAM; modes i and s only"
+			     << endl;
 		}
 	}
-	keep_templates = do_simulation;
+	keep_templates = do_simulation || do_input_model;
 
 	if(do_simulation && mod_prefix_set == 0) {
 		cerr << "s (simulation) argument specified, but [read/model prefix] not specified" << endl;
 		return -1;
 	}
 
+	if(do_input_model && mod_prefix_set == 0) {
+		cerr << "i (input model) argument specified, but [read/model prefix] not specified" << endl;
+		return -1;
+	}
+
+	bool loading_model = !load_model_fn.empty();
+	if(loading_model && (do_features || !sams.empty())) {
+		cerr << "load-input-model specified along with f mode or SAM files; "
+		     << "the input model is loaded instead of parsing SAM" << endl;
+		return -1;
+	}
+
+	if(!save_model_fn.empty() && !(do_simulation || do_input_model)) {
+		cerr << "save-input-model specified without i or s mode" << endl;
+		return -1;
+	}
+
 	FILEDEC(orec_u_fn, orec_u_fh, orec_u_buf, "feature", do_features);
 	FILEDEC(orec_u_meta_fn, orec_u_meta_fh, orec_u_meta_buf, "feature", do_features);
 	FILEDEC(omod_u_fn, omod_u_fh, omod_u_buf, "template record", false);
@@ -1752,55 +2512,104 @@ int main(int argc, char **argv) {
 	FILEDEC(orec_d_meta_fn, orec_d_meta_fh, orec_d_meta_buf, "feature", do_features);
 	FILEDEC(omod_d_fn, omod_d_fh, omod_d_buf, "template record", false);
 
+	bool do_idmap = do_features && dedup_features;
+	FILEDEC(orec_u_idmap_fn, orec_u_idmap_fh, orec_u_idmap_buf, "feature", do_idmap);
+	FILEDEC(orec_b_idmap_fn, orec_b_idmap_fh, orec_b_idmap_buf, "feature", do_idmap);
+	FILEDEC(orec_c_idmap_fn, orec_c_idmap_fh, orec_c_idmap_buf, "feature", do_idmap);
+	FILEDEC(orec_d_idmap_fn, orec_d_idmap_fh, orec_d_idmap_buf, "feature", do_idmap);
+
+	// feature records are written in columnar row groups
+	ColumnarWriter orec_u_w(orec_u_fh, false, orec_u_idmap_fh);
+	ColumnarWriter orec_b_w(orec_b_fh, false, orec_b_idmap_fh);
+	ColumnarWriter orec_c_w(orec_c_fh, true, orec_c_idmap_fh);
+	ColumnarWriter orec_d_w(orec_d_fh, true, orec_d_idmap_fh);
+
 	ReservoirSampledEList<TemplateUnpaired> u_templates(input_model_size);
 	ReservoirSampledEList<TemplateUnpaired> b_templates(input_model_size);
 	ReservoirSampledEList<TemplatePaired> c_templates(input_model_size);
 	ReservoirSampledEList<TemplatePaired> d_templates(input_model_size);
 
-	if(do_features || do_input_model || do_simulation) {
+	if(!loading_model && (do_features || do_input_model || do_simulation)) {
+		SamPass1Parser parser;
+		parser.u_recs.out = orec_u_fh == NULL ? NULL : &orec_u_w;
+		parser.b_recs.out = orec_b_fh == NULL ? NULL : &orec_b_w;
+		parser.c_recs.out = orec_c_fh == NULL ? NULL : &orec_c_w;
+		parser.d_recs.out = orec_d_fh == NULL ? NULL : &orec_d_w;
+		parser.u_mod = omod_u_fh;
+		parser.b_mod = omod_b_fh;
+		parser.c_mod = omod_c_fh;
+		parser.d_mod = omod_d_fh;
+		parser.u_templates.reservoir = keep_templates ? &u_templates : NULL;
+		parser.b_templates.reservoir = keep_templates ? &b_templates : NULL;
+		parser.c_templates.reservoir = keep_templates ? &c_templates : NULL;
+		parser.d_templates.reservoir = keep_templates ? &d_templates : NULL;
 		for(size_t i = 0; i < sams.size(); i++) {
-			cerr << "Parsing SAM file \"" << sams[i] << "\" (seed=" << seed << ")" << endl;
-			FILE *fh = fopen(sams[i].c_str(), "rb");
+			cerr << "Parsing SAM file \"" << sams[i] << "\" (seed=" << seed
+			     << ", threads=" << parse_threads << ")" << endl;
+			// "-" means read SAM from stdin, e.g. streamed from the aligner
+			bool from_stdin = sams[i] == "-";
+			FILE *fh = from_stdin ? stdin : fopen(sams[i].c_str(), "rb");
 			if(fh == NULL) {
 				cerr << "Could not open input SAM file \"" << sams[i] << "\"" << endl;
 				return -1;
 			}
 			setvbuf(fh, buf_input_sam, _IOFBF, BUFSZ);
-			sam_pass1(fh,
-					  orec_u_fn, orec_u_fh,
-					  orec_u_meta_fn, orec_u_meta_fh,
-					  omod_u_fn, omod_u_fh,
-					  orec_b_fn, orec_b_fh,
-					  orec_b_meta_fn, orec_b_meta_fh,
-					  omod_b_fn, omod_b_fh,
-					  orec_c_fn, orec_c_fh,
-					  orec_c_meta_fn, orec_c_meta_fh,
-					  omod_c_fn, omod_c_fh,
-					  orec_d_fn, orec_d_fh,
-					  orec_d_meta_fn, orec_d_meta_fh,
-					  omod_d_fn, omod_d_fh,
-					  keep_templates ? &u_templates : NULL,
-					  keep_templates ? &b_templates : NULL,
-					  keep_templates ? &c_templates : NULL,
-					  keep_templates ? &d_templates : NULL,
-					  false); // not quiet
-			fclose(fh);
+			parser.reset();
+			int ret = (parse_threads > 1) ?
+				sam_pass1_threaded(fh, parser, parse_threads) :
+				sam_pass1(fh, parser);
+			if(ret != 0) {
+				return -1;
+			}
+			sam_pass1_finish(parser,
+			                 orec_u_meta_fh, orec_b_meta_fh,
+			                 orec_c_meta_fh, orec_d_meta_fh,
+			                 orec_u_w, orec_b_w, orec_c_w, orec_d_w,
+			                 false); // not quiet
+			if(!from_stdin) {
+				fclose(fh);
+			}
 		}
 	}
 
+	if((orec_u_fh != NULL && orec_u_w.finish() != 0) ||
+	   (orec_b_fh != NULL && orec_b_w.finish() != 0) ||
+	   (orec_c_fh != NULL && orec_c_w.finish() != 0) ||
+	   (orec_d_fh != NULL && orec_d_w.finish() != 0))
+	{
+		return -1;
+	}
+	// Column statistics go in the metadata after the column types
+	if(orec_u_meta_fh != NULL && orec_u_w.ncol() > 0) orec_u_w.print_stats(orec_u_meta_fh);
+	if(orec_b_meta_fh != NULL && orec_b_w.ncol() > 0) orec_b_w.print_stats(orec_b_meta_fh);
+	if(orec_c_meta_fh != NULL && orec_c_w.ncol() > 0) orec_c_w.print_stats(orec_c_meta_fh);
+	if(orec_d_meta_fh != NULL && orec_d_w.ncol() > 0) orec_d_w.print_stats(orec_d_meta_fh);
 	if(omod_u_fh != NULL) fclose(omod_u_fh);
 	if(orec_u_fh != NULL) fclose(orec_u_fh);
 	if(orec_u_meta_fh != NULL) fclose(orec_u_meta_fh);
+	if(orec_u_idmap_fh != NULL) fclose(orec_u_idmap_fh);
 	if(omod_b_fh != NULL) fclose(omod_b_fh);
 	if(orec_b_fh != NULL) fclose(orec_b_fh);
 	if(orec_b_meta_fh != NULL) fclose(orec_b_meta_fh);
+	if(orec_b_idmap_fh != NULL) fclose(orec_b_idmap_fh);
 	if(omod_c_fh != NULL) fclose(omod_c_fh);
 	if(orec_c_fh != NULL) fclose(orec_c_fh);
 	if(orec_c_meta_fh != NULL) fclose(orec_c_meta_fh);
+	if(orec_c_idmap_fh != NULL) fclose(orec_c_idmap_fh);
 	if(omod_d_fh != NULL) fclose(omod_d_fh);
 	if(orec_d_fh != NULL) fclose(orec_d_fh);
 	if(orec_d_meta_fh != NULL) fclose(orec_d_meta_fh);
-	cerr << "Finished parsing SAM" << endl;
+	if(orec_d_idmap_fh != NULL) fclose(orec_d_idmap_fh);
+	if(loading_model) {
+		cerr << "Loading input model from \"" << load_model_fn << "\"" << endl;
+		if(load_input_model(load_model_fn, u_templates, b_templates,
+		                    c_templates, d_templates) != 0)
+		{
+			return -1;
+		}
+	} else {
+		cerr << "Finished parsing SAM" << endl;
+	}
 
 	if(keep_templates) {
 		cerr << "Input model in memory:" << endl;
@@ -1822,6 +2631,22 @@ int main(int argc, char **argv) {
 		}
 	}
 
+	if(!save_model_fn.empty()) {
+		if(save_input_model(save_model_fn, u_templates, b_templates,
+		                    c_templates, d_templates) != 0)
+		{
+			return -1;
+		}
+	}
+
+	if(do_input_model) {
+		if(write_fingerprint(fingerprint_fn, u_templates, b_templates,
+		                     c_templates, d_templates) != 0)
+		{
+			return -1;
+		}
+	}
+
 	if(do_simulation) {
 		InputModelUnpaired u_model(u_templates.list(), u_templates.size(), fraction_even, low_score_bias);
 		InputModelUnpaired b_model(b_templates.list(), b_templates.size(), fraction_even, low_score_bias);
@@ -1848,14 +2673,26 @@ int main(int argc, char **argv) {
 		cerr << "  Estimate total number of FASTA bases is a bit less than "
 		     << ss.num_estimated_bases() / 1000 << "k" << endl;
 		
-		cerr << "  Simulating reads..." << endl;
-		ss.simulate_batch(
-			sim_factor,
-			sim_function,
-			sim_unp_min,
-			sim_conc_min,
-			sim_disc_min,
-			sim_bad_end_min);
+		cerr << "  Simulating reads (threads=" << sim_threads << ")..." << endl;
+		if(sim_threads > 1) {
+			ss.simulate_batch_threaded(
+				sim_factor,
+				sim_function,
+				sim_unp_min,
+				sim_conc_min,
+				sim_disc_min,
+				sim_bad_end_min,
+				sim_threads,
+				seed);
+		} else {
+			ss.simulate_batch(
+				sim_factor,
+				sim_function,
+				sim_unp_min,
+				sim_conc_min,
+				sim_disc_min,
+				sim_bad_end_min);
+		}
 		
 		fclose(oread_u_fh);
 		fclose(oread1_b_fh);
@@ -1866,3 +2703,5 @@ int main(int argc, char **argv) {
 		fclose(oread2_d_fh);
 	}
 }
+
+#endif /* QTIP_PARSE_NO_MAIN */
@@ -0,0 +1,31 @@
+//
+//  qtip_parse.h
+//  qtip
+//
+//  Copyright (c) 2016 JHU. All rights reserved.
+//
+
+#ifndef __qtip__qtip_parse__
+#define __qtip__qtip_parse__
+
+#include <stdio.h>
+#include "colfile.h"
+
+extern int wiggle;
+extern int max_allowed_fraglen;
+
+/**
+ * Parse SAM from fh, using nthreads threads, sending the feature records
+ * for unpaired (u), bad-end (b), concordant (c) and discordant (d)
+ * alignments to the given writers, exactly as qtip-parse does in mode f.
+ * Writers may be NULL.  Returns -1 on error.
+ */
+int parse_feature_records(
+	FILE *fh,
+	int nthreads,
+	RecordWriter *u,
+	RecordWriter *b,
+	RecordWriter *c,
+	RecordWriter *d);
+
+#endif /* defined(__qtip__qtip_parse__) */
@@ -12,8 +12,13 @@
 #include <string>
 #include <vector>
 #include <cassert>
+#include <stdlib.h>
+#include <pthread.h>
 #include "qtip_rewrite.h"
 #include "predmerge.h"
+#include "blockio.h"
+#include "forest.h"
+#include "qtip_parse.h"
 
 using namespace std;
 
@@ -29,49 +34,60 @@ const char *precise_mapq_flag = "Zp:Z";
 
 bool keep_ztz = false;
 
+int rewrite_threads = 1;
+
+// rows per chunk when post-processing predictions made with a model file
+size_t model_chunk_rows = 0;
+
 const static size_t BUFSZ = 262144;
 
+/* size of the blocks of input SAM handed to each rewriting thread */
+const static size_t REWRITE_BLOCKSZ = 4 * 1024 * 1024;
+
 /**
- * Write a new line of SAM (buf) to output filehandle (osam_fh) replacing the
- * existing MAPQ with the predicted one (mapq).
+ * Write a new line of SAM (buf, of length len) to output filehandle
+ * (osam_fh) replacing the existing MAPQ with the predicted one (mapq).  The
+ * line needn't be NUL-terminated.  Unchanged stretches of the line are
+ * written in bulk.
  */
-static void rewrite(FILE *fh, char *buf, double mapq) {
-	char orig[10];
-	char *orig_cur = orig;
+static void rewrite(FILE *fh, const char *buf, size_t len, double mapq) {
+	const char *end = buf + len;
+	while(end > buf && (end[-1] == '\n' || end[-1] == '\r')) {
+		end--;
+	}
+	// Everything up to and including the tab before MAPQ is unchanged
+	const char *cur = buf;
 	for(int i = 0; i < 4; i++) {
-		while(*buf != '\t') {
-		    putc_unlocked(*buf++, fh);
-		}
-		putc_unlocked(*buf++, fh);
+		cur = (const char *)memchr(cur, '\t', end - cur);
+		assert(cur != NULL);
+		cur++;
 	}
+	fwrite(buf, 1, cur - buf, fh);
 	// Replace MAPQ with our new one
 	int mapq_rounded = (int)(mapq + 0.5);
 	fprintf(fh, "%d", mapq_rounded);
-	while(*buf != '\t') {
-		// Copy orginal to buffer?
-		*orig_cur++ = *buf++;
-	}
-	*orig_cur = '\0';
-	while(*buf != '\n' && *buf != '\r') {
-		if(!keep_ztz && *buf == '\t') {
-			if(strncmp(buf+1, "ZT:Z:", 5) == 0) { // Remove the ZT:Z
-				buf += 6;
-				while(true) {
-					if(*buf == '\t' || *buf == '\n' || *buf == '\r') {
-						break;
-					}
-					buf++;
-				}
-			}
-			if(*buf == '\n' || *buf == '\r') {
-				break;
-			}
+	const char *orig = cur;
+	cur = (const char *)memchr(cur, '\t', end - cur);
+	assert(cur != NULL);
+	const size_t orig_len = cur - orig;
+	// Copy the rest, minus any ZT:Z fields
+	const char *span = cur;
+	while(!keep_ztz && cur < end) {
+		const char *tab = (const char *)memchr(cur, '\t', end - cur);
+		if(tab == NULL) {
+			break;
+		}
+		if(end - tab > 5 && strncmp(tab+1, "ZT:Z:", 5) == 0) { // Remove the ZT:Z
+			fwrite(span, 1, tab - span, fh);
+			const char *next = (const char *)memchr(tab+1, '\t', end - (tab+1));
+			span = cur = (next == NULL) ? end : next;
+		} else {
+			cur = tab + 1;
 		}
-		putc_unlocked(*buf, fh);
-		buf++;
 	}
+	fwrite(span, 1, end - span, fh);
 	if(write_orig_mapq) {
-		fprintf(fh, "\t%s:%s", orig_mapq_flag, orig);
+		fprintf(fh, "\t%s:%.*s", orig_mapq_flag, (int)orig_len, orig);
 	}
 	if(write_precise_mapq) {
 		fprintf(fh, "\t%s:%0.3lf", precise_mapq_flag, mapq);
@@ -79,6 +95,209 @@ static void rewrite(FILE *fh, char *buf, double mapq) {
 	putc_unlocked('\n', fh);
 }
 
+/**
+ * A block of input SAM to be rewritten on a worker thread.  Output
+ * accumulates in memory until it can be written in order.
+ */
+struct RewriteJob {
+	char *blk;
+	size_t len;
+	unsigned long long first_line; // line number of first line in block
+	const PredictionTable *table;
+	char *out;
+	size_t outlen;
+	size_t nhead, nskip, nrewrite;
+	bool failed;
+};
+
+static void *rewrite_worker(void *vjob) {
+	RewriteJob *job = (RewriteJob *)vjob;
+	job->nhead = job->nskip = job->nrewrite = 0;
+	FILE *fh = open_memstream(&job->out, &job->outlen);
+	if(fh == NULL) {
+		job->failed = true;
+		return NULL;
+	}
+	const char *cur = job->blk;
+	const char *end = cur + job->len;
+	unsigned long long nline = job->first_line - 1;
+	double mapq = 0.0;
+	while(cur < end) {
+		const char *line = cur;
+		const char *nl = (const char *)memchr(cur, '\n', end - cur);
+		cur = (nl == NULL) ? end : nl + 1;
+		size_t len = cur - line;
+		nline++;
+		if(line[0] == '@') {
+			job->nhead++;
+			fwrite(line, 1, len, fh);
+			continue; // skip header
+		}
+		if(!job->table->get(nline, mapq)) {
+			fwrite(line, 1, len, fh); // no prediction for this line
+			job->nskip++;
+			continue;
+		}
+		rewrite(fh, line, len, mapq);
+		job->nrewrite++;
+	}
+	fclose(fh);
+	job->failed = false;
+	return NULL;
+}
+
+/**
+ * Fill up to jobs.size() jobs with blocks of SAM.  nline is the number of
+ * lines given to jobs so far.  Returns number of jobs filled.
+ */
+static size_t next_rewrite_round(
+	LineBlockReader& rd,
+	const PredictionTable& table,
+	unsigned long long& nline,
+	vector<vector<char> >& store,
+	vector<RewriteJob>& jobs)
+{
+	size_t njob = 0;
+	while(njob < jobs.size() && rd.next(store[njob], jobs[njob].blk, jobs[njob].len)) {
+		RewriteJob& job = jobs[njob++];
+		job.first_line = nline + 1;
+		job.table = &table;
+		const char *cur = job.blk, *end = job.blk + job.len;
+		while((cur = (const char *)memchr(cur, '\n', end - cur)) != NULL) {
+			cur++;
+			nline++;
+		}
+	}
+	return njob;
+}
+
+/**
+ * Check that there's no prediction for a line past the end of the input
+ * SAM, which has nline lines.  Returns -1 if there is.
+ */
+static int check_prediction_lines(const PredictionTable& table, unsigned long long nline) {
+	unsigned long long end = table.end();
+	if(end > nline + 1) {
+		cerr << "Error: prediction for line " << (end - 1) << " but input SAM has only "
+		     << nline << " lines" << endl;
+		return -1;
+	}
+	return 0;
+}
+
+/**
+ * Rewrite SAM from fh_sam to osam_fh using predictions from table, splitting the
+ * input into blocks and rewriting nthreads blocks at a time on separate
+ * threads.  The next blocks are gathered while the current ones are being
+ * rewritten, and output is written in input order.
+ */
+static int rewrite_threaded(
+	FILE *fh_sam,
+	FILE *osam_fh,
+	const PredictionTable& table,
+	int nthreads,
+	size_t& nhead,
+	size_t& nskip,
+	size_t& nrewrite)
+{
+	MappedFile mf;
+	bool mapped = mf.map(fh_sam, false);
+	LineBlockReader rd = mapped ?
+		LineBlockReader(mf.data(), mf.size(), REWRITE_BLOCKSZ, false) :
+		LineBlockReader(fh_sam, REWRITE_BLOCKSZ, false);
+	vector<vector<char> > store(nthreads), next_store(nthreads);
+	vector<RewriteJob> jobs(nthreads), next_jobs(nthreads);
+	vector<pthread_t> tids(nthreads);
+	unsigned long long nline = 0;
+	size_t njob = next_rewrite_round(rd, table, nline, store, jobs);
+	int ret = 0;
+	while(njob > 0) {
+		for(size_t i = 0; i < njob; i++) {
+			if(pthread_create(&tids[i], NULL, rewrite_worker, &jobs[i]) != 0) {
+				cerr << "Error: could not create rewriting thread" << endl;
+				throw 1;
+			}
+		}
+		// gather the next round while this one is rewritten
+		size_t nnext = next_rewrite_round(rd, table, nline, next_store, next_jobs);
+		for(size_t i = 0; i < njob; i++) {
+			pthread_join(tids[i], NULL);
+		}
+		for(size_t i = 0; i < njob; i++) {
+			if(jobs[i].failed) {
+				cerr << "Error: could not buffer rewritten SAM" << endl;
+				ret = -1;
+			} else {
+				if(ret == 0 && fwrite(jobs[i].out, 1, jobs[i].outlen, osam_fh) != jobs[i].outlen) {
+					cerr << "Error: could not write output SAM" << endl;
+					ret = -1;
+				}
+				free(jobs[i].out);
+			}
+			nhead += jobs[i].nhead;
+			nskip += jobs[i].nskip;
+			nrewrite += jobs[i].nrewrite;
+		}
+		if(ret != 0) {
+			return ret;
+		}
+		store.swap(next_store);
+		jobs.swap(next_jobs);
+		njob = nnext;
+	}
+	return check_prediction_lines(table, nline);
+}
+
+/**
+ * Parse the input SAM for feature records, the same way qtip-parse does,
+ * and predict MAPQs for them with the forests in the model file written by
+ * MapqFit.export_forests, adding them to table.  The SAM is rewound
+ * afterwards, ready to be rewritten.
+ */
+static int predict_with_model(
+	FILE *fh_sam,
+	const string& model_fn,
+	PredictionTable& table)
+{
+	vector<Forest> forests;
+	if(load_forests(model_fn, forests) != 0) {
+		return -1;
+	}
+	const char *cats = "ubcd";
+	const Forest *fs[] = {NULL, NULL, NULL, NULL};
+	for(size_t i = 0; i < forests.size(); i++) {
+		const char *cat = strchr(cats, forests[i].category);
+		if(forests[i].category == '\0' || cat == NULL) {
+			cerr << "Error: model for unknown alignment category '"
+			     << forests[i].category << "'" << endl;
+			return -1;
+		}
+		fs[cat - cats] = &forests[i];
+	}
+	ForestEvaluator u(fs[0], false), b(fs[1], false), c(fs[2], true), d(fs[3], true);
+	cerr << "Predicting MAPQs with model \"" << model_fn << "\"" << endl;
+	if(parse_feature_records(fh_sam, rewrite_threads, &u, &b, &c, &d) != 0) {
+		return -1;
+	}
+	ForestEvaluator *evs[] = {&u, &b, &c, &d};
+	for(int i = 0; i < 4; i++) {
+		size_t ndeferred = evs[i]->ndeferred();
+		if(evs[i]->finish(model_chunk_rows) != 0) {
+			return -1;
+		}
+		const vector<Prediction>& preds = evs[i]->predictions();
+		for(size_t j = 0; j < preds.size(); j++) {
+			table.add(preds[j]);
+		}
+		if(!preds.empty()) {
+			cerr << "  " << preds.size() << " " << cats[i] << " predictions ("
+			     << ndeferred << " with missing features)" << endl;
+		}
+	}
+	rewind(fh_sam);
+	return 0;
+}
+
 int main(int argc, char **argv) {
 
 	if(argc == 1) {
@@ -87,14 +306,17 @@ int main(int argc, char **argv) {
 		     << "precise-mapq-flag "
 		     << "write-orig-mapq "
 		     << "write-precise-mapq "
-		     << "keep-ztz" << endl;
+		     << "keep-ztz "
+		     << "rewrite-threads "
+		     << "max-allowed-fraglen" << endl;
 		return 0;
 	}
 
 	string fn;
 	string outfn;
 	string sam;           // handle 1 SAM file per invocation
-	vector<string> preds; // might handle many prediction files; need merging
+	vector<string> preds; // a .mapq file, or legacy files that need merging
+	string model_fn;      // or predict from a model file
 
 	// All arguments except last are SAM files to parse.  Final argument is
 	// output file.
@@ -125,6 +347,22 @@ int main(int argc, char **argv) {
 				if(strcmp(argv[i], "keep-ztz") == 0) {
 					keep_ztz = strcmp(argv[++i], "True") == 0;
 				}
+				if(strcmp(argv[i], "rewrite-threads") == 0) {
+					rewrite_threads = atoi(argv[++i]);
+					if(rewrite_threads < 1) {
+						cerr << "Error: rewrite-threads must be at least 1" << endl;
+						return -1;
+					}
+				}
+				if(strcmp(argv[i], "model-file") == 0) {
+					model_fn = argv[++i];
+				}
+				if(strcmp(argv[i], "model-chunk-rows") == 0) {
+					model_chunk_rows = (size_t)atol(argv[++i]);
+				}
+				if(strcmp(argv[i], "max-allowed-fraglen") == 0) {
+					max_allowed_fraglen = atoi(argv[++i]);
+				}
 			} else if(section == 1) {
 				sam = argv[i];
 			} else if(section == 2) {
@@ -138,9 +376,20 @@ int main(int argc, char **argv) {
 			}
 		}
 		if(sam.empty() || !outfn_set) {
-			cerr << "Usage: qtip_rewrite" << endl;
+			cerr << "Usage: qtip_rewrite [argument value]* -- [sam] -- [predictions]* -- [output sam]" << endl;
+			cerr << "Arguments:" << endl;
+			cerr << "  model-file <path>: predict MAPQs from the input SAM "
+			     << "using this model, written by MapqFit.export_forests, "
+			     << "instead of reading prediction files" << endl;
+			cerr << "  model-chunk-rows <int>: with model-file, post-process "
+			     << "predictions this many rows at a time, like "
+			     << "--max-rows" << endl;
 		}
 	}
+	if(!model_fn.empty() && !preds.empty()) {
+		cerr << "Error: specify prediction files or model-file, not both" << endl;
+		return -1;
+	}
 
 	// Output SAM file
     char osam_buf[BUFSZ];
@@ -151,54 +400,77 @@ int main(int argc, char **argv) {
 	}
 	setvbuf(osam_fh, osam_buf, _IOFBF, BUFSZ); \
 
-	// Input SAM file
+	// Input SAM file; "-" means stdin.  Regular files are mapped into
+	// memory rather than read through stdio.
 	char buf_input_sam[BUFSZ];
-	FILE *fh_sam = fopen(sam.c_str(), "rb");
+	bool from_stdin = sam == "-";
+	FILE *fh_sam = from_stdin ? stdin : fopen(sam.c_str(), "rb");
 	if(fh_sam == NULL) {
 		cerr << "Could not open input SAM file \"" << sam << "\"" << endl;
 		return -1;
 	}
 	setvbuf(fh_sam, buf_input_sam, _IOFBF, BUFSZ);
 
+	// Predictions come from a .mapq file, legacy prediction files or, given
+	// a model, from the input SAM itself, which then has to be read twice
+	PredictionTable table;
+	if(!model_fn.empty()) {
+		if(from_stdin) {
+			cerr << "Error: model-file requires a SAM file rather than standard input" << endl;
+			return -1;
+		}
+		if(predict_with_model(fh_sam, model_fn, table) != 0) {
+			return -1;
+		}
+	} else if(preds.size() == 1 && preds[0].size() > 5 &&
+	          preds[0].compare(preds[0].size() - 5, 5, ".mapq") == 0)
+	{
+		if(table.map(preds[0]) != 0) {
+			return -1;
+		}
+	} else {
+		PredictionMerger pm(preds);
+		for(Prediction p = pm.next(); p.valid(); p = pm.next()) {
+			table.add(p);
+		}
+	}
+
 	cerr << "Parsing SAM file \"" << sam << "\"" << endl;
 
-	// Input prediction file
-	PredictionMerger m(preds);
-	bool done_with_predictions = false;
-	bool done_with_sam = false;
-	char linebuf[BUFSZ];
-	size_t nline = 0, nhead = 0;
-	size_t nskip = 0, nrewrite = 0;
-	while(!done_with_predictions || !done_with_sam) {
-		Prediction p = m.next();
-		done_with_predictions = !p.valid();
-		while(true) {
-			// Handle line of sam
-			if(fgets(linebuf, BUFSZ, fh_sam) == NULL) {
-				assert(done_with_predictions);
-				done_with_sam = true;
-				break;
-			}
+	size_t nhead = 0, nskip = 0, nrewrite = 0;
+	if(rewrite_threads > 1) {
+		if(rewrite_threaded(fh_sam, osam_fh, table, rewrite_threads, nhead, nskip, nrewrite) != 0) {
+			return -1;
+		}
+	} else {
+		char linebuf[BUFSZ];
+		LineReader rd(fh_sam, linebuf, BUFSZ);
+		const char *line = NULL;
+		size_t len = 0;
+		unsigned long long nline = 0;
+		double mapq = 0.0;
+		while(rd.next(line, len)) {
 			nline++;
-			assert(done_with_predictions || nline <= p.line);
-			if(linebuf[0] == '@') {
+			if(line[0] == '@') {
 				nhead++;
-				fputs(linebuf, osam_fh);
+				fwrite(line, 1, len, osam_fh);
 				continue; // skip header
 			}
-			if(done_with_predictions || p.line > nline) {
-				fputs(linebuf, osam_fh); // no prediction for this line
+			if(!table.get(nline, mapq)) {
+				fwrite(line, 1, len, osam_fh); // no prediction for this line
 				nskip++;
 				continue;
 			}
-			assert(nline == p.line); // there is a prediction
-			rewrite(osam_fh, linebuf, p.mapq);
+			rewrite(osam_fh, line, len, mapq);
 			nrewrite++;
-			break; // get next prediction
 		}
+		if(check_prediction_lines(table, nline) != 0) {
+			return -1;
+		}
+	}
+	if(!from_stdin) {
+		fclose(fh_sam);
 	}
-	assert(done_with_predictions && done_with_sam);
-	fclose(fh_sam);
 
 	cerr << "Header lines:  " << nhead << endl;
 	cerr << "Skipped lines (did not rewrite MAPQ): " << nskip << endl;
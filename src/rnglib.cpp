@@ -168,7 +168,9 @@ void antithetic_memory ( int i, bool &value )
 {
 # define G_MAX 32
 
-  static bool a_save[G_MAX];
+  // qtip: all the generator state here and in the other *_memory
+  // functions is per-thread, so simulation threads have their own streams
+  static __thread bool a_save[G_MAX];
   int g;
   const int g_max = 32;
   int j;
@@ -305,8 +307,8 @@ void cg_memory ( int i, int g, int &cg1, int &cg2 )
 {
 # define G_MAX 32
 
-  static int cg1_save[G_MAX];
-  static int cg2_save[G_MAX];
+  static __thread int cg1_save[G_MAX];
+  static __thread int cg2_save[G_MAX];
   const int g_max = 32;
   int j;
 
@@ -447,7 +449,7 @@ void cgn_memory ( int i, int &g )
 {
 # define G_MAX 32
 
-  static int g_save = 0;
+  static __thread int g_save = 0;
   const int g_max = 32;
 
   if ( i < 0 )
@@ -759,8 +761,8 @@ void ig_memory ( int i, int g, int &ig1, int &ig2 )
 # define G_MAX 32
 
   const int g_max = 32;
-  static int ig1_save[G_MAX];
-  static int ig2_save[G_MAX];
+  static __thread int ig1_save[G_MAX];
+  static __thread int ig2_save[G_MAX];
   int j;
 
   if ( g < 0 || g_max <= g )
@@ -1076,7 +1078,7 @@ void initialized_memory ( int i, bool &initialized )
 //    this is ignored.
 //
 {
-  static bool initialized_save = false;
+  static __thread bool initialized_save = false;
 
   if ( i < 0 )
   {
@@ -1209,8 +1211,8 @@ void lg_memory ( int i, int g, int &lg1, int &lg2 )
   const int g_max = 32;
 
   int j;
-  static int lg1_save[G_MAX];
-  static int lg2_save[G_MAX];
+  static __thread int lg1_save[G_MAX];
+  static __thread int lg2_save[G_MAX];
 
   if ( g < 0 || g_max <= g )
   {
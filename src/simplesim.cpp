@@ -7,10 +7,12 @@
 //
 
 #include <stdlib.h>
+#include <stdint.h>
 #include <vector>
 #include <iostream>
 #include <cctype>
 #include <math.h>
+#include <pthread.h>
 #include "simplesim.h"
 #include "fasta.h"
 #include "rnglib.hpp"
@@ -190,75 +192,146 @@ size_t apply_function(float fraction, int function, size_t mn, size_t n) {
 }
 
 /**
- * Simulate a batch of reads
+ * Return the next value from the splitmix64 generator with state x.
  */
-void StreamingSimulator::simulate_batch(
+static inline uint64_t splitmix64(uint64_t& x) {
+	uint64_t z = (x += 0x9e3779b97f4a7c15ULL);
+	z = (z ^ (z >> 30)) * 0xbf58476d1ce4e5b9ULL;
+	z = (z ^ (z >> 27)) * 0x94d049bb133111ebULL;
+	return z ^ (z >> 31);
+}
+
+/**
+ * Seed this thread's current rnglib generator for the chunk with the given
+ * index, so that every chunk has its own reproducible stream.
+ */
+static void seed_chunk(int seed, unsigned long long index) {
+	uint64_t x = (uint32_t)seed;
+	x = splitmix64(x) ^ index;
+	int cg1 = (int)(splitmix64(x) % 2147483562ULL) + 1; // [1, 2147483563)
+	int cg2 = (int)(splitmix64(x) % 2147483398ULL) + 1; // [1, 2147483399)
+	set_seed(cg1, cg2);
+}
+
+SimCounts StreamingSimulator::targets(
 	float fraction,
 	int function,
 	size_t min_u,
 	size_t min_c,
 	size_t min_d,
-	size_t min_b)
+	size_t min_b) const
+{
+	SimCounts target;
+	target.u = apply_function(fraction, function, min_u, model_u_.num_added());
+	target.b = apply_function(fraction, function, min_b, model_b_.num_added());
+	target.c = apply_function(fraction, function, min_c, model_c_.num_added());
+	target.d = apply_function(fraction, function, min_d, model_d_.num_added());
+	assert(target.u + target.b + target.c + target.d > 0);
+	return target;
+}
+
+static void print_counts(const SimCounts& target, const SimCounts& wrote) {
+	cerr << "    Wrote " << wrote.u << " unpaired tandem reads "
+	     << "(target=" << target.u << ")" << endl;
+	cerr << "    Wrote " << wrote.b << " bad-end tandem reads "
+	     << "(target=" << target.b << ")" << endl;
+	cerr << "    Wrote " << wrote.c << " concordant tandem pairs "
+	     << "(target=" << target.c << ")" << endl;
+	cerr << "    Wrote " << wrote.d << " discordant tandem pairs "
+	     << "(target=" << target.d << ")" << endl;
+}
+
+void StreamingSimulator::simulate_chunk(
+	const char *buf,
+	size_t retsz,
+	const std::string& refid,
+	size_t refoff,
+	const SimCounts& target,
+	FILE * const *fhs,
+	SimCounts& wrote) const
 {
-	size_t nc = 0, nd = 0, nu = 0, nb = 0;
-	size_t n_wrote_c = 0, n_wrote_d = 0, n_wrote_u = 0, n_wrote_b = 0;
-	nu = apply_function(fraction, function, min_u, model_u_.num_added());
-	nb = apply_function(fraction, function, min_b, model_b_.num_added());
-	nc = apply_function(fraction, function, min_c, model_c_.num_added());
-	nd = apply_function(fraction, function, min_d, model_d_.num_added());
-	assert(nu + nb + nc + nd > 0);
-	
-	std::string refid, refid_full;
-	size_t refoff = 0, retsz = 0;
 	SimulatedRead rd1, rd2;
 	int hist[256];
 	const int max_attempts = 10;
-	while(true) {
-		const char * buf = fa_.next(refid, refid_full, refoff, retsz);
-		if(buf == NULL && fa_.done()) {
-			break; // finished scanning FASTA
-		}
-		if(retsz < olap_) {
-			continue; // chunk is too small to simulate fragments from
-		}
-		const size_t nchances = retsz - olap_ + 1; // # draws within window
+	if(buf == NULL || retsz < olap_) {
+		return; // chunk is too small to simulate fragments from
+	}
+	const size_t nchances = retsz - olap_ + 1; // # draws within window
 
-		const float binom_p = min(((float)nchances) * 1.1f / tot_fasta_len_, 0.999f);
-		// Histogram characters
-		memset(hist, 0, sizeof(int) * 256);
-		for(size_t i = 0; i < retsz; i++) {
-			hist[(int)buf[i]]++;
-		}
-		if(hist['N'] > (int)(0.9 * retsz)) {
-			continue; // skip chunks that are mostly Ns
-		}
-		
-		// Maybe N content should affect choice for n*_chances
-		
-		//
-		// Unpaired
-		//
-		
-		size_t nu_samp = draw_binomial(nu, binom_p);
-		for(size_t i = 0; i < nu_samp; i++) {
-			int attempts = 0;
-			do {
-				if(attempts > max_attempts) {
-					break;
+	const float binom_p = min(((float)nchances) * 1.1f / tot_fasta_len_, 0.999f);
+	// Histogram characters
+	memset(hist, 0, sizeof(int) * 256);
+	for(size_t i = 0; i < retsz; i++) {
+		hist[(int)buf[i]]++;
+	}
+	if(hist['N'] > (int)(0.9 * retsz)) {
+		return; // skip chunks that are mostly Ns
+	}
+	
+	// Maybe N content should affect choice for n*_chances
+	
+	//
+	// Unpaired
+	//
+	
+	size_t nu_samp = draw_binomial(target.u, binom_p);
+	for(size_t i = 0; i < nu_samp; i++) {
+		int attempts = 0;
+		do {
+			if(attempts > max_attempts) {
+				break;
+			}
+			attempts++;
+			const TemplateUnpaired &t = model_u_.draw();
+			size_t nslots = retsz - olap_;
+			assert(nslots > 0);
+			size_t off = std::min((size_t)(r4_uni_01() * nslots), nslots-1);
+			assert(off < nslots);
+			const size_t rflen = t.reflen();
+			for(size_t j = off; j < off + rflen; j++) {
+				const int b = buf[j];
+				if(b != 'A' && b != 'C' && b != 'G' && b != 'T') {
+					continue; // uses 1 attempt
 				}
-				attempts++;
-				const TemplateUnpaired &t = model_u_.draw();
-				size_t nslots = retsz - olap_;
-				assert(nslots > 0);
-				size_t off = std::min((size_t)(r4_uni_01() * nslots), nslots-1);
-				assert(off < nslots);
-				const size_t rflen = t.reflen();
-				for(size_t j = off; j < off + rflen; j++) {
-					const int b = buf[j];
-					if(b != 'A' && b != 'C' && b != 'G' && b != 'T') {
-						continue; // uses 1 attempt
-					}
+			}
+			rd1.init(
+				buf + off,
+				t.qual_,
+				t.edit_xscript_,
+				t.fw_flag_ == 'T',
+				t.best_score_,
+				refid.c_str(),
+				refoff + off);
+			wrote.u++;
+			rd1.write(fhs[SIM_U], "u");
+		} while(false);
+	}
+	
+	//
+	// Bad-end
+	//
+
+	size_t nb_samp = draw_binomial(target.b, binom_p);
+	for(size_t i = 0; i < nb_samp; i++) {
+		int attempts = 0;
+		do {
+			if(attempts > max_attempts) {
+				break;
+			}
+			attempts++;
+			const TemplateUnpaired &t = model_b_.draw();
+			bool mate1 = t.mate_flag_ == '1';
+			size_t nslots = retsz - olap_;
+			size_t off = std::min((size_t)(r4_uni_01() * nslots), nslots-1);
+			assert(off < nslots);
+			const size_t rflen = t.reflen();
+			for(size_t j = off; j < off + rflen; j++) {
+				const int b = buf[j];
+				if(b != 'A' && b != 'C' && b != 'G' && b != 'T') {
+					continue; // uses 1 attempt
 				}
+			}
+			if(mate1) {
 				rd1.init(
 					buf + off,
 					t.qual_,
@@ -267,143 +340,238 @@ void StreamingSimulator::simulate_batch(
 					t.best_score_,
 					refid.c_str(),
 					refoff + off);
-				n_wrote_u++;
-				rd1.write(fh_u_, "u");
-			} while(false);
-		}
-		
-		//
-		// Bad-end
-		//
-
-		size_t nb_samp = draw_binomial(nb, binom_p);
-		for(size_t i = 0; i < nb_samp; i++) {
-			int attempts = 0;
-			do {
-				if(attempts > max_attempts) {
-					break;
-				}
-				attempts++;
-				const TemplateUnpaired &t = model_b_.draw();
-				bool mate1 = t.mate_flag_ == '1';
-				size_t nslots = retsz - olap_;
-				size_t off = std::min((size_t)(r4_uni_01() * nslots), nslots-1);
-				assert(off < nslots);
-				const size_t rflen = t.reflen();
-				for(size_t j = off; j < off + rflen; j++) {
-					const int b = buf[j];
-					if(b != 'A' && b != 'C' && b != 'G' && b != 'T') {
-						continue; // uses 1 attempt
-					}
+				rd2.init_random(
+					t.opp_len_,
+					t.fw_flag_ == 'T', // doesn't matter much, but need them for name
+					t.best_score_, // doesn't matter much, but need them for name
+					refid.c_str(), // doesn't matter much, but need them for name
+					refoff + off); // doesn't matter much, but need them for name
+			} else {
+				rd2.init(
+					buf + off,
+					t.qual_,
+					t.edit_xscript_,
+					t.fw_flag_ == 'T',
+					t.best_score_,
+					refid.c_str(),
+					refoff + off);
+				rd1.init_random(
+					t.opp_len_,
+					t.fw_flag_ == 'T', // doesn't matter much, but need them for name
+					t.best_score_, // doesn't matter much, but need them for name
+					refid.c_str(), // doesn't matter much, but need them for name
+					refoff + off); // doesn't matter much, but need them for name
+			}
+			wrote.b++;
+			const char *lab = mate1 ? "b1" : "b2";
+			SimulatedRead::write_pair(rd1, rd2, fhs[SIM_B_1], fhs[SIM_B_2], lab);
+		} while(false);
+	}
+
+	//
+	// Concordant & discordant
+	//
+	
+	size_t nc_samp = draw_binomial(target.c, binom_p);
+	size_t nd_samp = draw_binomial(target.d, binom_p);
+	for(size_t i = 0; i < nc_samp + nd_samp; i++) {
+		bool conc = i < nc_samp;
+		int attempts = 0;
+		do {
+			if(attempts > max_attempts) {
+				break;
+			}
+			attempts++;
+			const TemplatePaired &t = conc ? model_c_.draw() : model_d_.draw();
+			size_t nslots = retsz - olap_;
+			size_t off = std::min((size_t)(r4_uni_01() * nslots), nslots-1);
+			assert(off < nslots);
+			size_t off_1, off_2;
+			const size_t rflen_1 = edit_xscript_to_rflen(t.edit_xscript_1_);
+			const size_t rflen_2 = edit_xscript_to_rflen(t.edit_xscript_2_);
+			if(t.upstream1_) {
+				off_1 = off;
+				off_2 = off + std::max(t.fraglen_, rflen_2) - rflen_2;
+			} else {
+				off_2 = off;
+				off_1 = off + std::max(t.fraglen_, rflen_1) - rflen_1;
+			}
+			for(size_t j = off_1; j < off_1 + rflen_1; j++) {
+				const int b = buf[j];
+				if(b != 'A' && b != 'C' && b != 'G' && b != 'T') {
+					continue; // uses 1 attempt
 				}
-				if(mate1) {
-					rd1.init(
-						buf + off,
-						t.qual_,
-						t.edit_xscript_,
-						t.fw_flag_ == 'T',
-						t.best_score_,
-						refid.c_str(),
-						refoff + off);
-					rd2.init_random(
-						t.opp_len_,
-						t.fw_flag_ == 'T', // doesn't matter much, but need them for name
-						t.best_score_, // doesn't matter much, but need them for name
-						refid.c_str(), // doesn't matter much, but need them for name
-						refoff + off); // doesn't matter much, but need them for name
-				} else {
-					rd2.init(
-						buf + off,
-						t.qual_,
-						t.edit_xscript_,
-						t.fw_flag_ == 'T',
-						t.best_score_,
-						refid.c_str(),
-						refoff + off);
-					rd1.init_random(
-						t.opp_len_,
-						t.fw_flag_ == 'T', // doesn't matter much, but need them for name
-						t.best_score_, // doesn't matter much, but need them for name
-						refid.c_str(), // doesn't matter much, but need them for name
-						refoff + off); // doesn't matter much, but need them for name
+			}
+			for(size_t j = off_2; j < off_2 + rflen_2; j++) {
+				const int b = buf[j];
+				if(b != 'A' && b != 'C' && b != 'G' && b != 'T') {
+					continue; // uses 1 attempt
 				}
-				n_wrote_b++;
-				const char *lab = mate1 ? "b1" : "b2";
-				SimulatedRead::write_pair(rd1, rd2, fh_b_1_, fh_b_2_, lab);
-			} while(false);
+			}
+			rd1.init(buf + off_1,
+					 t.qual_1_,
+					 t.edit_xscript_1_,
+					 t.fw_flag_1_ == 'T',
+					 t.score_1_,
+					 refid.c_str(),
+					 refoff + off_1);
+			rd2.init(buf + off_2,
+					 t.qual_2_,
+					 t.edit_xscript_2_,
+					 t.fw_flag_2_ == 'T',
+					 t.score_2_,
+					 refid.c_str(),
+					 refoff + off_2);
+			if(conc) { wrote.c++; } else { wrote.d++; }
+			const char *lab = conc ? "c" : "d";
+			SimulatedRead::write_pair(rd1, rd2,
+									  conc ? fhs[SIM_C_1] : fhs[SIM_D_1],
+									  conc ? fhs[SIM_C_2] : fhs[SIM_D_2],
+									  lab);
+		} while(false);
+	}
+}
+
+/**
+ * Simulate a batch of reads
+ */
+void StreamingSimulator::simulate_batch(
+	float fraction,
+	int function,
+	size_t min_u,
+	size_t min_c,
+	size_t min_d,
+	size_t min_b)
+{
+	SimCounts target = targets(fraction, function, min_u, min_c, min_d, min_b);
+	SimCounts wrote;
+	FILE *fhs[SIM_NFILES] = {
+		fh_u_, fh_b_1_, fh_b_2_, fh_c_1_, fh_c_2_, fh_d_1_, fh_d_2_
+	};
+	std::string refid, refid_full;
+	size_t refoff = 0, retsz = 0;
+	while(true) {
+		const char * buf = fa_.next(refid, refid_full, refoff, retsz);
+		if(buf == NULL && fa_.done()) {
+			break; // finished scanning FASTA
 		}
+		simulate_chunk(buf, retsz, refid, refoff, target, fhs, wrote);
+	}
+	print_counts(target, wrote);
+}
 
-		//
-		// Concordant & discordant
-		//
-		
-		size_t nc_samp = draw_binomial(nc, binom_p);
-		size_t nd_samp = draw_binomial(nd, binom_p);
-		for(size_t i = 0; i < nc_samp + nd_samp; i++) {
-			bool conc = i < nc_samp;
-			int attempts = 0;
-			do {
-				if(attempts > max_attempts) {
-					break;
-				}
-				attempts++;
-				const TemplatePaired &t = conc ? model_c_.draw() : model_d_.draw();
-				size_t nslots = retsz - olap_;
-				size_t off = std::min((size_t)(r4_uni_01() * nslots), nslots-1);
-				assert(off < nslots);
-				size_t off_1, off_2;
-				const size_t rflen_1 = edit_xscript_to_rflen(t.edit_xscript_1_);
-				const size_t rflen_2 = edit_xscript_to_rflen(t.edit_xscript_2_);
-				if(t.upstream1_) {
-					off_1 = off;
-					off_2 = off + std::max(t.fraglen_, rflen_2) - rflen_2;
-				} else {
-					off_2 = off;
-					off_1 = off + std::max(t.fraglen_, rflen_1) - rflen_1;
-				}
-				for(size_t j = off_1; j < off_1 + rflen_1; j++) {
-					const int b = buf[j];
-					if(b != 'A' && b != 'C' && b != 'G' && b != 'T') {
-						continue; // uses 1 attempt
-					}
-				}
-				for(size_t j = off_2; j < off_2 + rflen_2; j++) {
-					const int b = buf[j];
-					if(b != 'A' && b != 'C' && b != 'G' && b != 'T') {
-						continue; // uses 1 attempt
-					}
+bool StreamingSimulator::next_chunk(ChunkJob& job, unsigned long long& index) {
+	while(true) {
+		// names are only set at the start of each FASTA record
+		const char *buf = fa_.next(refid_, refid_full_, job.refoff, job.retsz);
+		if(buf == NULL && fa_.done()) {
+			return false;
+		}
+		if(buf == NULL || job.retsz < olap_) {
+			continue; // chunk is too small to simulate fragments from
+		}
+		// the parser reuses its buffer, so the chunk is copied
+		job.buf.assign(buf, buf + job.retsz);
+		job.buf.push_back('\0');
+		job.refid = refid_;
+		job.index = index++;
+		return true;
+	}
+}
+
+void *StreamingSimulator::chunk_worker(void *vjob) {
+	ChunkJob *job = (ChunkJob *)vjob;
+	seed_chunk(job->seed, job->index);
+	FILE *fhs[SIM_NFILES];
+	for(int i = 0; i < SIM_NFILES; i++) {
+		job->out[i] = NULL;
+		job->out_len[i] = 0;
+		fhs[i] = open_memstream(&job->out[i], &job->out_len[i]);
+		if(fhs[i] == NULL) {
+			cerr << "Error: could not open buffer for simulated reads" << endl;
+			job->failed = true;
+		}
+	}
+	try {
+		if(!job->failed) {
+			job->sim->simulate_chunk(&job->buf[0], job->retsz, job->refid,
+			                         job->refoff, *job->target, fhs, job->wrote);
+		}
+	} catch(int e) {
+		job->failed = true;
+	}
+	for(int i = 0; i < SIM_NFILES; i++) {
+		if(fhs[i] != NULL) {
+			fclose(fhs[i]);
+		}
+	}
+	return NULL;
+}
+
+/**
+ * Simulate a batch of reads using nthreads threads.  While one round of
+ * chunks is simulated, the next round is read from the FASTA files.
+ */
+void StreamingSimulator::simulate_batch_threaded(
+	float fraction,
+	int function,
+	size_t min_u,
+	size_t min_c,
+	size_t min_d,
+	size_t min_b,
+	int nthreads,
+	int seed)
+{
+	SimCounts target = targets(fraction, function, min_u, min_c, min_d, min_b);
+	SimCounts wrote;
+	FILE *fhs[SIM_NFILES] = {
+		fh_u_, fh_b_1_, fh_b_2_, fh_c_1_, fh_c_2_, fh_d_1_, fh_d_2_
+	};
+	vector<ChunkJob> jobs(nthreads), next_jobs(nthreads);
+	vector<pthread_t> tids(nthreads);
+	unsigned long long index = 0;
+	int njob = 0;
+	while(njob < nthreads && next_chunk(jobs[njob], index)) {
+		njob++;
+	}
+	while(njob > 0) {
+		for(int i = 0; i < njob; i++) {
+			jobs[i].sim = this;
+			jobs[i].target = &target;
+			jobs[i].seed = seed;
+			jobs[i].wrote = SimCounts();
+			jobs[i].failed = false;
+			if(pthread_create(&tids[i], NULL, chunk_worker, &jobs[i]) != 0) {
+				cerr << "Error: could not create simulation thread" << endl;
+				throw 1;
+			}
+		}
+		// get the next round of chunks while this round is simulated
+		int nnext = 0;
+		while(nnext < nthreads && next_chunk(next_jobs[nnext], index)) {
+			nnext++;
+		}
+		for(int i = 0; i < njob; i++) {
+			pthread_join(tids[i], NULL);
+		}
+		bool failed = false;
+		for(int i = 0; i < njob; i++) {
+			failed = failed || jobs[i].failed;
+			for(int j = 0; j < SIM_NFILES; j++) {
+				if(!failed) {
+					fwrite(jobs[i].out[j], 1, jobs[i].out_len[j], fhs[j]);
 				}
-				rd1.init(buf + off_1,
-						 t.qual_1_,
-						 t.edit_xscript_1_,
-						 t.fw_flag_1_ == 'T',
-						 t.score_1_,
-						 refid.c_str(),
-						 refoff + off_1);
-				rd2.init(buf + off_2,
-						 t.qual_2_,
-						 t.edit_xscript_2_,
-						 t.fw_flag_2_ == 'T',
-						 t.score_2_,
-						 refid.c_str(),
-						 refoff + off_2);
-				if(conc) { n_wrote_c++; } else { n_wrote_d++; }
-				const char *lab = conc ? "c" : "d";
-				SimulatedRead::write_pair(rd1, rd2,
-										  conc ? fh_c_1_ : fh_d_1_,
-										  conc ? fh_c_2_ : fh_d_2_,
-										  lab);
-			} while(false);
+				free(jobs[i].out[j]);
+			}
+			wrote.add(jobs[i].wrote);
+		}
+		if(failed) {
+			throw 1;
 		}
+		jobs.swap(next_jobs);
+		njob = nnext;
 	}
-	cerr << "    Wrote " << n_wrote_u << " unpaired tandem reads "
-	     << "(target=" << nu << ")" << endl;
-	cerr << "    Wrote " << n_wrote_b << " bad-end tandem reads "
-	     << "(target=" << nb << ")" << endl;
-	cerr << "    Wrote " << n_wrote_c << " concordant tandem pairs "
-	     << "(target=" << nc << ")" << endl;
-	cerr << "    Wrote " << n_wrote_d << " discordant tandem pairs "
-	     << "(target=" << nd << ")" << endl;
+	print_counts(target, wrote);
 }
 
 #ifdef SIMPLESIM_MAIN
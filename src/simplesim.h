@@ -11,6 +11,7 @@
 
 #include <stdio.h>
 #include <vector>
+#include <string>
 #include <algorithm>
 #include <fstream>
 #include "fasta.h"
@@ -200,6 +201,37 @@ enum {
     FUNC_CONST
 };
 
+/**
+ * Indexes of the destinations for simulated reads.
+ */
+enum {
+	SIM_U = 0,  // unpaired
+	SIM_B_1,    // bad-end, mate 1
+	SIM_B_2,    // bad-end, mate 2
+	SIM_C_1,    // concordant, mate 1
+	SIM_C_2,    // concordant, mate 2
+	SIM_D_1,    // discordant, mate 1
+	SIM_D_2,    // discordant, mate 2
+	SIM_NFILES
+};
+
+/**
+ * Number of unpaired reads or pairs in each category, e.g. to simulate or
+ * simulated so far.
+ */
+struct SimCounts {
+	SimCounts() : u(0), b(0), c(0), d(0) { }
+
+	void add(const SimCounts& o) {
+		u += o.u;
+		b += o.b;
+		c += o.c;
+		d += o.d;
+	}
+
+	size_t u, b, c, d;
+};
+
 /**
  * What do we need from the dists?
  * 1. Average read/fragment lengths for all 4 classes
@@ -255,6 +287,23 @@ public:
 		size_t min_c,
 		size_t min_d,
 		size_t min_b);
+
+	/**
+	 * Like simulate_batch but simulates from nthreads FASTA chunks at a time
+	 * on separate threads.  Each chunk draws from its own stream of
+	 * pseudo-random numbers, seeded from seed and the chunk's index, and
+	 * its reads are buffered and written in chunk order.  So output depends
+	 * only on seed, not on nthreads, though it differs from simulate_batch's.
+	 */
+	void simulate_batch_threaded(
+		float fraction,
+		int function,
+		size_t min_u,
+		size_t min_c,
+		size_t min_d,
+		size_t min_b,
+		int nthreads,
+		int seed);
 	
 	/**
 	 * Return the estimated number of bases in all the FASTA files, based on
@@ -265,7 +314,59 @@ public:
 	}
 
 protected:
-	
+
+	/**
+	 * One FASTA chunk being simulated from on a worker thread, with the
+	 * FASTQ it produced for each destination.
+	 */
+	struct ChunkJob {
+		const StreamingSimulator *sim;
+		const SimCounts *target;
+		int seed;
+		unsigned long long index;
+		std::vector<char> buf;
+		size_t retsz;
+		std::string refid;
+		size_t refoff;
+		char *out[SIM_NFILES];
+		size_t out_len[SIM_NFILES];
+		SimCounts wrote;
+		bool failed;
+	};
+
+	static void *chunk_worker(void *vjob);
+
+	/**
+	 * Copy the next FASTA chunk big enough to simulate from into job.
+	 * Returns false when there are no more.
+	 */
+	bool next_chunk(ChunkJob& job, unsigned long long& index);
+
+	/**
+	 * Return number of reads or pairs to simulate in each category.
+	 */
+	SimCounts targets(
+		float fraction,
+		int function,
+		size_t min_u,
+		size_t min_c,
+		size_t min_d,
+		size_t min_b) const;
+
+	/**
+	 * Simulate reads from retsz characters of reference starting at buf,
+	 * drawing the number in each category from the binomial distributions
+	 * implied by target, and write them to fhs, indexed as by SIM_U etc.
+	 */
+	void simulate_chunk(
+		const char *buf,
+		size_t retsz,
+		const std::string& refid,
+		size_t refoff,
+		const SimCounts& target,
+		FILE * const *fhs,
+		SimCounts& wrote) const;
+
 	/**
 	 * Return size of file in bytes.
 	 */
@@ -300,6 +401,8 @@ protected:
 	FILE *fh_c_2_;  // destimation for simulated discordant reads, mate 2
 	FILE *fh_d_1_;  // destimation for simulated concordant reads, mate 1
 	FILE *fh_d_2_;  // destimation for simulated discordant reads, mate 2
+	std::string refid_;       // name of reference next_chunk is reading
+	std::string refid_full_;
 };
 
 #endif /* defined(__qtip__simplesim__) */